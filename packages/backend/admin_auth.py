@@ -0,0 +1,24 @@
+"""
+Admin Authentication for Pizoo Dating App
+Shared-secret dependency for operator-only endpoints (metrics, bulk invites)
+"""
+
+import os
+import hmac
+import logging
+
+from fastapi import Header, HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+# Unset means every admin-only endpoint refuses requests (fail closed)
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY', '')
+
+
+async def require_admin(x_admin_key: str = Header(default='')):
+    """FastAPI dependency: the X-Admin-Key header must match ADMIN_API_KEY"""
+    if not ADMIN_API_KEY:
+        logger.warning("⚠️ Admin endpoint called but ADMIN_API_KEY is not configured")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="ADMIN_DISABLED")
+    if not hmac.compare_digest(x_admin_key.encode(), ADMIN_API_KEY.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="ADMIN_ONLY")
@@ -3,15 +3,14 @@ Admin Tools for Pizoo
 SMS invite sending and other administrative functions
 """
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, File, Form, UploadFile
 from pydantic import BaseModel
 from sms_service import send_sms
+from invite_service import bulk_invites
+from admin_auth import require_admin
 
-# Import authentication dependency from main server
-# This will be imported properly when integrated
-# from server import get_current_user, db
-
-admin_router = APIRouter(prefix="/api/admin", tags=["admin"])
+# Every admin tool requires the X-Admin-Key header
+admin_router = APIRouter(prefix="/api/admin", tags=["admin"], dependencies=[Depends(require_admin)])
 
 
 class SMSInvitePayload(BaseModel):
@@ -32,20 +31,13 @@ async def send_invite_sms(payload: SMSInvitePayload):
     
     Returns:
         Success status
-    
-    Note: This endpoint should be protected with admin authentication
     """
-    # TODO: Add admin authentication check
-    # user = await get_current_user()
-    # if not user.get("is_admin"):
-    #     raise HTTPException(403, "ADMIN_ONLY")
-    
     # Validate phone format
     if not payload.phone.startswith("+"):
         raise HTTPException(400, "INVALID_PHONE_FORMAT")
     
     # Send SMS
-    success = send_sms(payload.phone, payload.message)
+    success = await send_sms(payload.phone, payload.message)
     
     if not success:
         raise HTTPException(500, "SMS_FAILED")
@@ -57,41 +49,64 @@ async def send_invite_sms(payload: SMSInvitePayload):
     }
 
 
-@admin_router.post("/send-bulk-invites")
+async def _iter_list(phones: list[str]):
+    for phone in phones:
+        yield phone
+
+
+async def _iter_upload(upload: UploadFile, chunk_size: int = 64 * 1024):
+    """Yield the first column of each line of an uploaded CSV/text file without loading it whole"""
+    remainder = b""
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode("utf-8", "ignore").split(",")[0].strip().strip('"')
+    if remainder.strip():
+        yield remainder.decode("utf-8", "ignore").split(",")[0].strip().strip('"')
+
+
+def _require_jobs():
+    if not bulk_invites.available:
+        raise HTTPException(503, "DATABASE_UNAVAILABLE")
+
+
+@admin_router.post("/send-bulk-invites", status_code=202)
 async def send_bulk_invites(phones: list[str], message: str):
     """
-    Send SMS invitations to multiple phone numbers
+    Start a background SMS invite campaign
     
     Args:
-        phones: List of E.164 format phone numbers
+        phones: List of phone numbers (normalized to E.164, invalid and duplicate entries skipped)
         message: Message text to send
     
     Returns:
-        Success and failure counts
+        Job id and validation counts; poll /bulk-invites/{job_id} for progress
     """
-    # TODO: Add admin authentication check
-    
-    results = {
-        "success": [],
-        "failed": []
-    }
-    
-    for phone in phones:
-        if not phone.startswith("+"):
-            results["failed"].append({"phone": phone, "reason": "Invalid format"})
-            continue
-        
-        success = send_sms(phone, message)
-        
-        if success:
-            results["success"].append(phone)
-        else:
-            results["failed"].append({"phone": phone, "reason": "SMS sending failed"})
-    
-    return {
-        "ok": True,
-        "total": len(phones),
-        "sent": len(results["success"]),
-        "failed": len(results["failed"]),
-        "details": results
-    }
+    _require_jobs()
+    job = await bulk_invites.create_job(_iter_list(phones), message)
+    return {"ok": True, **job}
+
+
+@admin_router.post("/send-bulk-invites/upload", status_code=202)
+async def send_bulk_invites_upload(file: UploadFile = File(...), message: str = Form(...)):
+    """
+    Start a background SMS invite campaign from an uploaded file
+    (one phone per line, or a CSV whose first column is the phone)
+    """
+    _require_jobs()
+    job = await bulk_invites.create_job(_iter_upload(file), message)
+    return {"ok": True, **job}
+
+
+@admin_router.get("/bulk-invites/{job_id}")
+async def get_bulk_invite_status(job_id: str):
+    """Progress, throughput and recent failures of a bulk invite job"""
+    _require_jobs()
+    job = await bulk_invites.get_status(job_id)
+    if job is None:
+        raise HTTPException(404, "JOB_NOT_FOUND")
+    return job
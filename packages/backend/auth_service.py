@@ -4,20 +4,23 @@ Handles Google OAuth, Email Magic Link, Phone OTP verification
 """
 
 import os
-import httpx
 import secrets
 import string
 from datetime import datetime, timezone, timedelta
 from typing import Optional, Dict, Tuple
 from jose import JWTError, jwt
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import logging
 
+from email_queue import email_queue, SMTPConnectionPool
+from http_clients import http_clients
+from token_cache import TokenCache
+
 # JWT Settings
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-do-not-use-in-production')
 ALGORITHM = "HS256"
+
+# Decoded claims are cached until exp and checked against the logout deny list
+_token_cache = TokenCache(SECRET_KEY, [ALGORITHM])
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # 1 hour
 REFRESH_TOKEN_EXPIRE_DAYS = 7  # 7 days
 
@@ -29,11 +32,16 @@ SMTP_PASS = os.environ.get('SMTP_PASS', '')
 EMAIL_FROM = os.environ.get('EMAIL_FROM', 'Pizoo App <noreply@pizoo.app>')
 EMAIL_MODE = os.environ.get('EMAIL_MODE', 'mock')  # 'smtp' or 'mock'
 
+if EMAIL_MODE == 'smtp':
+    # Logged-in connections are reused by the email queue instead of one STARTTLS handshake per email
+    email_queue.configure_smtp(SMTPConnectionPool(SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS), EMAIL_FROM)
+
 # Frontend URL for magic links
 FRONTEND_URL = os.environ.get('FRONTEND_URL') if 'FRONTEND_URL' in os.environ else None
 
 # Emergent OAuth Service URL
 EMERGENT_OAUTH_URL = os.environ.get('EMERGENT_OAUTH_URL', 'https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data')
+http_clients.register('emergent_oauth')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -77,7 +85,7 @@ class AuthService:
     def verify_token(token: str, token_type: str = "access") -> Optional[Dict]:
         """Verify JWT token and return payload"""
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            payload = _token_cache.decode(token)
             
             # Verify token type
             if payload.get("type") != token_type:
@@ -96,17 +104,16 @@ class AuthService:
         Returns: {"id": str, "email": str, "name": str, "picture": str, "session_token": str}
         """
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    EMERGENT_OAUTH_URL,
-                    headers={"X-Session-ID": session_id}
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logger.error(f"Emergent OAuth session fetch failed: {response.status_code} - {response.text}")
-                    return None
+            response = await http_clients.get('emergent_oauth').get(
+                EMERGENT_OAUTH_URL,
+                headers={"X-Session-ID": session_id}
+            )
+            
+            if response.status_code == 200:
+                return response.json()
+            else:
+                logger.error(f"Emergent OAuth session fetch failed: {response.status_code} - {response.text}")
+                return None
         except Exception as e:
             logger.error(f"Error fetching Emergent OAuth session: {e}")
             return None
@@ -193,23 +200,17 @@ class AuthService:
             </html>
             """
             
-            # Create message
-            message = MIMEMultipart('alternative')
-            message['Subject'] = 'Verify Your Pizoo Account | تحقق من حساب Pizoo'
-            message['From'] = EMAIL_FROM
-            message['To'] = email
-            
-            html_part = MIMEText(html_content, 'html', 'utf-8')
-            message.attach(html_part)
+            # Queue for background delivery over the pooled SMTP connections
+            queued = email_queue.enqueue(
+                email,
+                'Verify Your Pizoo Account | تحقق من حساب Pizoo',
+                html_content,
+                transport='smtp'
+            )
             
-            # Send email
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                server.starttls()
-                server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(message)
-            
-            logger.info(f"✅ Verification email sent to {email}")
-            return True
+            if queued:
+                logger.info(f"✅ Verification email queued for {email}")
+            return queued
             
         except Exception as e:
             logger.error(f"❌ Failed to send verification email to {email}: {e}")
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark WebSocket Frame Encodings
+Compares bytes per frame and encode CPU per 10k frames for JSON vs MessagePack,
+with and without permessage-deflate and batching
+
+Usage: python bench_ws_protocol.py [frames]
+"""
+
+import sys
+import time
+import uuid
+import zlib
+from datetime import datetime, timezone
+
+from ws_codec import MSGPACK_AVAILABLE, JsonCodec, MsgpackCodec
+
+
+def sample_frames(count: int):
+    """A realistic mix: chat messages, presence, typing and acks"""
+    match_id = str(uuid.uuid4())
+    sender_id = str(uuid.uuid4())
+    frames = []
+    for i in range(count):
+        now = datetime.now(timezone.utc).isoformat()
+        kind = i % 4
+        if kind == 0:
+            frames.append({
+                'type': 'new_message',
+                'id': str(uuid.uuid4()),
+                'sender_id': sender_id,
+                'message': 'مرحبا! كيف حالك اليوم؟',
+                'match_id': match_id,
+                'timestamp': now
+            })
+        elif kind == 1:
+            frames.append({'type': 'user_status', 'user_id': sender_id, 'online': True, 'timestamp': now})
+        elif kind == 2:
+            frames.append({'type': 'typing', 'user_id': sender_id, 'is_typing': True})
+        else:
+            frames.append({'type': 'message_sent', 'id': str(uuid.uuid4()), 'success': True})
+    return frames
+
+
+def deflate_sizes(payloads):
+    """permessage-deflate with context takeover (the default both sides negotiate)"""
+    compressor = zlib.compressobj(wbits=-15)
+    total = 0
+    for payload in payloads:
+        data = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+        total += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def run(codec, frames, batch_size=1):
+    start = time.process_time()
+    if batch_size == 1:
+        payloads = [codec.encode(f) for f in frames]
+    else:
+        payloads = [
+            codec.encode({'type': 'batch', 'frames': frames[i:i + batch_size]})
+            for i in range(0, len(frames), batch_size)
+        ]
+    cpu = time.process_time() - start
+    raw = sum(len(p) if isinstance(p, bytes) else len(p.encode('utf-8')) for p in payloads)
+    return {
+        'bytes_per_frame': raw / len(frames),
+        'deflate_bytes_per_frame': deflate_sizes(payloads) / len(frames),
+        'cpu_ms_per_10k': cpu * 1000 * 10000 / len(frames),
+        'ws_frames': len(payloads),
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    frames = sample_frames(count)
+
+    print("🧪 WebSocket encoding benchmark")
+    print("=" * 78)
+    print(f"   • {count} frames (mix of new_message / user_status / typing / message_sent)")
+
+    cases = [('json', JsonCodec(), 1), ('json batch x8', JsonCodec(), 8)]
+    if MSGPACK_AVAILABLE:
+        cases += [('msgpack', MsgpackCodec(), 1), ('msgpack batch x8', MsgpackCodec(), 8)]
+    else:
+        print("   ⚠️ msgpack not installed - only JSON is measured")
+
+    print(f"\n{'encoding':<20}{'bytes/frame':>14}{'+deflate':>12}{'cpu ms/10k':>14}{'ws frames':>12}")
+    print("-" * 78)
+    baseline = None
+    for name, codec, batch_size in cases:
+        result = run(codec, frames, batch_size)
+        baseline = baseline or result['bytes_per_frame']
+        print(
+            f"{name:<20}{result['bytes_per_frame']:>14.1f}{result['deflate_bytes_per_frame']:>12.1f}"
+            f"{result['cpu_ms_per_10k']:>14.1f}{result['ws_frames']:>12}"
+            f"   ({result['bytes_per_frame'] / baseline:.0%} of json)"
+        )
+    print("=" * 78 + "\n")
+
+
+if __name__ == "__main__":
+    main()
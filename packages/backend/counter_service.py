@@ -0,0 +1,253 @@
+"""
+Counter Buffer for Pizoo Dating App
+Write-behind aggregation of high-frequency $inc/$addToSet updates, flushed with bulk_write
+"""
+
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+COUNTER_FLUSH_SECONDS = float(os.environ.get('COUNTER_FLUSH_SECONDS', '1'))
+# Most documents buffered at once (pending + being written); updates to further
+# documents are dropped until a flush frees room. Half of it triggers an early flush.
+COUNTER_MAX_PENDING = int(os.environ.get('COUNTER_MAX_PENDING', '10000'))
+# Failed flushes are merged back into the buffer this many times before being dropped
+COUNTER_MAX_RETRIES = int(os.environ.get('COUNTER_MAX_RETRIES', '3'))
+
+
+class CounterBuffer:
+    """
+    inc() and add_to_set() only touch memory: updates to the same document
+    are merged per (collection, query) and written at most once per
+    COUNTER_FLUSH_SECONDS as one unordered bulk_write per collection, so a
+    burst of N events on a document costs one write. Shutdown flushes what
+    is left; a crash loses at most one flush interval. Memory is capped at
+    COUNTER_MAX_PENDING documents: past it, updates to documents not already
+    buffered are dropped and counted, also while Mongo is down and failed
+    batches are waiting to be retried.
+
+    Only use it for counts that nothing is enforced against: a conditional
+    limit (free-tier quotas) has to stay a single atomic update. Readers of
+    buffered fields call apply_pending() on what they read, so a caller sees
+    its own writes; that holds within this worker, other workers see them
+    after the next flush.
+    """
+
+    def __init__(self):
+        self._db = None
+        # (collection, query key) -> entry
+        self._pending: Dict[Tuple[str, tuple], dict] = {}
+        # The batch being written, still visible to readers until it lands
+        self._in_flight: Dict[Tuple[str, tuple], dict] = {}
+        self._wake = asyncio.Event()
+        self._running = False
+        self._task: Optional[asyncio.Task] = None
+        self.stats_counters = {
+            'events': 0,
+            'writes': 0,
+            'flushes': 0,
+            'retried': 0,
+            'dropped': 0,
+            'over_capacity': 0,
+        }
+
+    def configure(self, db):
+        self._db = db
+
+    def start(self):
+        if self._task is None and self._db is not None:
+            self._running = True
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        # Let the loop finish its flush rather than cancelling a bulk_write half way
+        if self._task is not None:
+            self._running = False
+            self._wake.set()
+            await self._task
+            self._task = None
+        if self._db is not None and self._pending:
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Failed to flush counters on shutdown: {e}")
+
+    @staticmethod
+    def _key(collection: str, query: dict) -> Tuple[str, tuple]:
+        return collection, tuple(sorted(query.items()))
+
+    def _entry(self, collection: str, query: dict, upsert: bool, on_insert: Optional[dict]) -> Optional[dict]:
+        """The pending entry for this document, or None if the buffer is full and the event was dropped"""
+        key = self._key(collection, query)
+        entry = self._pending.get(key)
+        if entry is None:
+            if len(self._pending) + len(self._in_flight) >= COUNTER_MAX_PENDING:
+                self.stats_counters['over_capacity'] += 1
+                self.stats_counters['dropped'] += 1
+                self._wake.set()
+                return None
+            entry = self._pending[key] = {
+                'query': dict(query),
+                'inc': defaultdict(int),
+                'add_to_set': defaultdict(set),
+                'on_insert': dict(on_insert or {}),
+                'upsert': upsert,
+                'events': 0,
+                'attempts': 0,
+            }
+            if len(self._pending) >= COUNTER_MAX_PENDING // 2:
+                self._wake.set()
+        else:
+            self._merge_insert(entry, upsert, on_insert or {})
+        self.stats_counters['events'] += 1
+        entry['events'] += 1
+        return entry
+
+    @staticmethod
+    def _merge_insert(entry: dict, upsert: bool, on_insert: dict):
+        # Any caller asking for an upsert gets one; the first value of a field wins
+        entry['upsert'] = entry['upsert'] or upsert
+        for field, value in on_insert.items():
+            entry['on_insert'].setdefault(field, value)
+
+    def inc(self, collection: str, query: dict, fields: dict, upsert: bool = False,
+            on_insert: Optional[dict] = None):
+        """Buffer {'$inc': fields} for the document matching query (an equality filter)"""
+        entry = self._entry(collection, query, upsert, on_insert)
+        if entry is None:
+            return
+        for field, amount in fields.items():
+            entry['inc'][field] += amount
+
+    def add_to_set(self, collection: str, query: dict, field: str, value, upsert: bool = False,
+                   on_insert: Optional[dict] = None):
+        """Buffer {'$addToSet': {field: value}} for the document matching query"""
+        entry = self._entry(collection, query, upsert, on_insert)
+        if entry is not None:
+            entry['add_to_set'][field].add(value)
+
+    def apply_pending(self, collection: str, query: dict, doc: Optional[dict]) -> Optional[dict]:
+        """Return doc (as read from Mongo, or None) with this worker's unflushed updates applied"""
+        key = self._key(collection, query)
+        entries = [batch[key] for batch in (self._in_flight, self._pending) if key in batch]
+        if not entries:
+            return doc
+        if doc is None:
+            if not any(entry['upsert'] for entry in entries):
+                return None
+            doc = {**entries[0]['query'], **entries[0]['on_insert']}
+        else:
+            doc = dict(doc)
+        for entry in entries:
+            for field, amount in entry['inc'].items():
+                doc[field] = doc.get(field, 0) + amount
+            for field, values in entry['add_to_set'].items():
+                current = list(doc.get(field) or [])
+                current.extend(value for value in values if value not in current)
+                doc[field] = current
+        return doc
+
+    async def _loop(self):
+        while self._running:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=COUNTER_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Counter flush failed: {e}")
+
+    @staticmethod
+    def _update_op(entry: dict) -> UpdateOne:
+        update = {}
+        if entry['inc']:
+            update['$inc'] = dict(entry['inc'])
+        if entry['add_to_set']:
+            update['$addToSet'] = {field: {'$each': list(values)} for field, values in entry['add_to_set'].items()}
+        if entry['upsert']:
+            # A field can't be both initialised and updated by one statement
+            on_insert = {
+                field: value for field, value in entry['on_insert'].items()
+                if field not in entry['inc'] and field not in entry['add_to_set']
+            }
+            if on_insert:
+                update['$setOnInsert'] = on_insert
+        return UpdateOne(entry['query'], update, upsert=entry['upsert'])
+
+    def _requeue(self, key: Tuple[str, tuple], entry: dict):
+        entry['attempts'] += 1
+        if entry['attempts'] > COUNTER_MAX_RETRIES:
+            self.stats_counters['dropped'] += entry['events']
+            logger.error(f"❌ Dropping {entry['events']} buffered updates for {key[0]} {entry['query']}")
+            return
+        current = self._pending.get(key)
+        if current is None:
+            if len(self._pending) >= COUNTER_MAX_PENDING:
+                self.stats_counters['over_capacity'] += entry['events']
+                self.stats_counters['dropped'] += entry['events']
+                logger.error(f"❌ Counter buffer full, dropping {entry['events']} updates for {key[0]} {entry['query']}")
+                return
+            self.stats_counters['retried'] += 1
+            self._pending[key] = entry
+            return
+        self.stats_counters['retried'] += 1
+        # Newer updates arrived meanwhile: fold the failed batch into them
+        self._merge_insert(current, entry['upsert'], entry['on_insert'])
+        for field, amount in entry['inc'].items():
+            current['inc'][field] += amount
+        for field, values in entry['add_to_set'].items():
+            current['add_to_set'][field] |= values
+        current['events'] += entry['events']
+        current['attempts'] = max(current['attempts'], entry['attempts'])
+
+    async def flush(self):
+        """Write every pending update (one bulk_write per collection)"""
+        if not self._pending or self._in_flight:
+            return
+        self._in_flight, self._pending = self._pending, {}
+        try:
+            by_collection = defaultdict(list)
+            for key, entry in self._in_flight.items():
+                by_collection[key[0]].append((key, entry))
+
+            for collection, entries in by_collection.items():
+                try:
+                    await self._db[collection].bulk_write(
+                        [self._update_op(entry) for _, entry in entries],
+                        ordered=False
+                    )
+                    self.stats_counters['writes'] += len(entries)
+                except BulkWriteError as e:
+                    # e.g. two workers upserting the same new document: the
+                    # unique index rejects one, and the retry updates the winner
+                    failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                    self.stats_counters['writes'] += len(entries) - len(failed)
+                    for index in failed:
+                        self._requeue(*entries[index])
+                except Exception as e:
+                    logger.error(f"❌ Counter flush for {collection} failed: {e}")
+                    for key, entry in entries:
+                        self._requeue(key, entry)
+            self.stats_counters['flushes'] += 1
+        finally:
+            self._in_flight = {}
+
+    def stats(self) -> dict:
+        return {
+            'pending_documents': len(self._pending),
+            'pending_events': sum(entry['events'] for entry in self._pending.values()),
+            'flush_seconds': COUNTER_FLUSH_SECONDS,
+            **self.stats_counters,
+        }
+
+
+counter_buffer = CounterBuffer()
@@ -0,0 +1,157 @@
+"""
+Delivery Service for Pizoo Dating App
+Per-user pending-delivery queue for chat messages, sent on connect and cleared on delivery
+"""
+
+import os
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Iterable, List
+
+from realtime_service import ClientConnection, manager
+
+logger = logging.getLogger(__name__)
+
+# Frames waiting for an ack are dropped after this long (the inbox still has them)
+PENDING_DELIVERY_TTL_DAYS = int(os.environ.get('PENDING_DELIVERY_TTL_DAYS', '14'))
+# Max messages in one `pending_messages` frame; the client asks for more if has_more
+PENDING_DELIVERY_BATCH_SIZE = int(os.environ.get('PENDING_DELIVERY_BATCH_SIZE', '100'))
+MAX_ACK_IDS = 500
+
+
+class DeliveryQueue:
+    """
+    Online receivers get a chat message pushed immediately; everyone else gets
+    it queued and receives their backlog in one batched frame on connect, so a
+    reconnect costs one small query instead of a full inbox poll.
+
+    Acks are opt-in per connection (?acks=true). An entry sent to an acking
+    connection stays queued until its id is acked, so it survives a socket
+    that drops mid-send. A frame pushed to connections without acks is never
+    queued (and a flushed batch is removed once handed to the socket), so the
+    default client costs no extra writes and never gets a backlog replayed.
+    """
+
+    def __init__(self):
+        self._db = None
+        self.stats_counters = {
+            'enqueued': 0,
+            'pushed_live': 0,
+            'flushed_batches': 0,
+            'flushed_messages': 0,
+            'acked': 0,
+        }
+
+    def configure(self, db):
+        self._db = db
+
+    async def ensure_indexes(self):
+        if self._db is None:
+            return
+        collection = self._db.pending_deliveries
+        await collection.create_index([('user_id', 1), ('created_at', 1)])
+        await collection.create_index([('user_id', 1), ('message_id', 1)], unique=True)
+        await collection.create_index('expire_at', expireAfterSeconds=0)
+
+    def _acking(self, user_id: str) -> bool:
+        return any(c.acks and not c.closed for c in manager.get_connections(user_id))
+
+    async def _enqueue(self, user_id: str, message_id: str, frame: dict):
+        now = datetime.now(timezone.utc)
+        try:
+            await self._db.pending_deliveries.insert_one({
+                'user_id': user_id,
+                'message_id': message_id,
+                'frame': dict(frame),
+                'created_at': now,
+                'expire_at': now + timedelta(days=PENDING_DELIVERY_TTL_DAYS)
+            })
+            self.stats_counters['enqueued'] += 1
+        except Exception as e:
+            logger.error(f"❌ Failed to enqueue delivery {message_id} for {user_id}: {e}")
+
+    async def deliver(self, user_id: str, message_id: str, frame: dict) -> bool:
+        """
+        Push the frame to user_id's connections; queue it only if nothing took
+        it, or if one of them acks (queued first then, so an early ack finds it).
+        Returns True if it was pushed live.
+        """
+        if self._db is not None and self._acking(user_id):
+            await self._enqueue(user_id, message_id, frame)
+            pushed = await manager.send_personal_message(frame, user_id)
+        else:
+            pushed = await manager.send_personal_message(frame, user_id)
+            if not pushed and self._db is not None:
+                await self._enqueue(user_id, message_id, frame)
+                # The user may have connected (and flushed) while we were writing
+                if manager.get_connections(user_id):
+                    pushed = await manager.send_personal_message(frame, user_id)
+                    if pushed and not self._acking(user_id):
+                        await self._remove(user_id, [message_id])
+        if pushed:
+            self.stats_counters['pushed_live'] += 1
+        return pushed
+
+    async def _remove(self, user_id: str, message_ids: List[str]) -> int:
+        try:
+            result = await self._db.pending_deliveries.delete_many({
+                'user_id': user_id,
+                'message_id': {'$in': message_ids}
+            })
+            return result.deleted_count
+        except Exception as e:
+            logger.error(f"❌ Failed to clear {len(message_ids)} deliveries for {user_id}: {e}")
+            return 0
+
+    async def flush(self, user_id: str, connection: ClientConnection):
+        """Send the oldest pending frames to one connection as a single batch"""
+        if self._db is None:
+            return
+        pending = await self._db.pending_deliveries.find(
+            {'user_id': user_id},
+            {'_id': 0, 'message_id': 1, 'frame': 1}
+        ).sort('created_at', 1).limit(PENDING_DELIVERY_BATCH_SIZE + 1).to_list(length=None)
+        if not pending:
+            return
+
+        has_more = len(pending) > PENDING_DELIVERY_BATCH_SIZE
+        batch = pending[:PENDING_DELIVERY_BATCH_SIZE]
+        messages = [p['frame'] for p in batch]
+        queued = connection.enqueue({
+            'type': 'pending_messages',
+            'messages': messages,
+            'has_more': has_more,
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        })
+        if not queued:
+            return
+        self.stats_counters['flushed_batches'] += 1
+        self.stats_counters['flushed_messages'] += len(messages)
+        if not connection.acks:
+            # No acks will come: handing the batch to the socket is delivery
+            await self._remove(user_id, [p['message_id'] for p in batch])
+
+    async def ack(self, user_id: str, message_ids: Iterable[str]) -> int:
+        """Drop acked entries and mark those messages delivered. Returns entries removed."""
+        ids: List[str] = [m for m in message_ids if isinstance(m, str)][:MAX_ACK_IDS]
+        if self._db is None or not ids:
+            return 0
+        removed = await self._remove(user_id, ids)
+        await self._db.messages.update_many(
+            {'id': {'$in': ids}, 'receiver_id': user_id, 'status': 'sent'},
+            {'$set': {
+                'status': 'delivered',
+                'delivered_at': datetime.now(timezone.utc).isoformat()
+            }}
+        )
+        self.stats_counters['acked'] += removed
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            'batch_size': PENDING_DELIVERY_BATCH_SIZE,
+            **self.stats_counters,
+        }
+
+
+delivery_queue = DeliveryQueue()
@@ -0,0 +1,306 @@
+"""
+Email Queue for Pizoo Dating App
+Background delivery of outgoing email: SendGrid personalization batches, pooled SMTP, retries
+"""
+
+import os
+import time
+import queue
+import random
+import asyncio
+import logging
+import smtplib
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+EMAIL_WORKERS = int(os.environ.get('EMAIL_WORKERS', '4'))
+EMAIL_QUEUE_MAX = int(os.environ.get('EMAIL_QUEUE_MAX', '10000'))
+# SendGrid accepts up to 1000 personalizations per request
+EMAIL_BATCH_SIZE = min(int(os.environ.get('EMAIL_BATCH_SIZE', '500')), 1000)
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '4'))
+EMAIL_RETRY_BASE_SECONDS = float(os.environ.get('EMAIL_RETRY_BASE_SECONDS', '2'))
+EMAIL_SMTP_POOL_SIZE = int(os.environ.get('EMAIL_SMTP_POOL_SIZE', '2'))
+EMAIL_SMTP_TIMEOUT_SECONDS = float(os.environ.get('EMAIL_SMTP_TIMEOUT_SECONDS', '15'))
+EMAIL_SHUTDOWN_GRACE_SECONDS = float(os.environ.get('EMAIL_SHUTDOWN_GRACE_SECONDS', '10'))
+
+
+class SMTPConnectionPool:
+    """
+    Up to `size` logged-in SMTP connections reused across sends. A connection is
+    checked with NOOP before reuse and replaced when the server dropped it.
+    Used only from the email queue's worker threads.
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str, size: int = EMAIL_SMTP_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self._idle: "queue.LifoQueue[smtplib.SMTP]" = queue.LifoQueue()
+        self._slots = queue.Queue()
+        for _ in range(size):
+            self._slots.put(None)
+        self.connects = 0
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.host, self.port, timeout=EMAIL_SMTP_TIMEOUT_SECONDS)
+        server.starttls()
+        if self.user:
+            server.login(self.user, self.password)
+        self.connects += 1
+        return server
+
+    def send(self, message):
+        self._slots.get()
+        server = None
+        try:
+            try:
+                server = self._idle.get_nowait()
+                if server.noop()[0] != 250:
+                    raise smtplib.SMTPServerDisconnected()
+            except queue.Empty:
+                server = self._connect()
+            except (smtplib.SMTPException, OSError):
+                self._close(server)
+                server = self._connect()
+            server.send_message(message)
+            self._idle.put(server)
+            server = None
+        finally:
+            if server is not None:
+                # Failed mid-send; don't hand a broken connection to the next caller
+                self._close(server)
+            self._slots.put(None)
+
+    @staticmethod
+    def _close(server: Optional[smtplib.SMTP]):
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def close(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class EmailQueue:
+    """
+    Request handlers call enqueue(), which only appends to an in-memory queue.
+    EMAIL_WORKERS tasks drain it and run the blocking SendGrid/SMTP calls in a
+    thread pool. Queued SendGrid emails with identical subject and body are sent
+    as one request with one personalization per recipient. A failed send is
+    retried with jittered exponential backoff up to EMAIL_MAX_ATTEMPTS times.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=EMAIL_QUEUE_MAX)
+        self._workers: List[asyncio.Task] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._retry_handles = set()
+        self._sendgrid = None
+        self._sendgrid_from = None
+        self._smtp_pool: Optional[SMTPConnectionPool] = None
+        self._smtp_from = None
+        self.stats_counters = {
+            'enqueued': 0,
+            'sent': 0,
+            'retried': 0,
+            'failed': 0,
+            'rejected_full': 0,
+            'sendgrid_requests': 0,
+        }
+        self._send_total = 0.0
+        self._send_count = 0
+
+    def configure_sendgrid(self, client, from_email):
+        self._sendgrid = client
+        self._sendgrid_from = from_email
+
+    def configure_smtp(self, pool: SMTPConnectionPool, from_header: str):
+        self._smtp_pool = pool
+        self._smtp_from = from_header
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix='email-send')
+        return self._executor
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(EMAIL_WORKERS)]
+
+    async def stop(self):
+        """Give queued mail a short grace period, then stop the workers"""
+        if self._workers:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=EMAIL_SHUTDOWN_GRACE_SECONDS)
+            except asyncio.TimeoutError:
+                logger.warning(f"⚠️ Email queue stopped with {self._queue.qsize()} messages undelivered")
+            for task in self._workers:
+                task.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            self._workers = []
+        for handle in self._retry_handles:
+            handle.cancel()
+        self._retry_handles.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._smtp_pool is not None:
+            self._smtp_pool.close()
+
+    def enqueue(self, to_email: str, subject: str, html_content: str,
+                plain_text_content: Optional[str] = None, transport: str = 'sendgrid') -> bool:
+        """Queue an email for background delivery; False if the queue is full"""
+        item = {
+            'to': to_email,
+            'subject': subject,
+            'html': html_content,
+            'text': plain_text_content,
+            'transport': transport,
+            'attempts': 0,
+        }
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.stats_counters['rejected_full'] += 1
+            logger.error(f"❌ Email queue full, dropping email to {to_email}")
+            return False
+        self.stats_counters['enqueued'] += 1
+        return True
+
+    # ===== Workers =====
+
+    @staticmethod
+    def _batch_key(item: dict):
+        return (item['transport'], item['subject'], item['html'], item['text'])
+
+    def _take_batch(self, first: dict) -> List[dict]:
+        """Pull queued SendGrid emails with the same content as `first` (no await, so no races)"""
+        batch = [first]
+        if first['transport'] != 'sendgrid':
+            return batch
+        key = self._batch_key(first)
+        others = []
+        for _ in range(min(self._queue.qsize(), EMAIL_BATCH_SIZE * 2)):
+            item = self._queue.get_nowait()
+            if len(batch) < EMAIL_BATCH_SIZE and self._batch_key(item) == key:
+                batch.append(item)
+            else:
+                others.append(item)
+        for item in others:
+            self._queue.put_nowait(item)
+            self._queue.task_done()
+        return batch
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            batch = self._take_batch(first)
+            try:
+                started = time.monotonic()
+                try:
+                    ok = await loop.run_in_executor(self._get_executor(), self._deliver, batch)
+                except Exception as e:
+                    logger.error(f"❌ Error sending email to {len(batch)} recipient(s): {e}")
+                    ok = False
+                self._send_total += time.monotonic() - started
+                self._send_count += 1
+                if ok:
+                    self.stats_counters['sent'] += len(batch)
+                else:
+                    for item in batch:
+                        self._retry(item)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _retry(self, item: dict):
+        item['attempts'] += 1
+        if item['attempts'] >= EMAIL_MAX_ATTEMPTS:
+            self.stats_counters['failed'] += 1
+            logger.error(f"❌ Giving up on email to {item['to']} after {item['attempts']} attempts")
+            return
+        self.stats_counters['retried'] += 1
+        delay = random.uniform(0, EMAIL_RETRY_BASE_SECONDS * (2 ** item['attempts']))
+
+        def requeue():
+            self._retry_handles.discard(handle)
+            try:
+                self._queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.stats_counters['rejected_full'] += 1
+                logger.error(f"❌ Email queue full, dropping retry to {item['to']}")
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retry_handles.add(handle)
+
+    # ===== Transports (run in the thread pool) =====
+
+    def _deliver(self, batch: List[dict]) -> bool:
+        transport = batch[0]['transport']
+        if transport == 'sendgrid' and self._sendgrid is not None:
+            return self._deliver_sendgrid(batch)
+        if transport == 'smtp' and self._smtp_pool is not None:
+            return self._deliver_smtp(batch[0])
+        for item in batch:
+            logger.info(
+                f"[MOCK EMAIL] To: {item['to']} | Subject: {item['subject']} | "
+                f"Content: {(item['text'] or item['html'])[:100]}..."
+            )
+        return True
+
+    def _deliver_sendgrid(self, batch: List[dict]) -> bool:
+        from sendgrid.helpers.mail import Mail, To
+
+        first = batch[0]
+        message = Mail(
+            from_email=self._sendgrid_from,
+            to_emails=[To(item['to']) for item in batch],
+            subject=first['subject'],
+            plain_text_content=first['text'],
+            html_content=first['html'],
+            is_multiple=True  # one personalization per recipient; nobody sees the others
+        )
+        self.stats_counters['sendgrid_requests'] += 1
+        response = self._sendgrid.send(message)
+        if response.status_code == 202:
+            return True
+        logger.warning(f"⚠️ SendGrid returned {response.status_code} for {len(batch)} recipient(s)")
+        return False
+
+    def _deliver_smtp(self, item: dict) -> bool:
+        message = MIMEMultipart('alternative')
+        message['Subject'] = item['subject']
+        message['From'] = self._smtp_from
+        message['To'] = item['to']
+        if item['text']:
+            message.attach(MIMEText(item['text'], 'plain', 'utf-8'))
+        message.attach(MIMEText(item['html'], 'html', 'utf-8'))
+        self._smtp_pool.send(message)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'max_queue': EMAIL_QUEUE_MAX,
+            'workers': len(self._workers),
+            'retries_pending': len(self._retry_handles),
+            'avg_send_ms': round(self._send_total / self._send_count * 1000, 2) if self._send_count else None,
+            'smtp_connects': self._smtp_pool.connects if self._smtp_pool is not None else None,
+            **self.stats_counters,
+        }
+
+
+email_queue = EmailQueue()
@@ -4,21 +4,22 @@ Handles email verification, notifications, and marketing emails
 Supports SendGrid and mock mode
 """
 import os
+import html
 import random
 import string
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content
+from sendgrid.helpers.mail import Email
 from typing import Optional
-from datetime import datetime, timezone, timedelta
+
+from email_queue import email_queue
+from otp_store import otp_store
 
 # Configuration
 EMAIL_PROVIDER = os.getenv('EMAIL_PROVIDER', 'mock')  # sendgrid | mock
 SENDGRID_API_KEY = os.getenv('SENDGRID_API_KEY')
 EMAIL_FROM = os.getenv('EMAIL_FROM', 'noreply@pizoo.app')
 EMAIL_FROM_NAME = os.getenv('EMAIL_FROM_NAME', 'Pizoo')
-
-# Store OTP codes temporarily (in production, use Redis or database)
-otp_storage = {}
+EMAIL_OTP_TTL_SECONDS = int(os.getenv('EMAIL_OTP_TTL_SECONDS', '300'))  # 5 minutes
 
 class EmailService:
     def __init__(self):
@@ -32,6 +33,9 @@ class EmailService:
             print("⚠️  SendGrid API key not configured. Using mock mode.")
             self.provider = 'mock'
         
+        if self.sg:
+            email_queue.configure_sendgrid(self.sg, Email(self.sender_email, self.sender_name))
+        
         print(f"✅ Email service initialized: Provider={self.provider}, From={self.sender_email}")
     
     def generate_otp(self, length=6):
@@ -39,57 +43,19 @@ class EmailService:
         return ''.join(random.choices(string.digits, k=length))
     
     def send_email(self, to_email: str, subject: str, html_content: str, plain_text_content: Optional[str] = None):
-        """Send email via configured provider"""
-        
-        # Mock mode
-        if self.provider == 'mock':
-            print(f"[MOCK EMAIL]")
-            print(f"  From: {self.sender_email}")
-            print(f"  To: {to_email}")
-            print(f"  Subject: {subject}")
-            print(f"  Content: {plain_text_content or html_content[:100]}...")
-            return True
-        
-        # SendGrid mode
-        try:
-            from_email = Email(self.sender_email, self.sender_name)
-            to_email_obj = To(to_email)
-            
-            message = Mail(
-                from_email=from_email,
-                to_emails=to_email_obj,
-                subject=subject,
-                html_content=html_content
-            )
-            
-            if plain_text_content:
-                message.content = [
-                    Content("text/plain", plain_text_content),
-                    Content("text/html", html_content)
-                ]
-            
-            response = self.sg.send(message)
-            
-            if response.status_code == 202:
-                print(f"✅ Email sent successfully to {to_email}")
-                return True
-            else:
-                print(f"⚠️  Email sent with status code: {response.status_code}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Error sending email: {str(e)}")
-            return False
+        """Queue email for background delivery via configured provider (True once queued)"""
+        return email_queue.enqueue(to_email, subject, html_content, plain_text_content, transport=self.provider)
     
-    def send_verification_otp(self, email: str):
+    @staticmethod
+    def _otp_key(email: str) -> str:
+        return f"email:{email.strip().lower()}"
+    
+    async def send_verification_otp(self, email: str):
         """Send OTP verification email"""
         otp = self.generate_otp()
         
-        # Store OTP with expiry (5 minutes)
-        otp_storage[email] = {
-            'code': otp,
-            'expires_at': datetime.now(timezone.utc) + timedelta(minutes=5)
-        }
+        # Store hashed OTP with expiry (shared by all workers)
+        await otp_store.put(self._otp_key(email), otp, EMAIL_OTP_TTL_SECONDS)
         
         subject = "تأكيد بريدك الإلكتروني - Pizoo"
         
@@ -132,24 +98,9 @@ class EmailService:
         
         return self.send_email(email, subject, html_content, plain_text)
     
-    def verify_otp(self, email: str, code: str):
-        """Verify OTP code"""
-        if email not in otp_storage:
-            return False
-        
-        stored = otp_storage[email]
-        
-        # Check expiry
-        if datetime.now(timezone.utc) > stored['expires_at']:
-            del otp_storage[email]
-            return False
-        
-        # Check code
-        if stored['code'] == code:
-            del otp_storage[email]
-            return True
-        
-        return False
+    async def verify_otp(self, email: str, code: str):
+        """Verify OTP code (single use; expired or exhausted codes never match)"""
+        return await otp_store.verify(self._otp_key(email), code.strip())
     
     def send_new_match_notification(self, email: str, match_name: str, match_photo: str):
         """Send new match notification email"""
@@ -257,6 +208,56 @@ class EmailService:
         
         return self.send_email(email, subject, html_content)
     
+    def send_notification_digest(self, email: str, counts: dict, highlights: list):
+        """Send one summary email for the notifications collected during a digest window"""
+        parts = []
+        if counts.get('new_message'):
+            parts.append(f"💬 {counts['new_message']} رسائل جديدة")
+        if counts.get('new_match'):
+            parts.append(f"🎉 {counts['new_match']} تطابقات جديدة")
+        likes = counts.get('new_like', 0) + counts.get('super_like', 0)
+        if likes:
+            parts.append(f"❤️ {likes} إعجابات جديدة")
+        subject = " • ".join(parts) + " - Pizoo"
+        
+        items = "".join(
+            f'<div class="item"><strong>{html.escape(item["title"])}</strong><br>{html.escape(item["message"])}</div>'
+            for item in highlights
+        )
+        
+        html_content = f"""
+        <!DOCTYPE html>
+        <html dir="rtl" lang="ar">
+        <head>
+            <meta charset="UTF-8">
+            <style>
+                body {{ font-family: Arial, sans-serif; background-color: #f9f9f9; padding: 20px; }}
+                .container {{ max-width: 600px; margin: 0 auto; background-color: white; border-radius: 10px; overflow: hidden; }}
+                .header {{ background: linear-gradient(135deg, #ec4899, #f472b6); color: white; padding: 20px; text-align: center; }}
+                .content {{ padding: 30px; }}
+                .item {{ background: #f3f4f6; padding: 12px 15px; border-radius: 10px; margin: 10px 0; }}
+                .cta-button {{ display: inline-block; background: linear-gradient(135deg, #ec4899, #f472b6); color: white; padding: 12px 30px; border-radius: 50px; text-decoration: none; }}
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <div class="header">
+                    <h1>❤️‍🔥 Pizoo</h1>
+                </div>
+                <div class="content">
+                    <h2>{"<br>".join(parts)}</h2>
+                    {items}
+                    <a href="https://pizoo.app/notifications" class="cta-button">عرض الإشعارات</a>
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+        
+        plain_text = "\n".join(parts + [f"{item['title']}: {item['message']}" for item in highlights])
+        
+        return self.send_email(email, subject, html_content, plain_text)
+    
     def send_reengagement_email(self, email: str, user_name: str):
         """Send re-engagement email to inactive users"""
         subject = f"{user_name}، نحن نفتقدك! 💖"
@@ -0,0 +1,72 @@
+"""
+Ephemeral Auth Stores for Pizoo Dating App
+TTL and lookup indexes for sessions, OTPs, email tokens and rate limit windows
+"""
+
+import logging
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# collection -> [(keys, options)]
+# TTL indexes only act on BSON datetimes, so every TTL field below must be written
+# as a datetime (see migrate_ephemeral_expiries.py for older ISO-string/epoch rows).
+EPHEMERAL_INDEXES = {
+    'user_otp': [
+        # latest OTP for a phone
+        ([('phone', ASCENDING), ('_id', DESCENDING)], {}),
+        ([('expire_at', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'email_verification_tokens': [
+        ([('token', ASCENDING)], {'unique': True}),
+        ([('expires_at', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'user_sessions': [
+        # refresh lookup and logout delete_many by user_id
+        ([('user_id', ASCENDING), ('refresh_token', ASCENDING)], {}),
+        ([('expires_at', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'user_usage': [
+        # Daily view/like counters, one document per day (the unique index only dedupes it;
+        # consume_capped in server.py enforces the limit)
+        ([('user_id', ASCENDING), ('day', ASCENDING)], {'unique': True}),
+        ([('expire_at', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    'weekly_usage': [
+        # Weekly like/message quotas per ISO week, same scheme as user_usage
+        ([('user_id', ASCENDING), ('week', ASCENDING)], {'unique': True}),
+        ([('expire_at', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+    # Legacy per-endpoint windows (rate_limiter.py now uses rate_limit_counters); kept so old rows expire
+    'rate_limits': [
+        ([('user_id', ASCENDING), ('endpoint', ASCENDING)], {'unique': True}),
+        ([('expire_at', ASCENDING)], {'expireAfterSeconds': 0}),
+    ],
+}
+
+
+def epoch_to_datetime(epoch: int) -> datetime:
+    """OTP rows keep int epoch fields for compatibility; TTL needs a datetime twin"""
+    return datetime.fromtimestamp(int(epoch), tz=timezone.utc)
+
+
+async def ensure_ephemeral_indexes(db) -> List[Tuple[str, str]]:
+    """Create all ephemeral-store indexes; returns (collection, index) pairs that failed"""
+    failed = []
+    if db is None:
+        return failed
+    for collection, indexes in EPHEMERAL_INDEXES.items():
+        for keys, options in indexes:
+            try:
+                await db[collection].create_index(keys, **options)
+            except OperationFailure as e:
+                # e.g. an older index on the same keys with different options,
+                # or duplicate rows blocking a unique index
+                name = '_'.join(f"{k}_{d}" for k, d in keys)
+                failed.append((collection, name))
+                logger.error(f"❌ Failed to create index {name} on {collection}: {e}")
+    return failed
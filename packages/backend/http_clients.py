@@ -0,0 +1,120 @@
+"""
+HTTP Client Registry for Pizoo Dating App
+One pooled httpx.AsyncClient per upstream, opened at startup and closed on shutdown
+"""
+
+import os
+import time
+import logging
+import importlib.util
+from typing import Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 needs the optional h2 package; without it clients fall back to HTTP/1.1 keep-alive
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+HTTP_CLIENT_HTTP2 = os.environ.get('HTTP_CLIENT_HTTP2', 'true').lower() == 'true'
+HTTP_CLIENT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CLIENT_TIMEOUT_SECONDS', '10'))
+HTTP_CLIENT_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CLIENT_CONNECT_TIMEOUT_SECONDS', '3'))
+HTTP_CLIENT_MAX_CONNECTIONS = int(os.environ.get('HTTP_CLIENT_MAX_CONNECTIONS', '50'))
+HTTP_CLIENT_MAX_KEEPALIVE = int(os.environ.get('HTTP_CLIENT_MAX_KEEPALIVE', '20'))
+HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS = float(os.environ.get('HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS', '30'))
+
+
+class HTTPClientRegistry:
+    """
+    Modules register their upstream once at import time (base URL, headers,
+    timeouts, pool limits) and call get(name) per request instead of building
+    a client, so connections and TLS sessions are reused across requests.
+    start() opens every registered client; close() is called from the
+    shutdown hook.
+    """
+
+    def __init__(self):
+        self._configs: Dict[str, dict] = {}
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._metrics: Dict[str, dict] = {}
+
+    def register(self, name: str, base_url: str = '', headers: Optional[dict] = None, auth=None,
+                 timeout: Optional[httpx.Timeout] = None, limits: Optional[httpx.Limits] = None):
+        self._configs[name] = {
+            'base_url': base_url,
+            'headers': headers,
+            'auth': auth,
+            'timeout': timeout or httpx.Timeout(
+                HTTP_CLIENT_TIMEOUT_SECONDS,
+                connect=HTTP_CLIENT_CONNECT_TIMEOUT_SECONDS
+            ),
+            'limits': limits or httpx.Limits(
+                max_connections=HTTP_CLIENT_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_CLIENT_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_CLIENT_KEEPALIVE_EXPIRY_SECONDS
+            ),
+        }
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._open(name)
+        return client
+
+    def _open(self, name: str) -> httpx.AsyncClient:
+        config = self._configs[name]
+        metrics = self._metrics.setdefault(name, {
+            'requests': 0,
+            'errors': 0,
+            'latency_total': 0.0,
+            'opened': 0,
+        })
+        metrics['opened'] += 1
+
+        async def on_request(request: httpx.Request):
+            request.extensions['started_at'] = time.monotonic()
+
+        async def on_response(response: httpx.Response):
+            metrics['requests'] += 1
+            metrics['latency_total'] += time.monotonic() - response.request.extensions.get('started_at', time.monotonic())
+            if response.status_code >= 500:
+                metrics['errors'] += 1
+
+        return httpx.AsyncClient(
+            base_url=config['base_url'],
+            headers=config['headers'],
+            auth=config['auth'],
+            timeout=config['timeout'],
+            limits=config['limits'],
+            http2=HTTP2_AVAILABLE and HTTP_CLIENT_HTTP2,
+            event_hooks={'request': [on_request], 'response': [on_response]},
+        )
+
+    def start(self):
+        for name in self._configs:
+            self.get(name)
+        logger.info(f"✅ HTTP clients ready: {', '.join(self._clients)} (http2={HTTP2_AVAILABLE and HTTP_CLIENT_HTTP2})")
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    def stats(self) -> dict:
+        clients = {}
+        for name, metrics in self._metrics.items():
+            requests = metrics['requests']
+            clients[name] = {
+                'open': name in self._clients and not self._clients[name].is_closed,
+                'requests': requests,
+                'server_errors': metrics['errors'],
+                'avg_latency_ms': round(metrics['latency_total'] / requests * 1000, 2) if requests else None,
+                'times_opened': metrics['opened'],
+            }
+        return {
+            'http2': HTTP2_AVAILABLE and HTTP_CLIENT_HTTP2,
+            'registered': sorted(self._configs),
+            'clients': clients,
+        }
+
+
+http_clients = HTTPClientRegistry()
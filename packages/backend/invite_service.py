@@ -0,0 +1,411 @@
+"""
+Bulk Invite Service for Pizoo Dating App
+Background SMS invite campaigns with a worker pool, provider rate limits and resumable progress
+"""
+
+import os
+import re
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import AsyncIterator, Dict, Optional
+
+from job_leases import job_leases
+from presence_service import as_utc
+from sms_service import E164, PROVIDER, send_sms
+
+logger = logging.getLogger(__name__)
+
+# Concurrent sends per job and sustained sends/second per SMS provider
+INVITE_WORKERS = int(os.environ.get('INVITE_WORKERS', '8'))
+INVITE_RATE_PER_SECOND = float(os.environ.get('INVITE_RATE_PER_SECOND', '10'))
+INVITE_BURST = int(os.environ.get('INVITE_BURST', '20'))
+INVITE_INSERT_BATCH = 1000
+# Progress is written to the job document at most this often
+INVITE_PROGRESS_SECONDS = float(os.environ.get('INVITE_PROGRESS_SECONDS', '2'))
+INVITE_LEASE_SECONDS = 60
+# A job still "preparing" this long after its last recipient batch lost its upload (restart mid-request)
+INVITE_PREPARE_STALE_SECONDS = int(os.environ.get('INVITE_PREPARE_STALE_SECONDS', '600'))
+
+_PHONE_NOISE_RE = re.compile(r"[\s\-().]")
+
+
+def normalize_phone(raw: str) -> Optional[str]:
+    """Strip formatting and return the E.164 form, or None if it isn't a valid number"""
+    phone = _PHONE_NOISE_RE.sub('', raw or '')
+    if phone.startswith('00'):
+        phone = '+' + phone[2:]
+    return phone if E164.match(phone) else None
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, bursting up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BulkInviteService:
+    """
+    Each campaign is an `invite_jobs` document plus one `invite_job_recipients`
+    row per unique valid phone (status pending/sent/failed). Creating a job only
+    validates, dedupes and stores the list; a background runner sends through
+    INVITE_WORKERS concurrent workers that share a per-provider token bucket
+    (one token per provider request, so retries and the alphanumeric fallback
+    count) and records every result on its recipient row. A job interrupted
+    while sending is picked up again on startup (one worker per job, via a
+    lease in `job_leases`) and continues with the rows still pending; one
+    interrupted while its list was being stored can't be, and is marked failed.
+    A runner that fails to renew its lease stops at once, and each row is
+    claimed (pending -> sending) before its SMS goes out, so a recipient is
+    never sent the invite twice; a row left "sending" by a dead runner is
+    marked failed rather than risk a duplicate.
+    """
+
+    def __init__(self):
+        self._db = None
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._runners: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.stats_counters = {
+            'jobs_created': 0,
+            'jobs_completed': 0,
+            'leases_lost': 0,
+            'sent': 0,
+            'failed': 0,
+        }
+
+    def configure(self, db):
+        self._db = db
+
+    @property
+    def available(self) -> bool:
+        return self._db is not None
+
+    async def ensure_indexes(self):
+        if self._db is None:
+            return
+        await self._db.invite_jobs.create_index('job_id', unique=True)
+        await self._db.invite_jobs.create_index('status')
+        await self._db.invite_job_recipients.create_index([('job_id', 1), ('phone', 1)], unique=True)
+        await self._db.invite_job_recipients.create_index([('job_id', 1), ('status', 1)])
+
+    def start(self):
+        if self._task is None and self._db is not None:
+            self._task = asyncio.create_task(self._resume_loop())
+
+    async def stop(self):
+        # Unfinished jobs keep status "running" and are resumed by whichever worker gets the lease
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        runners = list(self._runners.values())
+        for task in runners:
+            task.cancel()
+        # Let each runner record its final progress before the DB client closes
+        await asyncio.gather(*runners, return_exceptions=True)
+        self._runners.clear()
+
+    def _bucket(self, provider: str) -> TokenBucket:
+        bucket = self._buckets.get(provider)
+        if bucket is None:
+            bucket = self._buckets[provider] = TokenBucket(INVITE_RATE_PER_SECOND, INVITE_BURST)
+        return bucket
+
+    # ===== Job creation =====
+
+    async def create_job(self, phones: AsyncIterator[str], message: str, created_by: Optional[str] = None) -> dict:
+        """Validate and dedupe the phone stream, store the recipients and start sending"""
+        job_id = str(uuid.uuid4())
+        now = datetime.now(timezone.utc)
+        job = {
+            'job_id': job_id,
+            'status': 'preparing',
+            'message': message,
+            'provider': PROVIDER,
+            'created_by': created_by,
+            'total': 0,
+            'invalid': 0,
+            'duplicates': 0,
+            'sent': 0,
+            'failed': 0,
+            'created_at': now,
+            'updated_at': now,
+        }
+        await self._db.invite_jobs.insert_one(dict(job))
+
+        seen = set()
+        batch = []
+        invalid_samples = []
+        async for raw in phones:
+            phone = normalize_phone(raw)
+            if phone is None:
+                job['invalid'] += 1
+                if len(invalid_samples) < 20:
+                    invalid_samples.append(raw)
+                continue
+            if phone in seen:
+                job['duplicates'] += 1
+                continue
+            seen.add(phone)
+            batch.append({'job_id': job_id, 'phone': phone, 'status': 'pending', 'attempts': 0})
+            if len(batch) >= INVITE_INSERT_BATCH:
+                await self._db.invite_job_recipients.insert_many(batch, ordered=False)
+                batch = []
+                # Heartbeat: long uploads aren't mistaken for interrupted ones
+                await self._db.invite_jobs.update_one(
+                    {'job_id': job_id},
+                    {'$set': {'updated_at': datetime.now(timezone.utc)}}
+                )
+        if batch:
+            await self._db.invite_job_recipients.insert_many(batch, ordered=False)
+
+        job['total'] = len(seen)
+        job['status'] = 'running' if seen else 'completed'
+        await self._db.invite_jobs.update_one(
+            {'job_id': job_id},
+            {'$set': {
+                'status': job['status'],
+                'total': job['total'],
+                'invalid': job['invalid'],
+                'duplicates': job['duplicates'],
+                'invalid_samples': invalid_samples,
+                'updated_at': datetime.now(timezone.utc),
+            }}
+        )
+        self.stats_counters['jobs_created'] += 1
+        if seen:
+            await self._launch(job_id)
+        job.pop('_id', None)
+        return job
+
+    # ===== Running =====
+
+    async def _resume_loop(self):
+        """Pick up running jobs whose worker went away (its lease expired)"""
+        while True:
+            try:
+                await self._fail_stale_preparing()
+                async for job in self._db.invite_jobs.find({'status': 'running'}, {'_id': 0, 'job_id': 1}):
+                    await self._launch(job['job_id'])
+            except Exception as e:
+                logger.error(f"❌ Failed to resume bulk invite jobs: {e}")
+            await asyncio.sleep(INVITE_LEASE_SECONDS)
+
+    async def _fail_stale_preparing(self):
+        """
+        The phone list of a job arrives with its creating request; if the worker
+        died before the job left "preparing" the rest of the list is gone, so it
+        can't be resumed. Fail it (and drop its unsent rows) instead of leaving it
+        preparing forever.
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=INVITE_PREPARE_STALE_SECONDS)
+        async for job in self._db.invite_jobs.find(
+            {'status': 'preparing', 'updated_at': {'$lt': cutoff}},
+            {'_id': 0, 'job_id': 1}
+        ):
+            result = await self._db.invite_jobs.update_one(
+                {'job_id': job['job_id'], 'status': 'preparing', 'updated_at': {'$lt': cutoff}},
+                {'$set': {
+                    'status': 'failed',
+                    'error': 'Interrupted while storing recipients; create the job again',
+                    'finished_at': datetime.now(timezone.utc),
+                }}
+            )
+            if result.modified_count:
+                await self._db.invite_job_recipients.delete_many({'job_id': job['job_id']})
+                logger.warning(f"⚠️ Bulk invite job {job['job_id']} was interrupted while preparing; marked failed")
+
+    async def _acquire_lease(self, job_id: str) -> bool:
+        """One worker sends a given job; a dead worker's lease expires and another resumes"""
+        return await job_leases.acquire(f"bulk_invite:{job_id}", self._owner, INVITE_LEASE_SECONDS)
+
+    async def _launch(self, job_id: str):
+        if job_id in self._runners or not await self._acquire_lease(job_id):
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._runners[job_id] = task
+        task.add_done_callback(lambda _: self._runners.pop(job_id, None))
+
+    async def _run(self, job_id: str):
+        job = await self._db.invite_jobs.find_one({'job_id': job_id}, {'_id': 0})
+        if job is None:
+            return
+        bucket = self._bucket(job.get('provider') or PROVIDER)
+        runner = asyncio.current_task()
+        # Marks the rows this run claimed, so a late result from a superseded run can't overwrite them
+        run_id = str(uuid.uuid4())
+        # Results not yet added to the job document's counters
+        pending_progress = {'sent': 0, 'failed': 0}
+        queue: asyncio.Queue = asyncio.Queue(maxsize=INVITE_WORKERS * 4)
+
+        async def worker():
+            while True:
+                phone = await queue.get()
+                try:
+                    claimed = await self._db.invite_job_recipients.find_one_and_update(
+                        {'job_id': job_id, 'phone': phone, 'status': 'pending'},
+                        {'$set': {'status': 'sending', 'run_id': run_id}},
+                        projection={'_id': 1}
+                    )
+                    if claimed is None:
+                        continue
+                    try:
+                        ok = await send_sms(phone, job['message'], throttle=bucket.acquire)
+                        error = None if ok else 'SMS sending failed'
+                    except Exception as e:
+                        ok, error = False, str(e)
+                    self.stats_counters['sent' if ok else 'failed'] += 1
+                    await self._db.invite_job_recipients.update_one(
+                        {'job_id': job_id, 'phone': phone, 'status': 'sending', 'run_id': run_id},
+                        {'$set': {'status': 'sent' if ok else 'failed', 'error': error},
+                         '$inc': {'attempts': 1}}
+                    )
+                    pending_progress['sent' if ok else 'failed'] += 1
+                except Exception as e:
+                    logger.error(f"❌ Failed to record invite result for job {job_id}: {e}")
+                finally:
+                    queue.task_done()
+
+        async def flush_progress():
+            sent, failed = pending_progress['sent'], pending_progress['failed']
+            pending_progress['sent'] = pending_progress['failed'] = 0
+            await self._db.invite_jobs.update_one(
+                {'job_id': job_id},
+                {'$inc': {'sent': sent, 'failed': failed},
+                 '$set': {'updated_at': datetime.now(timezone.utc)}}
+            )
+
+        async def progress_loop():
+            while True:
+                await asyncio.sleep(INVITE_PROGRESS_SECONDS)
+                try:
+                    await flush_progress()
+                    renewed = await self._acquire_lease(job_id)
+                except Exception as e:
+                    # Keep renewing; a lease that really lapses is caught on a later tick
+                    logger.error(f"❌ Failed to renew bulk invite job {job_id}: {e}")
+                    continue
+                if not renewed:
+                    # Another worker may resume the job now; stop before it sends too
+                    self.stats_counters['leases_lost'] += 1
+                    logger.warning(f"⚠️ Lost the lease on bulk invite job {job_id}, stopping this runner")
+                    runner.cancel()
+                    return
+
+        # Rows a previous runner claimed but never recorded may or may not have been sent
+        await self._db.invite_job_recipients.update_many(
+            {'job_id': job_id, 'status': 'sending'},
+            {'$set': {'status': 'failed', 'error': 'Interrupted while sending; delivery unknown'},
+             '$inc': {'attempts': 1}}
+        )
+        processed = await self._recount(job_id)
+        now = datetime.now(timezone.utc)
+        await self._db.invite_jobs.update_one(
+            {'job_id': job_id},
+            {'$set': {
+                'started_at': job.get('started_at') or now,
+                'resumed_at': now,
+                'processed_at_resume': processed,
+            }}
+        )
+        workers = [asyncio.create_task(worker()) for _ in range(INVITE_WORKERS)]
+        progress = asyncio.create_task(progress_loop())
+        try:
+            cursor = self._db.invite_job_recipients.find(
+                {'job_id': job_id, 'status': 'pending'},
+                {'_id': 0, 'phone': 1}
+            )
+            async for recipient in cursor:
+                await queue.put(recipient['phone'])
+            await queue.join()
+        except asyncio.CancelledError:
+            # Shutdown or lost lease: results already recorded per recipient, the rest stay pending
+            raise
+        except Exception as e:
+            logger.error(f"❌ Bulk invite job {job_id} failed: {e}")
+            await self._db.invite_jobs.update_one({'job_id': job_id}, {'$set': {'status': 'failed', 'error': str(e)}})
+            return
+        finally:
+            progress.cancel()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, progress, return_exceptions=True)
+            try:
+                await asyncio.shield(flush_progress())
+            except Exception as e:
+                logger.error(f"❌ Failed to record bulk invite progress for {job_id}: {e}")
+
+        await self._db.invite_jobs.update_one(
+            {'job_id': job_id},
+            {'$set': {'status': 'completed', 'finished_at': datetime.now(timezone.utc)}}
+        )
+        await job_leases.release(f"bulk_invite:{job_id}", self._owner)
+        self.stats_counters['jobs_completed'] += 1
+        logger.info(f"✅ Bulk invite job {job_id} completed")
+
+    async def _recount(self, job_id: str) -> int:
+        """After a restart, rebuild sent/failed from recipient rows (counters may lag)"""
+        counts = {'sent': 0, 'failed': 0}
+        async for row in self._db.invite_job_recipients.aggregate([
+            {'$match': {'job_id': job_id, 'status': {'$in': ['sent', 'failed']}}},
+            {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+        ]):
+            counts[row['_id']] = row['count']
+        await self._db.invite_jobs.update_one({'job_id': job_id}, {'$set': counts})
+        return counts['sent'] + counts['failed']
+
+    # ===== Status =====
+
+    async def get_status(self, job_id: str) -> Optional[dict]:
+        job = await self._db.invite_jobs.find_one({'job_id': job_id}, {'_id': 0, 'message': 0})
+        if job is None:
+            return None
+        done = job['sent'] + job['failed']
+        # Throughput covers the current run only, so a resumed job isn't diluted by downtime
+        resumed_at = job.get('resumed_at')
+        rate = None
+        if resumed_at is not None:
+            end = job.get('finished_at') or datetime.now(timezone.utc)
+            elapsed = (as_utc(end) - as_utc(resumed_at)).total_seconds()
+            if elapsed > 0:
+                rate = (done - job.get('processed_at_resume', 0)) / elapsed
+        remaining = max(job['total'] - done, 0)
+        job['progress'] = round(done / job['total'], 4) if job['total'] else 1.0
+        job['throughput_per_second'] = round(rate, 2) if rate else None
+        job['eta_seconds'] = round(remaining / rate) if rate and job['status'] == 'running' else None
+        job['recent_failures'] = await self._db.invite_job_recipients.find(
+            {'job_id': job_id, 'status': 'failed'},
+            {'_id': 0, 'phone': 1, 'error': 1, 'attempts': 1}
+        ).limit(20).to_list(length=20)
+        return job
+
+    def stats(self) -> dict:
+        return {
+            'running_jobs': len(self._runners),
+            'workers_per_job': INVITE_WORKERS,
+            'rate_per_second': INVITE_RATE_PER_SECOND,
+            **self.stats_counters,
+        }
+
+
+bulk_invites = BulkInviteService()
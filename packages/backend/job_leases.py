@@ -0,0 +1,81 @@
+"""
+Job Leases for Pizoo Dating App
+Named, expiring leases in `job_leases` so only one worker runs a given background job
+"""
+
+import logging
+from datetime import datetime, timezone, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class JobLeases:
+    """
+    A lease is one `job_leases` document per name, taken with an upsert that
+    only matches when the lease is expired or already ours. That is only
+    exclusive because of the unique index on `name`: without it every
+    worker's upsert inserts its own document and "acquires" the lease. So the
+    index is created on its own at startup and verified, and acquire() refuses
+    every lease until it exists.
+    """
+
+    def __init__(self):
+        self._db = None
+        self._ready = False
+
+    def configure(self, db):
+        self._db = db
+
+    async def ensure_indexes(self) -> bool:
+        """Create and verify the unique index on name; returns whether leases are usable"""
+        if self._db is None:
+            return False
+        try:
+            await self._db.job_leases.create_index('name', unique=True)
+        except Exception as e:
+            logger.error(f"❌ Failed to create job_leases index: {e}")
+        try:
+            indexes = await self._db.job_leases.index_information()
+        except Exception as e:
+            logger.error(f"❌ Failed to read job_leases indexes: {e}")
+            indexes = {}
+        self._ready = any(
+            spec.get('unique') and spec.get('key') == [('name', 1)]
+            for spec in indexes.values()
+        )
+        if not self._ready:
+            logger.error("❌ job_leases has no unique index on name; leased background jobs will not run")
+        return self._ready
+
+    async def acquire(self, name: str, owner: str, seconds: float) -> bool:
+        """Take or renew the lease for `seconds`; False if another owner holds it"""
+        if self._db is None:
+            return False
+        # The index may have been fixed since startup (e.g. duplicates cleaned up)
+        if not self._ready and not await self.ensure_indexes():
+            return False
+        now = datetime.now(timezone.utc)
+        try:
+            lease = await self._db.job_leases.find_one_and_update(
+                {'name': name, '$or': [{'expires_at': {'$lt': now}}, {'owner': owner}]},
+                {'$set': {
+                    'owner': owner,
+                    'expires_at': now + timedelta(seconds=seconds)
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another worker holds an unexpired lease
+            return False
+        return lease is not None and lease.get('owner') == owner
+
+    async def release(self, name: str, owner: str):
+        if self._db is not None:
+            await self._db.job_leases.delete_one({'name': name, 'owner': owner})
+
+
+job_leases = JobLeases()
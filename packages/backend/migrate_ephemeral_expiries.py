@@ -0,0 +1,161 @@
+"""
+Migration Script: Convert ephemeral auth expiries to BSON datetimes
+TTL indexes ignore ISO strings and ints, so older sessions, email tokens,
+OTPs, rate limit windows and daily usage counters would never be reaped without this
+"""
+
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from datetime import datetime, timezone, timedelta
+from dotenv import load_dotenv
+import asyncio
+
+from ephemeral_store import ensure_ephemeral_indexes, epoch_to_datetime
+
+# Load environment
+load_dotenv()
+
+MONGO_URL = os.environ['MONGO_URL']
+DB_NAME = os.environ['DB_NAME']
+BATCH_SIZE = 1000
+USAGE_RETENTION_DAYS = int(os.environ.get('USAGE_RETENTION_DAYS', '2'))
+
+
+def parse_iso(value) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+async def convert(collection, query: dict, build_set) -> int:
+    """Apply build_set(doc) -> $set dict to every doc matching query, in batches"""
+    converted = 0
+    ops = []
+    async for doc in collection.find(query):
+        try:
+            update = build_set(doc)
+        except (ValueError, TypeError, AttributeError):
+            print(f"   ⚠️ Skipping {collection.name} {doc['_id']}: unparseable expiry")
+            continue
+        ops.append(UpdateOne({'_id': doc['_id']}, {'$set': update}))
+        if len(ops) >= BATCH_SIZE:
+            await collection.bulk_write(ops, ordered=False)
+            converted += len(ops)
+            ops = []
+    if ops:
+        await collection.bulk_write(ops, ordered=False)
+        converted += len(ops)
+    return converted
+
+
+async def dedupe_rate_limits(db) -> int:
+    """Keep only the newest window per (user_id, endpoint) so the unique index can build"""
+    removed = 0
+    pipeline = [
+        {'$sort': {'_id': -1}},
+        {'$group': {'_id': {'user_id': '$user_id', 'endpoint': '$endpoint'}, 'ids': {'$push': '$_id'}}},
+        {'$match': {'ids.1': {'$exists': True}}},
+    ]
+    async for group in db.rate_limits.aggregate(pipeline):
+        result = await db.rate_limits.delete_many({'_id': {'$in': group['ids'][1:]}})
+        removed += result.deleted_count
+    return removed
+
+
+async def dedupe_user_usage(db) -> int:
+    """Merge duplicate (user_id, day) usage documents, keeping the highest counts"""
+    removed = 0
+    pipeline = [
+        {'$group': {
+            '_id': {'user_id': '$user_id', 'day': '$day'},
+            'ids': {'$push': '$_id'},
+            'views': {'$max': '$views'},
+            'likes': {'$max': '$likes'},
+        }},
+        {'$match': {'ids.1': {'$exists': True}}},
+    ]
+    async for group in db.user_usage.aggregate(pipeline):
+        keep, *extra = group['ids']
+        await db.user_usage.update_one(
+            {'_id': keep},
+            {'$set': {'views': group['views'] or 0, 'likes': group['likes'] or 0}}
+        )
+        result = await db.user_usage.delete_many({'_id': {'$in': extra}})
+        removed += result.deleted_count
+    return removed
+
+
+async def migrate_expiries():
+    """Convert string/epoch expiries and create the TTL + lookup indexes"""
+
+    print("🔄 Starting ephemeral expiry migration...")
+
+    client = AsyncIOMotorClient(MONGO_URL)
+    db = client[DB_NAME]
+
+    try:
+        sessions = await convert(
+            db.user_sessions,
+            {'expires_at': {'$type': 'string'}},
+            lambda doc: {'expires_at': parse_iso(doc['expires_at'])}
+        )
+        print(f"   • user_sessions converted: {sessions}")
+
+        tokens = await convert(
+            db.email_verification_tokens,
+            {'expires_at': {'$type': 'string'}},
+            lambda doc: {'expires_at': parse_iso(doc['expires_at'])}
+        )
+        print(f"   • email_verification_tokens converted: {tokens}")
+
+        otps = await convert(
+            db.user_otp,
+            {'expire_at': {'$exists': False}},
+            lambda doc: {'expire_at': epoch_to_datetime(doc['expires_at'])}
+        )
+        print(f"   • user_otp converted: {otps}")
+
+        def rate_limit_set(doc):
+            window_start = doc['window_start']
+            if isinstance(window_start, str):
+                window_start = parse_iso(window_start)
+            update = {
+                'window_start': window_start,
+                'expire_at': window_start + timedelta(hours=1),
+            }
+            if isinstance(doc.get('last_request'), str):
+                update['last_request'] = parse_iso(doc['last_request'])
+            return update
+
+        removed = await dedupe_rate_limits(db)
+        rate_limits = await convert(db.rate_limits, {'expire_at': {'$exists': False}}, rate_limit_set)
+        print(f"   • rate_limits converted: {rate_limits} (duplicates removed: {removed})")
+
+        removed = await dedupe_user_usage(db)
+        usage = await convert(
+            db.user_usage,
+            {'expire_at': {'$exists': False}},
+            lambda doc: {'expire_at': datetime.strptime(doc['day'], '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=USAGE_RETENTION_DAYS)}
+        )
+        print(f"   • user_usage converted: {usage} (duplicates merged: {removed})")
+
+        failed = await ensure_ephemeral_indexes(db)
+        if failed:
+            print(f"⚠️ Indexes not created: {failed}")
+        else:
+            print("✅ TTL and lookup indexes ready")
+
+        print("✅ Migration complete!")
+
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        raise
+    finally:
+        client.close()
+        print("\n🔒 Database connection closed")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate_expiries())
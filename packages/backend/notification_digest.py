@@ -0,0 +1,146 @@
+"""
+Notification Digest for Pizoo Dating App
+Buffers per-user notification events and emails one summary per window
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, List, Optional
+
+from email_service import email_service
+from presence_service import presence_store
+
+logger = logging.getLogger(__name__)
+
+# Notification types that are worth an email; the rest stay in-app only
+DIGEST_TYPES = {'new_message', 'new_match', 'new_like', 'super_like'}
+DIGEST_WINDOW_SECONDS = float(os.environ.get('DIGEST_WINDOW_SECONDS', '900'))
+DIGEST_TICK_SECONDS = float(os.environ.get('DIGEST_TICK_SECONDS', '30'))
+# Events listed in the email; everything else only shows up in the counts
+DIGEST_HIGHLIGHTS = int(os.environ.get('DIGEST_HIGHLIGHTS', '5'))
+DIGEST_MAX_USERS = int(os.environ.get('DIGEST_MAX_USERS', '100000'))
+
+
+class NotificationDigest:
+    """
+    create_notification() hands every emailable event to add(). Events for a
+    user are collected from the first one until DIGEST_WINDOW_SECONDS later,
+    then the tick loop sends one summary email per user (counts per type plus
+    the latest few events) through the email queue. Users who are online when
+    the event arrives or when the window closes get no email; they see the
+    notifications in the app. Buffers live in this worker's memory, so a user
+    whose events land on several workers can get one digest per worker.
+    """
+
+    def __init__(self):
+        self._db = None
+        # user_id -> {'opened_at', 'counts', 'highlights'}
+        self._buffers: Dict[str, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats_counters = {
+            'events': 0,
+            'skipped_online': 0,
+            'dropped_full': 0,
+            'digests_sent': 0,
+            'digests_skipped_online': 0,
+            'digests_no_email': 0,
+        }
+
+    def configure(self, db):
+        self._db = db
+
+    def start(self):
+        if self._task is None and self._db is not None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Don't lose the open windows on shutdown
+        if self._db is not None and self._buffers:
+            try:
+                await self.flush(force=True)
+            except Exception as e:
+                logger.error(f"❌ Failed to flush notification digests: {e}")
+
+    def add(self, user_id: str, notification_type: str, title: str, message: str):
+        if notification_type not in DIGEST_TYPES:
+            return
+        if presence_store.is_online(user_id):
+            self.stats_counters['skipped_online'] += 1
+            return
+        buffer = self._buffers.get(user_id)
+        if buffer is None:
+            if len(self._buffers) >= DIGEST_MAX_USERS:
+                self.stats_counters['dropped_full'] += 1
+                return
+            buffer = self._buffers[user_id] = {
+                'opened_at': time.monotonic(),
+                'counts': Counter(),
+                'highlights': [],
+            }
+        self.stats_counters['events'] += 1
+        buffer['counts'][notification_type] += 1
+        buffer['highlights'].append({'title': title, 'message': message})
+        del buffer['highlights'][:-DIGEST_HIGHLIGHTS]
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(DIGEST_TICK_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Notification digest flush failed: {e}")
+
+    async def flush(self, force: bool = False):
+        """Send digests for every window that has closed (all windows when force)"""
+        now = time.monotonic()
+        due = [
+            user_id for user_id, buffer in self._buffers.items()
+            if force or now - buffer['opened_at'] >= DIGEST_WINDOW_SECONDS
+        ]
+        if not due:
+            return
+        buffers = {user_id: self._buffers.pop(user_id) for user_id in due}
+
+        recipients: List[str] = []
+        for user_id in due:
+            if presence_store.is_online(user_id):
+                self.stats_counters['digests_skipped_online'] += 1
+            else:
+                recipients.append(user_id)
+        if not recipients:
+            return
+
+        # One query for the whole batch of closed windows
+        emails = {}
+        async for user in self._db.users.find(
+            {'id': {'$in': recipients}},
+            {'_id': 0, 'id': 1, 'email': 1}
+        ):
+            if user.get('email'):
+                emails[user['id']] = user['email']
+
+        for user_id in recipients:
+            email = emails.get(user_id)
+            if not email:
+                self.stats_counters['digests_no_email'] += 1
+                continue
+            buffer = buffers[user_id]
+            highlights = list(reversed(buffer['highlights']))  # newest first
+            if email_service.send_notification_digest(email, dict(buffer['counts']), highlights):
+                self.stats_counters['digests_sent'] += 1
+
+    def stats(self) -> dict:
+        return {
+            'open_windows': len(self._buffers),
+            'window_seconds': DIGEST_WINDOW_SECONDS,
+            **self.stats_counters,
+        }
+
+
+notification_digest = NotificationDigest()
@@ -0,0 +1,195 @@
+"""
+OTP Store for Pizoo Dating App
+Shared, expiring store of hashed one-time codes (Mongo TTL backend or in-memory)
+"""
+
+import os
+import hmac
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# mongo | memory. The memory backend is per worker, so only use it with a single worker
+OTP_STORE_BACKEND = os.environ.get('OTP_STORE_BACKEND', 'mongo')
+OTP_MAX_ATTEMPTS = int(os.environ.get('OTP_MAX_ATTEMPTS', '5'))
+OTP_SWEEP_SECONDS = float(os.environ.get('OTP_SWEEP_SECONDS', '60'))
+
+
+def hash_code(key: str, code: str) -> str:
+    """HMAC of key + code, so a leaked store does not reveal usable codes"""
+    secret = (os.environ.get('JWT_SECRET') or os.environ.get('SECRET_KEY') or 'pizoo-secret').encode()
+    return hmac.new(secret, f"{key}-{code}".encode(), hashlib.sha256).hexdigest()
+
+
+class MemoryOTPBackend:
+    """Dict of key -> entry with a periodic sweeper for codes nobody verified"""
+
+    name = 'memory'
+
+    def __init__(self):
+        # key -> {'hash', 'expires_at' (epoch), 'attempts_left'}
+        self._entries: Dict[str, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.swept = 0
+
+    async def ensure_indexes(self):
+        pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(OTP_SWEEP_SECONDS)
+            self.sweep()
+
+    def sweep(self):
+        now = time.time()
+        for key in [k for k, entry in self._entries.items() if entry['expires_at'] <= now]:
+            del self._entries[key]
+            self.swept += 1
+
+    async def put(self, key: str, code_hash: str, ttl_seconds: int):
+        self._entries[key] = {
+            'hash': code_hash,
+            'expires_at': time.time() + ttl_seconds,
+            'attempts_left': OTP_MAX_ATTEMPTS,
+        }
+
+    async def consume(self, key: str, code_hash: str) -> bool:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if entry['expires_at'] <= time.time():
+            del self._entries[key]
+            return False
+        if hmac.compare_digest(entry['hash'], code_hash):
+            del self._entries[key]
+            return True
+        entry['attempts_left'] -= 1
+        if entry['attempts_left'] <= 0:
+            del self._entries[key]
+        return False
+
+    def size(self) -> int:
+        return len(self._entries)
+
+
+class MongoOTPBackend:
+    """
+    One document per key in `otp_codes`, reaped by a TTL index on expire_at.
+    A correct code is consumed with a single find_one_and_delete, so two workers
+    can never both accept the same code.
+    """
+
+    name = 'mongo'
+
+    def __init__(self, db):
+        self._db = db
+
+    async def ensure_indexes(self):
+        await self._db.otp_codes.create_index('key', unique=True)
+        await self._db.otp_codes.create_index('expire_at', expireAfterSeconds=0)
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def put(self, key: str, code_hash: str, ttl_seconds: int):
+        now = datetime.now(timezone.utc)
+        await self._db.otp_codes.update_one(
+            {'key': key},
+            {'$set': {
+                'hash': code_hash,
+                'attempts_left': OTP_MAX_ATTEMPTS,
+                'created_at': now,
+                'expire_at': now + timedelta(seconds=ttl_seconds),
+            }},
+            upsert=True
+        )
+
+    async def consume(self, key: str, code_hash: str) -> bool:
+        now = datetime.now(timezone.utc)
+        matched = await self._db.otp_codes.find_one_and_delete(
+            {'key': key, 'hash': code_hash, 'expire_at': {'$gt': now}}
+        )
+        if matched is not None:
+            return True
+
+        # Wrong code: burn an attempt and drop the code once they run out
+        entry = await self._db.otp_codes.find_one_and_update(
+            {'key': key},
+            {'$inc': {'attempts_left': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if entry is not None and entry.get('attempts_left', 0) <= 0:
+            await self._db.otp_codes.delete_one({'_id': entry['_id']})
+        return False
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+class OTPStore:
+    """Facade over the configured backend; callers only see put/verify"""
+
+    def __init__(self):
+        self._backend = MemoryOTPBackend()
+        self.stats_counters = {
+            'issued': 0,
+            'verified': 0,
+            'rejected': 0,
+        }
+
+    def configure(self, db):
+        if db is not None and OTP_STORE_BACKEND == 'mongo':
+            self._backend = MongoOTPBackend(db)
+        else:
+            self._backend = MemoryOTPBackend()
+        logger.info(f"✅ OTP store backend: {self._backend.name}")
+
+    async def ensure_indexes(self):
+        await self._backend.ensure_indexes()
+
+    def start(self):
+        self._backend.start()
+
+    async def stop(self):
+        await self._backend.stop()
+
+    async def put(self, key: str, code: str, ttl_seconds: int):
+        """Store code for key, replacing any earlier code"""
+        self.stats_counters['issued'] += 1
+        await self._backend.put(key, hash_code(key, code), ttl_seconds)
+
+    async def verify(self, key: str, code: str) -> bool:
+        """True once for the right unexpired code; a wrong code costs an attempt"""
+        valid = await self._backend.consume(key, hash_code(key, code))
+        self.stats_counters['verified' if valid else 'rejected'] += 1
+        return valid
+
+    def stats(self) -> dict:
+        return {
+            'backend': self._backend.name,
+            'entries': self._backend.size(),
+            'max_attempts': OTP_MAX_ATTEMPTS,
+            **self.stats_counters,
+        }
+
+
+otp_store = OTPStore()
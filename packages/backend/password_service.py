@@ -0,0 +1,134 @@
+"""
+Password Hashing Service for Pizoo Dating App
+bcrypt hashing/verification in a bounded thread pool, off the event loop
+"""
+
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+# Work factor for new hashes; hashes with any other cost are rehashed on next login
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+# bcrypt releases the GIL, so threads hash in parallel up to the core count
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Requests allowed to wait for a worker before we answer 503
+PASSWORD_HASH_MAX_QUEUE = int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '64'))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a dedicated thread pool. At most PASSWORD_HASH_WORKERS hashes
+    run at once; up to PASSWORD_HASH_MAX_QUEUE more wait their turn and anything
+    beyond that is rejected, so a login burst degrades into 503s instead of
+    freezing every other request on the worker.
+    """
+
+    def __init__(self):
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+        self._waiting = 0
+        self._in_flight = 0
+        self.stats_counters = {
+            'hashes': 0,
+            'verifications': 0,
+            'rehashes': 0,
+            'rejected': 0,
+        }
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._work_total = 0.0
+        self._completed = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS,
+                thread_name_prefix='password-hash'
+            )
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self._waiting >= PASSWORD_HASH_MAX_QUEUE:
+            self.stats_counters['rejected'] += 1
+            raise PasswordHasherBusy()
+
+        self._waiting += 1
+        queued_at = time.monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        started_at = time.monotonic()
+        wait = started_at - queued_at
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        self._in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+            self._work_total += time.monotonic() - started_at
+            self._completed += 1
+
+    async def hash(self, password: str) -> str:
+        self.stats_counters['hashes'] += 1
+        return await self._run(pwd_context.hash, password)
+
+    async def verify_and_update(self, password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+        """
+        Check a password; when it matches a hash with an outdated cost, also
+        return a fresh hash at BCRYPT_ROUNDS for the caller to store.
+        """
+        self.stats_counters['verifications'] += 1
+        try:
+            valid, new_hash = await self._run(pwd_context.verify_and_update, password, password_hash)
+        except ValueError:
+            # Not a recognizable hash
+            return False, None
+        if new_hash:
+            self.stats_counters['rehashes'] += 1
+        return valid, new_hash
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        completed = self._completed
+        return {
+            'workers': PASSWORD_HASH_WORKERS,
+            'bcrypt_rounds': BCRYPT_ROUNDS,
+            'in_flight': self._in_flight,
+            'queued': self._waiting,
+            'max_queue': PASSWORD_HASH_MAX_QUEUE,
+            'avg_queue_wait_ms': round(self._wait_total / completed * 1000, 2) if completed else None,
+            'max_queue_wait_ms': round(self._wait_max * 1000, 2),
+            'avg_hash_ms': round(self._work_total / completed * 1000, 2) if completed else None,
+            **self.stats_counters,
+        }
+
+
+password_hasher = PasswordHasher()
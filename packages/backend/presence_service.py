@@ -0,0 +1,185 @@
+"""
+Presence Service for Pizoo Dating App
+Bounded in-memory presence with write-behind last_seen persistence
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Offline entries are kept this long / up to this many users, then evicted (LRU)
+PRESENCE_MAX_ENTRIES = int(os.environ.get('PRESENCE_MAX_ENTRIES', '50000'))
+PRESENCE_TTL_SECONDS = float(os.environ.get('PRESENCE_TTL_SECONDS', '3600'))
+# Buffered last_seen values are written to `users` in one bulk_write this often
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '30'))
+PRESENCE_FLUSH_BATCH_SIZE = int(os.environ.get('PRESENCE_FLUSH_BATCH_SIZE', '1000'))
+
+
+def as_utc(value) -> Optional[datetime]:
+    """Normalize a stored last_seen/lastActive value (datetime or ISO string) to aware UTC"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        # Motor returns naive UTC datetimes by default
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class PresenceStore:
+    """
+    Online flag and last_seen per user, bounded by size and TTL.
+
+    Online users are never evicted (their sockets already bound them); offline
+    entries expire after PRESENCE_TTL_SECONDS or when the store is full. last_seen
+    changes are buffered and persisted to `users.last_seen` in periodic batches
+    instead of one write per connect/disconnect.
+    """
+
+    def __init__(self):
+        # user_id -> {'online': bool, 'last_seen': datetime, 'touched': monotonic}
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._dirty: Dict[str, datetime] = {}
+        self._db = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.stats_counters = {
+            'evictions': 0,
+            'flushes': 0,
+            'flushed_users': 0,
+            'flush_errors': 0,
+        }
+
+    def configure(self, db):
+        self._db = db
+
+    def start(self):
+        """Start the periodic flush loop (call from the app startup hook)"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        # Persist whatever is still buffered before the worker exits
+        await self.flush()
+
+    # ===== Updates =====
+
+    def mark_online(self, user_id: str):
+        self._set(user_id, True)
+
+    def mark_offline(self, user_id: str):
+        self._set(user_id, False)
+
+    def _set(self, user_id: str, online: bool):
+        now = datetime.now(timezone.utc)
+        self.entries[user_id] = {'online': online, 'last_seen': now, 'touched': time.monotonic()}
+        self.entries.move_to_end(user_id)
+        self._dirty[user_id] = now
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        # Entries are in touch order, so only the front needs checking
+        for user_id in list(self.entries):
+            entry = self.entries[user_id]
+            expired = now - entry['touched'] > PRESENCE_TTL_SECONDS
+            if not expired and len(self.entries) <= PRESENCE_MAX_ENTRIES:
+                break
+            if entry['online']:
+                # Keep live users; rotate them behind the offline ones
+                entry['touched'] = now
+                self.entries.move_to_end(user_id)
+                continue
+            del self.entries[user_id]
+            self.stats_counters['evictions'] += 1
+
+    # ===== Reads =====
+
+    def is_online(self, user_id: str) -> bool:
+        entry = self.entries.get(user_id)
+        return bool(entry and entry['online'])
+
+    def get_last_seen(self, user_id: str) -> Optional[datetime]:
+        """In-memory last_seen (None when unknown to this worker)"""
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry['online']:
+            return datetime.now(timezone.utc)
+        return entry['last_seen']
+
+    def last_seen_for(self, user_id: str, user_doc: Optional[dict] = None) -> Optional[datetime]:
+        """Best known last activity: live presence first, then the persisted fields"""
+        last_seen = self.get_last_seen(user_id)
+        if last_seen is not None or not user_doc:
+            return last_seen
+        return as_utc(user_doc.get('last_seen')) or as_utc(user_doc.get('lastActive'))
+
+    def get_status(self, user_id: str) -> dict:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return {'online': False, 'last_seen': None}
+        return {'online': entry['online'], 'last_seen': entry['last_seen'].isoformat()}
+
+    # ===== Write-behind =====
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def flush(self):
+        """Write buffered last_seen values to users in bulk_write batches"""
+        if self._db is None or not self._dirty:
+            return
+        async with self._flush_lock:
+            pending, self._dirty = self._dirty, {}
+            items = list(pending.items())
+            for start in range(0, len(items), PRESENCE_FLUSH_BATCH_SIZE):
+                batch = items[start:start + PRESENCE_FLUSH_BATCH_SIZE]
+                operations = [
+                    # $max keeps the newest value if another worker wrote later
+                    UpdateOne({'id': user_id}, {'$max': {'last_seen': seen}})
+                    for user_id, seen in batch
+                ]
+                try:
+                    await self._db.users.bulk_write(operations, ordered=False)
+                    self.stats_counters['flushes'] += 1
+                    self.stats_counters['flushed_users'] += len(batch)
+                except Exception as e:
+                    self.stats_counters['flush_errors'] += 1
+                    logger.error(f"❌ Failed to flush last_seen for {len(batch)} users: {e}")
+                    # Put the batch back unless a newer value arrived meanwhile
+                    for user_id, seen in batch:
+                        newer = self._dirty.get(user_id)
+                        if newer is None or seen > newer:
+                            self._dirty[user_id] = seen
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'online': sum(1 for e in self.entries.values() if e['online']),
+            'max_entries': PRESENCE_MAX_ENTRIES,
+            'pending_last_seen_writes': len(self._dirty),
+            **self.stats_counters,
+        }
+
+
+presence_store = PresenceStore()
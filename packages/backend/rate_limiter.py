@@ -0,0 +1,283 @@
+"""
+Rate Limiter for Pizoo Dating App
+Token-bucket and sliding-window limits with in-memory or shared Mongo state, declared per route
+"""
+
+import os
+import math
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from typing import Callable, NamedTuple, Optional
+
+from fastapi import Depends, HTTPException, Request, status
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# mongo (shared by all workers) | memory (single node)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'mongo')
+RATE_LIMIT_MEMORY_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MEMORY_MAX_KEYS', '100000'))
+
+TOKEN_BUCKET = 'token_bucket'
+SLIDING_WINDOW = 'sliding_window'
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    remaining: int
+    retry_after: float  # seconds until the next call would be allowed (0 when allowed)
+
+
+def _sliding_window_state(now: float, period: float):
+    """Start of the current fixed window and how much of the previous one still overlaps"""
+    window_start = math.floor(now / period) * period
+    previous_weight = 1 - (now - window_start) / period
+    return window_start, previous_weight
+
+
+class MemoryRateLimitBackend:
+    """Per-process state in an LRU dict; checks are a few dict operations"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._state: "OrderedDict[str, dict]" = OrderedDict()
+
+    async def ensure_indexes(self):
+        pass
+
+    def _get(self, key: str) -> dict:
+        state = self._state.get(key)
+        if state is None:
+            state = self._state[key] = {}
+            while len(self._state) > RATE_LIMIT_MEMORY_MAX_KEYS:
+                self._state.popitem(last=False)
+        else:
+            self._state.move_to_end(key)
+        return state
+
+    async def token_bucket(self, key: str, capacity: int, rate: float, now: float) -> RateLimitResult:
+        state = self._get(key)
+        tokens = min(capacity, state.get('tokens', capacity) + (now - state.get('updated', now)) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        state['tokens'] = tokens
+        state['updated'] = now
+        return RateLimitResult(allowed, int(tokens), 0 if allowed else (1 - tokens) / rate)
+
+    async def sliding_window(self, key: str, limit: int, period: float, now: float) -> RateLimitResult:
+        state = self._get(key)
+        window_start, previous_weight = _sliding_window_state(now, period)
+        if state.get('window_start') != window_start:
+            previous = state.get('count', 0) if state.get('window_start') == window_start - period else 0
+            state.update(window_start=window_start, previous=previous, count=0)
+        estimate = state['previous'] * previous_weight + state['count']
+        allowed = estimate < limit
+        if allowed:
+            state['count'] += 1
+            estimate += 1
+        return RateLimitResult(allowed, max(int(limit - estimate), 0), 0 if allowed else window_start + period - now)
+
+
+class MongoRateLimitBackend:
+    """
+    One `rate_limit_counters` document per key, read-modify-written by a single
+    find_one_and_update with an update pipeline, so concurrent workers can't
+    race and each check is exactly one round trip. Idle keys expire by TTL.
+    Two workers creating the same key at once race on the unique index; the
+    loser retries once and updates the winner's document.
+    """
+
+    name = 'mongo'
+
+    def __init__(self, db):
+        self._db = db
+
+    async def ensure_indexes(self):
+        await self._db.rate_limit_counters.create_index('key', unique=True)
+        await self._db.rate_limit_counters.create_index('expire_at', expireAfterSeconds=0)
+
+    @staticmethod
+    def _expire_at(now: float, seconds: float) -> datetime:
+        return datetime.fromtimestamp(now, tz=timezone.utc) + timedelta(seconds=seconds)
+
+    async def _update(self, key: str, pipeline: list) -> dict:
+        """Apply pipeline to the key's document (created if missing) and return the result"""
+        for attempt in range(2):
+            try:
+                return await self._db.rate_limit_counters.find_one_and_update(
+                    {'key': key},
+                    pipeline,
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # Another worker inserted the key first; the retry matches its document
+                if attempt:
+                    raise
+
+    async def token_bucket(self, key: str, capacity: int, rate: float, now: float) -> RateLimitResult:
+        refilled = {'$min': [capacity, {'$add': [
+            {'$ifNull': ['$tokens', capacity]},
+            {'$multiply': [{'$subtract': [now, {'$ifNull': ['$updated', now]}]}, rate]},
+        ]}]}
+        doc = await self._update(
+            key,
+            [
+                {'$set': {'tokens': refilled, 'updated': now}},
+                {'$set': {'allowed': {'$gte': ['$tokens', 1]}}},
+                {'$set': {
+                    'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', 1]}, '$tokens']},
+                    'expire_at': self._expire_at(now, capacity / rate),
+                }},
+            ]
+        )
+        tokens = doc['tokens']
+        allowed = doc['allowed']
+        return RateLimitResult(allowed, int(tokens), 0 if allowed else (1 - tokens) / rate)
+
+    async def sliding_window(self, key: str, limit: int, period: float, now: float) -> RateLimitResult:
+        window_start, previous_weight = _sliding_window_state(now, period)
+        same_window = {'$eq': ['$window_start', window_start]}
+        doc = await self._update(
+            key,
+            [
+                # Roll the window forward (fields in one $set all see the old values)
+                {'$set': {
+                    'previous': {'$cond': [
+                        same_window,
+                        {'$ifNull': ['$previous', 0]},
+                        {'$cond': [
+                            {'$eq': ['$window_start', window_start - period]},
+                            {'$ifNull': ['$count', 0]},
+                            0
+                        ]}
+                    ]},
+                    'count': {'$cond': [same_window, {'$ifNull': ['$count', 0]}, 0]},
+                    'window_start': window_start,
+                }},
+                {'$set': {'allowed': {'$lt': [
+                    {'$add': [{'$multiply': ['$previous', previous_weight]}, '$count']},
+                    limit
+                ]}}},
+                {'$set': {
+                    'count': {'$cond': ['$allowed', {'$add': ['$count', 1]}, '$count']},
+                    'expire_at': self._expire_at(window_start, 2 * period),
+                }},
+            ]
+        )
+        estimate = doc['previous'] * previous_weight + doc['count']
+        allowed = doc['allowed']
+        return RateLimitResult(allowed, max(int(limit - estimate), 0), 0 if allowed else window_start + period - now)
+
+
+class RateLimitStore:
+    """Holds the configured backend shared by every RateLimiter"""
+
+    def __init__(self):
+        self.backend = MemoryRateLimitBackend()
+        self.stats_counters = {
+            'checks': 0,
+            'limited': 0,
+            'errors': 0,
+        }
+
+    def configure(self, db):
+        if db is not None and RATE_LIMIT_BACKEND == 'mongo':
+            self.backend = MongoRateLimitBackend(db)
+        else:
+            self.backend = MemoryRateLimitBackend()
+
+    async def ensure_indexes(self):
+        await self.backend.ensure_indexes()
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.backend.name,
+            **self.stats_counters,
+        }
+
+
+rate_limit_store = RateLimitStore()
+
+
+class RateLimiter:
+    """
+    A named limit of `limit` calls per `period_seconds` per key.
+
+    token_bucket allows bursts up to `limit` and refills continuously;
+    sliding_window approximates a rolling window from the current and
+    previous fixed-window counts. Declare it on a route with dependency();
+    hit()/enforce() are for keys only known part way through a handler.
+    """
+
+    def __init__(self, name: str, limit: int, period_seconds: float, algorithm: str = SLIDING_WINDOW,
+                 detail: Optional[str] = None):
+        if algorithm not in (TOKEN_BUCKET, SLIDING_WINDOW):
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+        self.name = name
+        self.limit = limit
+        self.period_seconds = period_seconds
+        self.algorithm = algorithm
+        self.detail = detail
+
+    async def hit(self, key: str) -> RateLimitResult:
+        """Count one call for key and say whether it is allowed"""
+        store = rate_limit_store
+        store.stats_counters['checks'] += 1
+        scoped_key = f"{self.name}:{key}"
+        now = time.time()
+        try:
+            if self.algorithm == TOKEN_BUCKET:
+                result = await store.backend.token_bucket(scoped_key, self.limit, self.limit / self.period_seconds, now)
+            else:
+                result = await store.backend.sliding_window(scoped_key, self.limit, self.period_seconds, now)
+        except Exception as e:
+            # Fail open: a limiter outage must not take the endpoint down with it
+            store.stats_counters['errors'] += 1
+            logger.error(f"❌ Rate limit check {self.name} failed: {e}")
+            return RateLimitResult(True, self.limit, 0)
+        if not result.allowed:
+            store.stats_counters['limited'] += 1
+        return result
+
+    async def enforce(self, key: str, detail: Optional[str] = None) -> RateLimitResult:
+        """hit(), raising 429 with Retry-After when the limit is exceeded"""
+        result = await self.hit(key)
+        if not result.allowed:
+            retry_after = max(math.ceil(result.retry_after), 1)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=(detail or self.detail or "Rate limit exceeded. Try again in {minutes} minutes.").format(
+                    limit=self.limit,
+                    seconds=retry_after,
+                    minutes=math.ceil(retry_after / 60)
+                ),
+                headers={"Retry-After": str(retry_after)}
+            )
+        return result
+
+    def dependency(self, key: Callable = None):
+        """
+        FastAPI dependency enforcing this limit. `key` is itself a dependency
+        returning the key (client IP by default), e.g. one that returns the
+        current user's id or a validated field of the request body. Chain it
+        after checks that should reject a request before it counts.
+        """
+        key = key or client_ip
+
+        async def check_rate_limit(key_value: str = Depends(key)) -> RateLimitResult:
+            return await self.enforce(key_value)
+
+        return check_rate_limit
+
+
+def client_ip(request: Request) -> str:
+    forwarded = request.headers.get('x-forwarded-for')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.client.host if request.client else 'unknown'
@@ -0,0 +1,527 @@
+"""
+Real-time Service for Pizoo Dating App
+WebSocket connection management and match-scoped presence
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set
+
+from fastapi import WebSocket
+
+from presence_service import presence_store
+from ws_codec import JSON_CODEC, WS_BATCH_MAX_FRAMES, JsonCodec, receive_frame, send_frame
+
+logger = logging.getLogger(__name__)
+
+# Presence changes for the same user inside this window are merged into one frame
+PRESENCE_COALESCE_SECONDS = float(os.environ.get('PRESENCE_COALESCE_SECONDS', '0.5'))
+
+# Outbound queue per connection; a slow client only ever fills its own queue
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '256'))
+WS_OVERFLOW_POLICY = os.environ.get('WS_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest | close
+WS_HEARTBEAT_INTERVAL = float(os.environ.get('WS_HEARTBEAT_INTERVAL', '25'))
+# Only applies to connections that answer pings (?heartbeat=true)
+WS_IDLE_TIMEOUT = float(os.environ.get('WS_IDLE_TIMEOUT', '75'))
+# Concurrent devices per user; the least recently connected one is closed beyond this
+WS_MAX_DEVICES_PER_USER = int(os.environ.get('WS_MAX_DEVICES_PER_USER', '5'))
+
+# Typing indicators: stop is sent after this much silence; starts are capped per connection
+TYPING_IDLE_SECONDS = float(os.environ.get('TYPING_IDLE_SECONDS', '3'))
+TYPING_MAX_FPS = float(os.environ.get('TYPING_MAX_FPS', '2'))
+
+# Close codes
+WS_CLOSE_GOING_AWAY = 1001
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class ClientConnection:
+    """One WebSocket plus its bounded outbound queue, writer task and wire codec"""
+
+    def __init__(self, user_id: str, device_id: str, websocket: WebSocket, stats: dict, codec: JsonCodec = JSON_CODEC,
+                 acks: bool = False, heartbeat: bool = False):
+        self.user_id = user_id
+        self.device_id = device_id
+        self.websocket = websocket
+        self.codec = codec
+        # True when the client acks message ids; otherwise a frame it was sent counts as delivered
+        self.acks = acks
+        # True when the client answers pings; only then does inbound silence mean it is gone
+        self.heartbeat = heartbeat
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.last_activity = time.monotonic()
+        self.closed = False
+        # Typing start frames emitted in the current one-second window
+        self.typing_window_start = 0.0
+        self.typing_window_count = 0
+        self._stats = stats
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def touch(self):
+        """Record inbound activity (any frame counts as a heartbeat)"""
+        self.last_activity = time.monotonic()
+
+    def enqueue(self, message: dict) -> bool:
+        """
+        Queue a frame without waiting on the socket.
+        Returns False when the frame could not be queued.
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if WS_OVERFLOW_POLICY == 'close':
+            self._stats['overflow_closes'] += 1
+            logger.warning(f"WebSocket send queue full for user {self.user_id} ({self.device_id}), closing connection")
+            asyncio.create_task(self.close(WS_CLOSE_TRY_AGAIN_LATER))
+            return False
+
+        # drop_oldest: keep the freshest state, lose the stalest frame
+        try:
+            self.queue.get_nowait()
+            self._stats['frames_dropped'] += 1
+        except asyncio.QueueEmpty:
+            pass
+        self.queue.put_nowait(message)
+        return True
+
+    async def _writer(self):
+        try:
+            while True:
+                frames = [await self.queue.get()]
+                if self.codec.batch:
+                    # Whatever piled up while we were waiting goes out as one frame
+                    while len(frames) < WS_BATCH_MAX_FRAMES and not self.queue.empty():
+                        frames.append(self.queue.get_nowait())
+                sent = await send_frame(self.websocket, self.codec, frames)
+                self._stats['frames_sent'] += len(frames)
+                self._stats['bytes_sent'] += sent
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._stats['send_errors'] += 1
+            logger.info(f"WebSocket writer stopped for user {self.user_id} ({self.device_id}): {e}")
+            self.closed = True
+
+    async def receive(self) -> dict:
+        """Read and decode the next client frame (raises WebSocketDisconnect)"""
+        return await receive_frame(self.websocket, self.codec)
+
+    def cancel(self):
+        """Stop the writer task; queued frames are discarded"""
+        self.closed = True
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+
+    async def close(self, code: int = 1000):
+        self.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    """
+    Tracks connected WebSockets and fans presence out to subscribers only.
+
+    A user subscribes to the presence of their matches when they connect, so an
+    online/offline change is delivered to the handful of people who can see it
+    instead of every connected socket. Every connection gets its own bounded
+    send queue, so one slow client cannot stall delivery for anyone else.
+
+    A user may be connected from several devices at once; frames fan out to all
+    of them and the user only goes offline when the last device disconnects.
+    """
+
+    def __init__(self):
+        # user_id -> device_id -> connection (insertion order = oldest device first)
+        self.active_connections: Dict[str, Dict[str, ClientConnection]] = {}
+        # Online flag and last_seen live in the bounded presence store
+        self.presence = presence_store
+        # target user_id -> user_ids watching that target
+        self.presence_subscribers: Dict[str, Set[str]] = {}
+        # watcher user_id -> target user_ids (used to clean up on disconnect)
+        self.presence_subscriptions: Dict[str, Set[str]] = {}
+        # Pending coalesced status per user and the last state actually sent
+        self._pending_status: Dict[str, bool] = {}
+        self._last_broadcast: Dict[str, bool] = {}
+        self._status_tasks: Dict[str, asyncio.Task] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.stats_counters = {
+            'frames_sent': 0,
+            'bytes_sent': 0,
+            'frames_dropped': 0,
+            'overflow_closes': 0,
+            'send_errors': 0,
+            'idle_evictions': 0,
+            'device_evictions': 0,
+        }
+
+    def start(self):
+        """Start the heartbeat loop (call from the app startup hook)"""
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        for connection in self._all_connections():
+            await connection.close(WS_CLOSE_GOING_AWAY)
+        for user_id in self.active_connections:
+            self.presence.mark_offline(user_id)
+        self.active_connections.clear()
+
+    def _all_connections(self) -> List[ClientConnection]:
+        return [c for devices in self.active_connections.values() for c in devices.values()]
+
+    def get_connections(self, user_id: str) -> List[ClientConnection]:
+        return list(self.active_connections.get(user_id, {}).values())
+
+    async def connect(
+        self,
+        user_id: str,
+        websocket: WebSocket,
+        match_user_ids: Iterable[str] = (),
+        device_id: Optional[str] = None,
+        codec: JsonCodec = JSON_CODEC,
+        acks: bool = False,
+        heartbeat: bool = False
+    ) -> ClientConnection:
+        await websocket.accept(subprotocol=codec.subprotocol)
+        device_id = device_id or str(uuid.uuid4())
+        connection = ClientConnection(user_id, device_id, websocket, self.stats_counters, codec,
+                                      acks=acks, heartbeat=heartbeat)
+        connection.start()
+
+        devices = self.active_connections.setdefault(user_id, {})
+        was_online = bool(devices)
+        # Same device reconnecting replaces its old socket; a new device goes to the back
+        previous = devices.pop(device_id, None)
+        devices[device_id] = connection
+        stale = [previous] if previous is not None else []
+        while len(devices) > WS_MAX_DEVICES_PER_USER:
+            oldest_id = next(iter(devices))
+            stale.append(devices.pop(oldest_id))
+            self.stats_counters['device_evictions'] += 1
+        for old in stale:
+            await old.close(WS_CLOSE_GOING_AWAY)
+
+        self.presence.mark_online(user_id)
+        if was_online:
+            # Presence is per user; only the new device needs a snapshot
+            self._add_subscriptions(user_id, match_user_ids)
+            await self._send_presence_snapshot(connection, self.presence_subscriptions.get(user_id, set()))
+        else:
+            await self.subscribe_presence(user_id, match_user_ids)
+            # Broadcast user online status to the people watching this user
+            await self.broadcast_status(user_id, True)
+        return connection
+
+    def disconnect(self, user_id: str, connection: Optional[ClientConnection] = None) -> bool:
+        """
+        Forget a connection of user_id. When `connection` is given, only that exact
+        connection is removed, so a stale socket cannot unregister its replacement;
+        without it every device of the user is dropped.
+        Returns True if the user went offline (no devices left).
+        """
+        devices = self.active_connections.get(user_id)
+        if not devices:
+            return False
+
+        if connection is None:
+            removed = list(devices.values())
+            devices.clear()
+        elif devices.get(connection.device_id) is connection:
+            removed = [devices.pop(connection.device_id)]
+        else:
+            return False
+        for current in removed:
+            current.cancel()
+
+        if devices:
+            return False
+
+        del self.active_connections[user_id]
+        self.presence.mark_offline(user_id)
+        self.unsubscribe_presence(user_id)
+        return True
+
+    async def send_personal_message(self, message: dict, user_id: str) -> bool:
+        """
+        Queue a frame on every device of user_id; never waits on a socket.
+        Returns True if at least one device accepted it.
+        """
+        delivered = False
+        for connection in self.get_connections(user_id):
+            if connection.closed:
+                if self.disconnect(user_id, connection):
+                    await self.broadcast_status(user_id, False)
+                continue
+            delivered = connection.enqueue(message) or delivered
+        return delivered
+
+    # ===== Heartbeats =====
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            try:
+                await self._heartbeat()
+            except Exception as e:
+                logger.error(f"WebSocket heartbeat error: {e}")
+
+    async def _heartbeat(self):
+        """
+        Ping every connection. A failed write marks a connection closed and it is
+        evicted here; inbound silence only evicts clients that opted into
+        answering pings, since older clients ignore them and may stay quiet.
+        """
+        now = time.monotonic()
+        ping = {'type': 'ping', 'timestamp': datetime.now(timezone.utc).isoformat()}
+        for connection in self._all_connections():
+            idle = connection.heartbeat and now - connection.last_activity > WS_IDLE_TIMEOUT
+            if connection.closed or idle:
+                self.stats_counters['idle_evictions'] += 1
+                await self.evict(connection.user_id, connection)
+            else:
+                connection.enqueue(ping)
+
+    async def evict(self, user_id: str, connection: ClientConnection, code: int = WS_CLOSE_GOING_AWAY):
+        """Drop a dead or idle connection and tell watchers the user left"""
+        went_offline = self.disconnect(user_id, connection)
+        await connection.close(code)
+        if went_offline:
+            await self.broadcast_status(user_id, False)
+
+    def stats(self) -> dict:
+        connections = self._all_connections()
+        depths = [c.queue.qsize() for c in connections]
+        encodings: Dict[str, int] = {}
+        for c in connections:
+            encodings[c.codec.name] = encodings.get(c.codec.name, 0) + 1
+        return {
+            'users': len(self.active_connections),
+            'connections': len(connections),
+            'encodings': encodings,
+            'max_devices_per_user': WS_MAX_DEVICES_PER_USER,
+            'queue_depth_total': sum(depths),
+            'queue_depth_max': max(depths, default=0),
+            'queue_capacity': WS_SEND_QUEUE_SIZE,
+            'overflow_policy': WS_OVERFLOW_POLICY,
+            'presence_watched_users': len(self.presence_subscribers),
+            **self.stats_counters,
+        }
+
+    # ===== Presence subscriptions =====
+
+    async def subscribe_presence(self, user_id: str, target_user_ids: Iterable[str]):
+        """Subscribe user_id to the presence of target_user_ids and send a snapshot"""
+        targets = self._add_subscriptions(user_id, target_user_ids)
+        if not targets:
+            return
+        for connection in self.get_connections(user_id):
+            await self._send_presence_snapshot(connection, targets)
+
+    def _add_subscriptions(self, user_id: str, target_user_ids: Iterable[str]) -> Set[str]:
+        """Record subscriptions and return the targets that are new for user_id"""
+        existing = self.presence_subscriptions.setdefault(user_id, set())
+        targets = {t for t in target_user_ids if t and t != user_id and t not in existing}
+        existing.update(targets)
+        for target in targets:
+            self.presence_subscribers.setdefault(target, set()).add(user_id)
+        if not existing:
+            del self.presence_subscriptions[user_id]
+        return targets
+
+    async def _send_presence_snapshot(self, connection: ClientConnection, targets: Iterable[str]):
+        targets = list(targets)
+        if not targets:
+            return
+        connection.enqueue({
+            'type': 'presence_snapshot',
+            'users': {target: self.is_user_online(target) for target in targets},
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        })
+
+    def unsubscribe_presence(self, user_id: str):
+        """Drop every subscription held by user_id"""
+        for target in self.presence_subscriptions.pop(user_id, set()):
+            watchers = self.presence_subscribers.get(target)
+            if watchers is None:
+                continue
+            watchers.discard(user_id)
+            if not watchers:
+                del self.presence_subscribers[target]
+
+    async def link_presence(self, user_a: str, user_b: str):
+        """Make two freshly matched users watch each other if they are connected"""
+        if self.is_user_online(user_a):
+            await self.subscribe_presence(user_a, [user_b])
+        if self.is_user_online(user_b):
+            await self.subscribe_presence(user_b, [user_a])
+
+    async def broadcast_status(self, user_id: str, online: bool):
+        """
+        Queue a presence change for user_id.
+        Rapid connect/disconnect flaps inside PRESENCE_COALESCE_SECONDS collapse
+        into a single frame carrying the final state.
+        """
+        self._pending_status[user_id] = online
+        task = self._status_tasks.get(user_id)
+        if task is None or task.done():
+            self._status_tasks[user_id] = asyncio.create_task(self._flush_status(user_id))
+
+    async def _flush_status(self, user_id: str):
+        try:
+            await asyncio.sleep(PRESENCE_COALESCE_SECONDS)
+        finally:
+            self._status_tasks.pop(user_id, None)
+
+        online = self._pending_status.pop(user_id, None)
+        if online is None or self._last_broadcast.get(user_id) == online:
+            return
+        if online:
+            self._last_broadcast[user_id] = True
+        else:
+            # Nobody needs the "last sent" marker for offline users
+            self._last_broadcast.pop(user_id, None)
+
+        watchers = [w for w in self.presence_subscribers.get(user_id, ()) if w in self.active_connections]
+        if not watchers:
+            return
+
+        status_message = {
+            'type': 'user_status',
+            'user_id': user_id,
+            'online': online,
+            'timestamp': datetime.now(timezone.utc).isoformat()
+        }
+        await asyncio.gather(
+            *(self.send_personal_message(status_message, watcher) for watcher in watchers),
+            return_exceptions=True
+        )
+
+    def is_user_online(self, user_id: str) -> bool:
+        return user_id in self.active_connections
+
+    def get_user_status(self, user_id: str) -> dict:
+        return self.presence.get_status(user_id)
+
+
+class TypingCoalescer:
+    """
+    Collapses keystroke-level `typing` events into state changes per (sender, receiver).
+
+    The receiver gets one start frame when typing begins and one stop frame when the
+    sender says so or goes quiet for TYPING_IDLE_SECONDS. Start frames are further
+    capped at TYPING_MAX_FPS per sending connection; stops are never dropped, so an
+    indicator cannot get stuck on.
+    """
+
+    def __init__(self, connection_manager: ConnectionManager):
+        self.manager = connection_manager
+        # (sender_id, receiver_id) -> monotonic deadline for the stop frame
+        self._deadlines: Dict[tuple, float] = {}
+        self._timers: Dict[tuple, asyncio.Task] = {}
+        self.stats_counters = {
+            'typing_events': 0,
+            'typing_frames_sent': 0,
+            'typing_suppressed': 0,
+        }
+
+    async def handle(self, connection: ClientConnection, receiver_id: Optional[str], is_typing: bool):
+        if not receiver_id:
+            return
+        self.stats_counters['typing_events'] += 1
+        key = (connection.user_id, receiver_id)
+
+        if not is_typing:
+            if key in self._deadlines:
+                await self._stop(key)
+            else:
+                self.stats_counters['typing_suppressed'] += 1
+            return
+
+        now = time.monotonic()
+        if key in self._deadlines:
+            # Already shown as typing; just push the stop further out
+            self._deadlines[key] = now + TYPING_IDLE_SECONDS
+            self.stats_counters['typing_suppressed'] += 1
+            return
+
+        if not self._allow_start(connection, now):
+            self.stats_counters['typing_suppressed'] += 1
+            return
+
+        self._deadlines[key] = now + TYPING_IDLE_SECONDS
+        self._timers[key] = asyncio.create_task(self._expire(key))
+        await self._emit(key, True)
+
+    def _allow_start(self, connection: ClientConnection, now: float) -> bool:
+        if now - connection.typing_window_start >= 1.0:
+            connection.typing_window_start = now
+            connection.typing_window_count = 0
+        if connection.typing_window_count >= TYPING_MAX_FPS:
+            return False
+        connection.typing_window_count += 1
+        return True
+
+    async def _expire(self, key: tuple):
+        try:
+            while True:
+                deadline = self._deadlines.get(key)
+                if deadline is None:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+        except asyncio.CancelledError:
+            return
+        self._timers.pop(key, None)
+        await self._stop(key)
+
+    async def _stop(self, key: tuple):
+        self._deadlines.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        await self._emit(key, False)
+
+    async def _emit(self, key: tuple, is_typing: bool):
+        sender_id, receiver_id = key
+        self.stats_counters['typing_frames_sent'] += 1
+        await self.manager.send_personal_message({
+            'type': 'typing',
+            'user_id': sender_id,
+            'is_typing': is_typing
+        }, receiver_id)
+
+    async def clear_sender(self, sender_id: str):
+        """Send stop frames for everything sender_id was typing to (on disconnect)"""
+        for key in [k for k in self._deadlines if k[0] == sender_id]:
+            await self._stop(key)
+
+    def stats(self) -> dict:
+        return {
+            'typing_active_pairs': len(self._deadlines),
+            **self.stats_counters,
+        }
+
+
+manager = ConnectionManager()
+typing_coalescer = TypingCoalescer(manager)
@@ -0,0 +1,416 @@
+"""
+Message Retention Service for Pizoo Dating App
+Archive compaction of old messages in inactive matches and TTL expiry of dead conversations
+"""
+
+import os
+import json
+import zlib
+import socket
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import Binary
+
+from job_leases import job_leases
+from search_service import search_tokens
+
+logger = logging.getLogger(__name__)
+
+# Messages older than this are archived once their match has gone quiet
+MESSAGE_HOT_DAYS = int(os.environ.get('MESSAGE_HOT_DAYS', '90'))
+MATCH_INACTIVE_DAYS = int(os.environ.get('MATCH_INACTIVE_DAYS', '30'))
+ARCHIVE_BLOCK_SIZE = int(os.environ.get('ARCHIVE_BLOCK_SIZE', '500'))
+# Messages and archives of blocked/unmatched conversations expire after this many days
+UNMATCHED_RETENTION_DAYS = int(os.environ.get('UNMATCHED_RETENTION_DAYS', '30'))
+RETENTION_INTERVAL_HOURS = float(os.environ.get('RETENTION_INTERVAL_HOURS', '6'))
+RETENTION_MATCH_BATCH = int(os.environ.get('RETENTION_MATCH_BATCH', '200'))
+# Largest `limit` a client may ask message_window for
+MESSAGE_PAGE_MAX = int(os.environ.get('MESSAGE_PAGE_MAX', '200'))
+
+ARCHIVE_FORMAT = 'zlib-json-v1'
+LEASE_NAME = 'message_retention'
+
+
+def _pack(messages: List[dict]) -> Binary:
+    return Binary(zlib.compress(json.dumps(messages, separators=(',', ':'), default=str).encode('utf-8'), 6))
+
+
+def _unpack(block: dict) -> List[dict]:
+    return json.loads(zlib.decompress(block['data']).decode('utf-8'))
+
+
+def _message_tokens(message: dict) -> set:
+    # Same messages the hot text index covers (search_text is only set for text)
+    if message.get('message_type', 'text') != 'text':
+        return set()
+    return search_tokens(message.get('content'))
+
+
+def _block_summary(messages: List[dict]) -> dict:
+    """Fields stored next to the packed data so blocks can be queried without unpacking"""
+    participants = {m[key] for m in messages for key in ('sender_id', 'receiver_id') if m.get(key)}
+    unread = Counter(m['receiver_id'] for m in messages if m.get('receiver_id') and m.get('status') != 'read')
+    last = messages[-1]
+    return {
+        'participants': sorted(participants),
+        # Union of the messages' search tokens, so search can skip blocks without a hit
+        'search_tokens': sorted(set().union(*(_message_tokens(m) for m in messages))),
+        # receiver_id -> archived messages they have not read
+        'unread': dict(unread),
+        'last_message': {
+            'content': last.get('content'),
+            'created_at': last.get('created_at'),
+            'sender_id': last.get('sender_id'),
+        },
+    }
+
+
+class RetentionService:
+    """
+    Keeps `messages` limited to the hot part of each conversation.
+
+    A periodic job (one worker at a time, via a lease in `job_leases`) looks at
+    matches whose newest message is older than MATCH_INACTIVE_DAYS and moves
+    their messages older than MESSAGE_HOT_DAYS into `message_archives` as
+    zlib-compressed blocks of ARCHIVE_BLOCK_SIZE messages. Reading history
+    transparently falls back to the archive when a user pages that far back.
+    Each block also keeps its participants, per-receiver unread counts, last
+    message and search tokens uncompressed, for account purges, the
+    conversation list and message search.
+    Dead conversations get an `expire_at` and are removed by TTL indexes.
+    """
+
+    def __init__(self):
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        self._owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.stats_counters = {
+            'runs': 0,
+            'matches_compacted': 0,
+            'messages_archived': 0,
+            'blocks_written': 0,
+            'archive_reads': 0,
+            'archive_searches': 0,
+        }
+
+    def configure(self, db):
+        self._db = db
+
+    async def ensure_indexes(self):
+        if self._db is None:
+            return
+        await self._db.message_archives.create_index([('match_id', 1), ('last_created_at', -1)])
+        await self._db.message_archives.create_index('participants')
+        await self._db.message_archives.create_index([('match_id', 1), ('search_tokens', 1)])
+        await self._db.message_archives.create_index('expire_at', expireAfterSeconds=0)
+        await self._db.messages.create_index('expire_at', expireAfterSeconds=0)
+
+    def start(self):
+        if self._task is None and self._db is not None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # ===== Compaction =====
+
+    async def _loop(self):
+        while True:
+            try:
+                if await self._acquire_lease():
+                    await self.run_once()
+            except Exception as e:
+                logger.error(f"❌ Message retention run failed: {e}")
+            await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+    async def _acquire_lease(self) -> bool:
+        """Only one worker compacts per interval"""
+        return await job_leases.acquire(LEASE_NAME, self._owner, RETENTION_INTERVAL_HOURS * 3600)
+
+    async def run_once(self):
+        """Archive cold history of every inactive match"""
+        now = datetime.now(timezone.utc)
+        hot_cutoff = (now - timedelta(days=MESSAGE_HOT_DAYS)).isoformat()
+        inactive_cutoff = (now - timedelta(days=MATCH_INACTIVE_DAYS)).isoformat()
+        self.stats_counters['runs'] += 1
+        await self.backfill_block_summaries()
+
+        last_id = ''
+        while True:
+            matches = await self._db.matches.find(
+                {'id': {'$gt': last_id}},
+                {'_id': 0, 'id': 1}
+            ).sort('id', 1).limit(RETENTION_MATCH_BATCH).to_list(length=None)
+            if not matches:
+                break
+            last_id = matches[-1]['id']
+            for match in matches:
+                newest = await self._db.messages.find_one(
+                    {'match_id': match['id']},
+                    {'_id': 0, 'created_at': 1},
+                    sort=[('created_at', -1)]
+                )
+                if newest and newest['created_at'] < inactive_cutoff:
+                    await self.compact_match(match['id'], hot_cutoff)
+
+    async def compact_match(self, match_id: str, before: str) -> int:
+        """Move messages of match_id created before `before` into archive blocks"""
+        archived = 0
+        while True:
+            batch = await self._db.messages.find(
+                {'match_id': match_id, 'created_at': {'$lt': before}},
+                {'_id': 0, 'search_text': 0, 'updated_at': 0}
+            ).sort('created_at', 1).limit(ARCHIVE_BLOCK_SIZE).to_list(length=None)
+            if not batch:
+                break
+
+            first, last = batch[0], batch[-1]
+            # Deterministic block id: a crash between insert and delete re-writes the same block
+            await self._db.message_archives.replace_one(
+                {'_id': f"{match_id}:{first['created_at']}:{first['id']}"},
+                {
+                    'match_id': match_id,
+                    'first_created_at': first['created_at'],
+                    'last_created_at': last['created_at'],
+                    'count': len(batch),
+                    'format': ARCHIVE_FORMAT,
+                    'data': _pack(batch),
+                    **_block_summary(batch),
+                    'created_at': datetime.now(timezone.utc)
+                },
+                upsert=True
+            )
+            await self._db.messages.delete_many({
+                'match_id': match_id,
+                'id': {'$in': [m['id'] for m in batch]}
+            })
+            archived += len(batch)
+            self.stats_counters['blocks_written'] += 1
+            if len(batch) < ARCHIVE_BLOCK_SIZE:
+                break
+
+        if archived:
+            self.stats_counters['matches_compacted'] += 1
+            self.stats_counters['messages_archived'] += archived
+            logger.info(f"🗄️ Archived {archived} messages of match {match_id}")
+        return archived
+
+    async def backfill_block_summaries(self) -> int:
+        """Add the summary fields to blocks archived before they were stored"""
+        updated = 0
+        async for block in self._db.message_archives.find({'$or': [
+            {'participants': {'$exists': False}},
+            {'search_tokens': {'$exists': False}},
+        ]}):
+            await self._db.message_archives.update_one(
+                {'_id': block['_id']},
+                {'$set': _block_summary(_unpack(block))}
+            )
+            updated += 1
+        return updated
+
+    # ===== Expiry =====
+
+    async def expire_conversations(self, match_ids: Iterable[str], days: int = UNMATCHED_RETENTION_DAYS):
+        """Schedule messages and archives of these matches for TTL removal"""
+        match_ids = list(match_ids)
+        if self._db is None or not match_ids:
+            return
+        expire_at = datetime.now(timezone.utc) + timedelta(days=days)
+        await self._db.messages.update_many(
+            {'match_id': {'$in': match_ids}},
+            {'$set': {'expire_at': expire_at}}
+        )
+        await self._db.message_archives.update_many(
+            {'match_id': {'$in': match_ids}},
+            {'$set': {'expire_at': expire_at}}
+        )
+
+    async def purge_user(self, user_id: str, match_ids: Iterable[str] = ()):
+        """
+        Delete every message user_id sent or received and every archive block
+        they appear in, whether or not the match still exists.
+        """
+        if self._db is None:
+            return
+        await self._db.messages.delete_many({'$or': [{'sender_id': user_id}, {'receiver_id': user_id}]})
+        match_ids = list(match_ids)
+        archive_query = {'participants': user_id}
+        if match_ids:
+            archive_query = {'$or': [archive_query, {'match_id': {'$in': match_ids}}]}
+        await self._db.message_archives.delete_many(archive_query)
+
+    # ===== Reads =====
+
+    async def archived_summaries(self, match_ids: Iterable[str], user_id: str) -> Dict[str, dict]:
+        """
+        Per match: {'unread': archived messages user_id has not read, 'last_message':
+        newest archived message}. One query over the block summaries, no unpacking.
+        """
+        match_ids = list(match_ids)
+        if self._db is None or not match_ids:
+            return {}
+        summaries: Dict[str, dict] = {}
+        cursor = self._db.message_archives.find(
+            {'match_id': {'$in': match_ids}},
+            {'_id': 0, 'match_id': 1, 'last_created_at': 1, 'last_message': 1, f'unread.{user_id}': 1}
+        )
+        async for block in cursor:
+            summary = summaries.setdefault(block['match_id'], {'unread': 0, 'last_message': None, 'last_created_at': ''})
+            summary['unread'] += (block.get('unread') or {}).get(user_id, 0)
+            if block['last_created_at'] > summary['last_created_at'] and block.get('last_message'):
+                summary['last_created_at'] = block['last_created_at']
+                summary['last_message'] = block['last_message']
+        return summaries
+
+    async def mark_archived_read(self, match_id: str, reader_id: str):
+        """Clear reader_id's archived unread counts once they have opened the conversation"""
+        if self._db is None:
+            return
+        await self._db.message_archives.update_many(
+            {'match_id': match_id, f'unread.{reader_id}': {'$gt': 0}},
+            {'$unset': {f'unread.{reader_id}': ''}}
+        )
+
+    async def load_archived(
+        self,
+        match_id: str,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        limit: Optional[int] = None,
+        newest_first: bool = True
+    ) -> List[dict]:
+        """
+        Archived messages of match_id in (after, before), oldest first. With a limit,
+        returns the `limit` messages nearest to `before` (newest_first) or to `after`.
+        Only blocks overlapping the range are fetched and decompressed.
+        """
+        if self._db is None:
+            return []
+        query = {'match_id': match_id}
+        if before:
+            query['first_created_at'] = {'$lt': before}
+        if after:
+            query['last_created_at'] = {'$gt': after}
+
+        direction = -1 if newest_first else 1
+        cursor = self._db.message_archives.find(query).sort('last_created_at', direction)
+        collected: List[dict] = []
+        async for block in cursor:
+            self.stats_counters['archive_reads'] += 1
+            messages = [
+                m for m in _unpack(block)
+                if (not before or m['created_at'] < before) and (not after or m['created_at'] > after)
+            ]
+            collected = messages + collected if newest_first else collected + messages
+            if limit is not None and len(collected) >= limit:
+                break
+
+        if limit is not None:
+            collected = collected[-limit:] if newest_first else collected[:limit]
+        return collected
+
+    async def message_window(
+        self,
+        match_id: str,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> Tuple[List[dict], bool]:
+        """
+        Hot messages plus archived ones where needed, oldest first.
+        Archived messages are always older than the hot ones of the same match.
+        Returns (messages, has_more).
+        """
+        db = self._db
+        query = {'match_id': match_id}
+        projection = {'_id': 0, 'search_text': 0, 'expire_at': 0}
+
+        if before or (limit and not after):
+            # Window ending at `before` (or the latest messages)
+            if before:
+                query['created_at'] = {'$lt': before}
+            cursor = db.messages.find(query, projection).sort('created_at', -1)
+            if limit:
+                cursor = cursor.limit(limit + 1)
+            messages = await cursor.to_list(length=None)
+            if limit and len(messages) > limit:
+                return list(reversed(messages[:limit])), True
+            messages.reverse()
+
+            need = limit - len(messages) if limit else None
+            if need == 0:
+                return messages, await self._has_archived(match_id, messages[0]['created_at'])
+            boundary = messages[0]['created_at'] if messages else before
+            archived = await self.load_archived(
+                match_id, before=boundary, limit=need + 1 if need else None
+            )
+            has_more = need is not None and len(archived) > need
+            if has_more:
+                archived = archived[1:]
+            return archived + messages, has_more
+
+        # Window starting after `after` (or the full history)
+        archived = await self.load_archived(
+            match_id, after=after, limit=limit + 1 if limit else None, newest_first=False
+        )
+        if after:
+            query['created_at'] = {'$gt': after}
+        cursor = db.messages.find(query, projection).sort('created_at', 1)
+        if limit:
+            cursor = cursor.limit(limit + 1)
+        messages = archived + await cursor.to_list(length=None)
+        if limit:
+            return messages[:limit], len(messages) > limit
+        return messages, False
+
+    async def search_archived(self, match_id: str, tokens: List[str], before: Optional[str] = None,
+                              limit: int = 20) -> List[dict]:
+        """
+        Archived messages of match_id containing every token, newest first.
+        Only blocks whose token set has them all are decompressed.
+        """
+        if self._db is None or not tokens or limit <= 0:
+            return []
+        query = {'match_id': match_id, 'search_tokens': {'$all': tokens}}
+        if before:
+            query['first_created_at'] = {'$lt': before}
+        self.stats_counters['archive_searches'] += 1
+        results: List[dict] = []
+        cursor = self._db.message_archives.find(query).sort('last_created_at', -1)
+        async for block in cursor:
+            self.stats_counters['archive_reads'] += 1
+            for message in reversed(_unpack(block)):
+                if before and message['created_at'] >= before:
+                    continue
+                if not _message_tokens(message).issuperset(tokens):
+                    continue
+                results.append({
+                    key: message.get(key) for key in ('id', 'sender_id', 'content', 'message_type', 'created_at')
+                })
+                if len(results) >= limit:
+                    return results
+        return results
+
+    async def _has_archived(self, match_id: str, before: str) -> bool:
+        block = await self._db.message_archives.find_one(
+            {'match_id': match_id, 'first_created_at': {'$lt': before}},
+            {'_id': 1}
+        )
+        return block is not None
+
+    def stats(self) -> dict:
+        return {
+            'hot_days': MESSAGE_HOT_DAYS,
+            'inactive_days': MATCH_INACTIVE_DAYS,
+            **self.stats_counters,
+        }
+
+
+retention_service = RetentionService()
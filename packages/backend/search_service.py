@@ -0,0 +1,120 @@
+"""
+Message Search Service for Pizoo Dating App
+Per-conversation full-text search over a Mongo text index with Arabic normalization,
+continuing into archived history through per-block token sets
+"""
+
+import os
+import re
+import logging
+from typing import List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', '20'))
+SEARCH_MAX_TERMS = 8
+
+# Harakat, Quranic marks and tatweel carry no meaning for search
+_ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي',
+    'ؤ': 'و',
+    'ة': 'ه',
+})
+# Arabic-Indic and Persian digits -> ASCII so phone numbers match either way
+_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+_PHONE_LIKE = re.compile(r'\+?\d[\d\s\-().]{5,}\d')
+_TOKEN = re.compile(r'\w+')
+
+
+def _fold(text: str) -> str:
+    return _ARABIC_MARKS.sub('', text.lower()).translate(_ARABIC_LETTERS).translate(_DIGITS)
+
+
+def normalize_search_text(text: Optional[str]) -> str:
+    """
+    Fold text to the form stored in `messages.search_text` and used for queries:
+    lowercase, Arabic letter variants unified, diacritics/tatweel removed and
+    digits made ASCII. Phone-number-like runs are also appended digits-only, so
+    "079 123 4567" is found by "0791234567".
+    """
+    if not text:
+        return ''
+    folded = _fold(text)
+    phones = [re.sub(r'\D', '', m) for m in _PHONE_LIKE.findall(folded)]
+    return ' '.join([folded] + phones)
+
+
+def build_text_query(q: str) -> str:
+    """Every term must match: quote each normalized token for Mongo's $search"""
+    # Phone numbers are searched in their digits-only form, however they were typed
+    folded = _PHONE_LIKE.sub(lambda m: re.sub(r'\D', '', m.group()), _fold(q or ''))
+    terms = [t.replace('"', '') for t in folded.split()][:SEARCH_MAX_TERMS]
+    terms = [t for t in terms if t]
+    return ' '.join(f'"{t}"' for t in terms)
+
+
+def search_tokens(text: Optional[str]) -> Set[str]:
+    """Word tokens of normalize_search_text(text); archived messages are matched on these"""
+    return set(_TOKEN.findall(normalize_search_text(text)))
+
+
+def query_tokens(q: str) -> List[str]:
+    """The query's terms as tokens (see build_text_query); all must be present"""
+    folded = _PHONE_LIKE.sub(lambda m: re.sub(r'\D', '', m.group()), _fold(q or ''))
+    return list(dict.fromkeys(_TOKEN.findall(folded)))[:SEARCH_MAX_TERMS]
+
+
+async def ensure_indexes(db):
+    """
+    One compound text index: equality on match_id first, so a search only scans
+    that conversation. default_language none disables English stemming and stop
+    words, which would otherwise mangle Arabic and names.
+    """
+    await db.messages.create_index(
+        [('match_id', 1), ('search_text', 'text'), ('content', 'text')],
+        name='match_message_text',
+        default_language='none',
+        weights={'search_text': 2, 'content': 1}
+    )
+    await db.messages.create_index([('match_id', 1), ('created_at', -1)])
+
+
+async def search_messages(db, match_id: str, q: str, before: Optional[str] = None, limit: int = SEARCH_PAGE_SIZE,
+                          archives=None) -> dict:
+    """
+    Newest-first search results with a created_at cursor for the next page.
+    Hot messages come first; once they run out the search continues in
+    `archives` (the retention service), whose messages are always older. The
+    archive matches whole words only, where the text index also matches phrases.
+    """
+    text_query = build_text_query(q)
+    if not text_query:
+        return {'results': [], 'next_cursor': None}
+
+    query = {'match_id': match_id, '$text': {'$search': text_query}}
+    if before:
+        query['created_at'] = {'$lt': before}
+
+    limit = max(1, min(limit, 100))
+    results: List[dict] = await db.messages.find(
+        query,
+        {'_id': 0, 'id': 1, 'sender_id': 1, 'content': 1, 'message_type': 1, 'created_at': 1}
+    ).sort('created_at', -1).limit(limit + 1).to_list(length=None)
+
+    if archives is not None and len(results) <= limit:
+        # Hot history exhausted: the rest comes from archive blocks older than it
+        results += await archives.search_archived(
+            match_id,
+            query_tokens(q),
+            before=results[-1]['created_at'] if results else before,
+            limit=limit + 1 - len(results)
+        )
+
+    has_more = len(results) > limit
+    results = results[:limit]
+    return {
+        'results': results,
+        'next_cursor': results[-1]['created_at'] if has_more else None
+    }
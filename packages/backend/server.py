@@ -1,4 +1,4 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, File, UploadFile, Request, Form, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, File, UploadFile, Request, Form, BackgroundTasks, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import PlainTextResponse, JSONResponse
 from dotenv import load_dotenv
@@ -10,18 +10,19 @@ import re
 import time
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr, field_validator
-from typing import List, Optional, Dict
+from typing import List, Optional, Tuple
 import uuid
 import json
 from datetime import datetime, timezone, timedelta
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 from image_service import ImageUploadService
 from auth_service import AuthService
-from sms_service import generate_and_send, verify as verify_otp
+from sms_service import generate_and_send, sms_dispatcher, verify as verify_otp
 from twilio_service import create_voice_token, create_video_token, send_sms, verify_start, verify_check
 from twilio.twiml.voice_response import VoiceResponse, Dial
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import sys
 
 # Configure logging at the very start
@@ -115,60 +116,39 @@ except Exception as e:
     db = None
 
 # WebSocket Connection Manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_status: Dict[str, dict] = {}
-    
-    async def connect(self, user_id: str, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        self.user_status[user_id] = {
-            'online': True,
-            'last_seen': datetime.now(timezone.utc).isoformat()
-        }
-        # Broadcast user online status
-        await self.broadcast_status(user_id, True)
-    
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-        self.user_status[user_id] = {
-            'online': False,
-            'last_seen': datetime.now(timezone.utc).isoformat()
-        }
-    
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_json(message)
-            except Exception:
-                self.disconnect(user_id)
-    
-    async def broadcast_status(self, user_id: str, online: bool):
-        status_message = {
-            'type': 'user_status',
-            'user_id': user_id,
-            'online': online,
-            'timestamp': datetime.now(timezone.utc).isoformat()
-        }
-        for connection_user_id, connection in self.active_connections.items():
-            if connection_user_id != user_id:
-                try:
-                    await connection.send_json(status_message)
-                except Exception:
-                    pass
-    
-    def is_user_online(self, user_id: str) -> bool:
-        return user_id in self.active_connections
-    
-    def get_user_status(self, user_id: str) -> dict:
-        return self.user_status.get(user_id, {'online': False, 'last_seen': None})
-
-manager = ConnectionManager()
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from realtime_service import manager, typing_coalescer
+from ws_codec import negotiate as negotiate_codec
+from presence_service import presence_store
+from delivery_service import delivery_queue
+from sync_service import sync_service, parse_cursor
+from voice_service import voice_uploads, VoiceTooLarge, VoiceUploadBusy, VoiceInvalidUpload
+from search_service import SEARCH_PAGE_SIZE, normalize_search_text, search_messages
+from search_service import ensure_indexes as ensure_search_indexes
+from retention_service import retention_service, MESSAGE_PAGE_MAX
+from user_cache import user_cache
+from otp_store import otp_store
+from invite_service import bulk_invites
+from email_queue import email_queue
+from notification_digest import notification_digest
+from http_clients import http_clients
+from rate_limiter import RateLimiter, RateLimitResult, TOKEN_BUCKET, rate_limit_store
+from counter_service import counter_buffer
+from admin_auth import require_admin
+from job_leases import job_leases
+job_leases.configure(db)
+presence_store.configure(db)
+delivery_queue.configure(db)
+sync_service.configure(db)
+voice_uploads.configure(db)
+retention_service.configure(db)
+otp_store.configure(db)
+bulk_invites.configure(db)
+notification_digest.configure(db)
+rate_limit_store.configure(db)
+counter_buffer.configure(db)
+
+# Password hashing (bcrypt in a bounded thread pool)
+from password_service import password_hasher, PasswordHasherBusy
 
 # JWT settings
 SECRET_KEY = os.environ.get('SECRET_KEY')
@@ -177,6 +157,12 @@ if not SECRET_KEY:
     SECRET_KEY = 'dev-secret-key-do-not-use-in-production'
     print("WARNING: Using development SECRET_KEY. Ensure SECRET_KEY is set in production!")
 ALGORITHM = "HS256"
+
+# Decoded access tokens are cached per worker until exp; logout revokes via the deny list
+from token_cache import TokenCache, revoked_tokens
+from ephemeral_store import ensure_ephemeral_indexes, epoch_to_datetime
+token_cache = TokenCache(SECRET_KEY, [ALGORITHM])
+revoked_tokens.configure(db)
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
 # Security
@@ -372,11 +358,6 @@ class User(BaseModel):
     
     # Premium tier (free, gold, platinum)
     premium_tier: str = "free"
-    
-    # Weekly usage tracking for free users
-    likes_sent_this_week: int = 0
-    messages_sent_this_week: int = 0
-    week_start_date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 
 class Profile(BaseModel):
@@ -478,19 +459,6 @@ class PhoneVerificationOTP(BaseModel):
     attempts: int = 0  # Track verification attempts
 
 
-# Rate Limiting Model
-class RateLimit(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    user_id: str
-    endpoint: str  # e.g., "/livekit/token"
-    count: int = 0  # Number of requests
-    window_start: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    last_request: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-
-
-
 class Notification(BaseModel):
     model_config = ConfigDict(extra="ignore")
     
@@ -771,12 +739,27 @@ class PhotoUploadRequest(BaseModel):
 
 # ===== Helper Functions =====
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def password_hasher_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please try again",
+        headers={"Retry-After": "1"}
+    )
 
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+async def verify_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Returns (valid, upgraded_hash); upgraded_hash is set when the stored cost is outdated"""
+    try:
+        return await password_hasher.verify_and_update(plain_password, hashed_password)
+    except PasswordHasherBusy:
+        raise password_hasher_busy()
+
+
+async def get_password_hash(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise password_hasher_busy()
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -792,102 +775,133 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 # ===== Helper Functions for Usage Limits =====
 
-async def check_and_reset_weekly_limits(user: dict):
-    """Check if a week has passed and reset weekly limits"""
-    if 'week_start_date' not in user:
-        # Initialize if not exists
-        await db.users.update_one(
-            {"id": user['id']},
-            {"$set": {
-                "week_start_date": datetime.now(timezone.utc).isoformat(),
-                "likes_sent_this_week": 0,
-                "messages_sent_this_week": 0,
-                "premium_tier": user.get('premium_tier', 'free')
-            }}
-        )
-        user['likes_sent_this_week'] = 0
-        user['messages_sent_this_week'] = 0
-        user['premium_tier'] = user.get('premium_tier', 'free')
-        return user
-    
-    if isinstance(user['week_start_date'], str):
-        week_start = datetime.fromisoformat(user['week_start_date'])
-        # Ensure timezone awareness
-        if week_start.tzinfo is None:
-            week_start = week_start.replace(tzinfo=timezone.utc)
-    else:
-        week_start = user['week_start_date']
-        if week_start.tzinfo is None:
-            week_start = week_start.replace(tzinfo=timezone.utc)
-    
-    now = datetime.now(timezone.utc)
-    days_passed = (now - week_start).days
-    
-    # If 7 days have passed, reset the counters
-    if days_passed >= 7:
-        await db.users.update_one(
-            {"id": user['id']},
-            {"$set": {
-                "week_start_date": now.isoformat(),
-                "likes_sent_this_week": 0,
-                "messages_sent_this_week": 0
-            }}
-        )
-        user['likes_sent_this_week'] = 0
-        user['messages_sent_this_week'] = 0
-        user['week_start_date'] = now.isoformat()
-    
-    return user
+# Free tier weekly quotas. Counters live in `weekly_usage`, one document per
+# (user_id, ISO week), so a new week simply starts a new document: nothing is
+# ever reset, and old weeks are reaped by a TTL index (see ephemeral_store.py).
+WEEKLY_LIKE_LIMIT = 12
+WEEKLY_MESSAGE_LIMIT = 10
+WEEKLY_USAGE_RETENTION_DAYS = int(os.environ.get('WEEKLY_USAGE_RETENTION_DAYS', '14'))
 
 
-async def can_send_like(user: dict) -> tuple[bool, str]:
-    """Check if user can send a like"""
-    # Premium users have unlimited likes
-    if user.get('premium_tier') in ['gold', 'platinum']:
-        return True, "unlimited"
-    
-    # Free users have 12 likes per week
-    user = await check_and_reset_weekly_limits(user)
-    likes_sent = user.get('likes_sent_this_week', 0)
-    
-    if likes_sent >= 12:
-        return False, f"Weekly like limit reached. You've sent {likes_sent}/12 likes this week."
-    
-    return True, f"{12 - likes_sent} likes remaining"
+def current_week() -> tuple[str, datetime]:
+    """ISO week key ("2025-W07") and the Monday 00:00 UTC it starts on"""
+    now = datetime.now(timezone.utc)
+    year, week, weekday = now.isocalendar()
+    week_start = (now - timedelta(days=weekday - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return f"{year}-W{week:02d}", week_start
 
 
-async def can_send_message(user: dict) -> tuple[bool, str]:
-    """Check if user can send a message"""
-    # Premium users have unlimited messages
-    if user.get('premium_tier') in ['gold', 'platinum']:
-        return True, "unlimited"
-    
-    # Free users have 10 messages per week
-    user = await check_and_reset_weekly_limits(user)
-    messages_sent = user.get('messages_sent_this_week', 0)
-    
-    if messages_sent >= 10:
-        return False, f"Weekly message limit reached. You've sent {messages_sent}/10 messages this week."
-    
-    return True, f"{10 - messages_sent} messages remaining"
+def weekly_usage_defaults(field: str, week_start: datetime) -> dict:
+    """$setOnInsert for a new weekly_usage document counting `field`"""
+    return {
+        "messages" if field == "likes" else "likes": 0,
+        "week_start": week_start,
+        "expire_at": week_start + timedelta(days=7 + WEEKLY_USAGE_RETENTION_DAYS)
+    }
 
 
-async def increment_likes_count(user_id: str):
-    """Increment the weekly likes counter"""
-    await db.users.update_one(
-        {"id": user_id},
-        {"$inc": {"likes_sent_this_week": 1}}
+async def consume_capped(collection, query: dict, field: str, limit: int, on_insert: dict) -> Optional[int]:
+    """
+    Count one `field` on the document matching query (an equality filter) if it
+    is below limit, creating the document with on_insert's fields if needed.
+    Returns the new count, or None when the limit was already reached.
+
+    One pipeline upsert whose filter never mentions the counter: the document is
+    always matched, and the pipeline itself only increments below the limit, so
+    the limit doesn't depend on a unique index to turn "limit reached" into a
+    collision. A collision can still happen when two first upserts of a period
+    race on the unique index; it is retried once, by which time the document exists.
+    """
+    current = {"$ifNull": [f"${field}", 0]}
+    pipeline = [{"$set": {
+        field: {"$cond": [{"$lt": [current, limit]}, {"$add": [current, 1]}, current]},
+        **{key: {"$ifNull": [f"${key}", value]} for key, value in on_insert.items()}
+    }}]
+    for attempt in range(2):
+        try:
+            before = await collection.find_one_and_update(
+                query,
+                pipeline,
+                upsert=True,
+                projection={"_id": 0, field: 1},
+                return_document=ReturnDocument.BEFORE
+            )
+            break
+        except DuplicateKeyError:
+            if attempt:
+                raise
+    count = (before or {}).get(field, 0)
+    return count + 1 if count < limit else None
+
+
+async def get_weekly_usage(user_id: str) -> dict:
+    """This week's like/message counts for user (zeros when nothing was counted yet; never writes)"""
+    week, week_start = current_week()
+    query = {"user_id": user_id, "week": week}
+    doc = await db.weekly_usage.find_one(query, {"_id": 0})
+    # Premium counts are write-behind; include the ones not flushed yet
+    doc = counter_buffer.apply_pending("weekly_usage", query, doc)
+    return doc or {"user_id": user_id, "week": week, "week_start": week_start, "likes": 0, "messages": 0}
+
+
+def track_weekly_usage(user_id: str, field: str):
+    """Count a like/message nothing is enforced against (premium); buffered, see counter_service.py"""
+    week, week_start = current_week()
+    counter_buffer.inc(
+        "weekly_usage",
+        {"user_id": user_id, "week": week},
+        {field: 1},
+        upsert=True,
+        on_insert=weekly_usage_defaults(field, week_start)
     )
 
 
-async def increment_messages_count(user_id: str):
-    """Increment the weekly messages counter"""
-    await db.users.update_one(
-        {"id": user_id},
-        {"$inc": {"messages_sent_this_week": 1}}
+async def consume_weekly_quota(user_id: str, field: str, limit: int) -> Optional[int]:
+    """
+    Count one like/message for this week in a single atomic upsert and return
+    the new count, or None when the limit was already reached (see consume_capped).
+    """
+    week, week_start = current_week()
+    return await consume_capped(
+        db.weekly_usage,
+        {"user_id": user_id, "week": week},
+        field,
+        limit,
+        weekly_usage_defaults(field, week_start)
     )
 
 
+async def consume_like_quota(user: dict) -> Optional[int]:
+    """Use one of the user's weekly likes; returns likes remaining (None = unlimited), 403 at the limit"""
+    # Premium users have unlimited likes (still counted for usage stats)
+    if user.get('premium_tier') in ['gold', 'platinum']:
+        track_weekly_usage(user['id'], "likes")
+        return None
+    
+    likes_sent = await consume_weekly_quota(user['id'], "likes", WEEKLY_LIKE_LIMIT)
+    if likes_sent is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Weekly like limit reached. You've sent {WEEKLY_LIKE_LIMIT}/{WEEKLY_LIKE_LIMIT} likes this week."
+        )
+    return WEEKLY_LIKE_LIMIT - likes_sent
+
+
+async def consume_message_quota(user: dict) -> Optional[int]:
+    """Use one of the user's weekly messages; returns messages remaining (None = unlimited), 403 at the limit"""
+    # Premium users have unlimited messages
+    if user.get('premium_tier') in ['gold', 'platinum']:
+        return None
+    
+    messages_sent = await consume_weekly_quota(user['id'], "messages", WEEKLY_MESSAGE_LIMIT)
+    if messages_sent is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Weekly message limit reached. You've sent {WEEKLY_MESSAGE_LIMIT}/{WEEKLY_MESSAGE_LIMIT} messages this week."
+        )
+    return WEEKLY_MESSAGE_LIMIT - messages_sent
+
+
 # ===== Authentication =====
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -898,14 +912,14 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     )
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = token_cache.decode(token)
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    user = await user_cache.get(db, user_id)
     if user is None:
         raise credentials_exception
     return user
@@ -921,12 +935,12 @@ async def optional_auth(credentials: Optional[HTTPAuthorizationCredentials] = De
     
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = token_cache.decode(token)
         user_id: str = payload.get("sub")
         if user_id is None:
             return None
         
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        user = await user_cache.get(db, user_id)
         return user
     except (JWTError, Exception):
         return None
@@ -1034,7 +1048,7 @@ async def register(request: RegisterRequest):
         name=request.name,
         email=request.email,
         phone_number=request.phone_number,
-        password_hash=get_password_hash(request.password),
+        password_hash=await get_password_hash(request.password),
         trial_end_date=trial_end_date,
         subscription_status="trial",
         terms_accepted=True,
@@ -1123,12 +1137,23 @@ async def login(request: LoginRequest):
     
     user = await db.users.find_one(query, {"_id": 0})
     
-    if not user or not verify_password(request.password, user['password_hash']):
+    valid, upgraded_hash = (False, None)
+    if user and user.get('password_hash'):
+        valid, upgraded_hash = await verify_password(request.password, user['password_hash'])
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="البريد الإلكتروني أو كلمة المرور غير صحيحة"
         )
     
+    if upgraded_hash:
+        # Stored hash used an outdated bcrypt cost; replace it now that we know the password
+        await db.users.update_one(
+            {"id": user['id']},
+            {"$set": {"password_hash": upgraded_hash}}
+        )
+        user_cache.invalidate(user['id'])
+    
     access_token = create_access_token(data={"sub": user['id']})
     
     # Convert trial_end_date to ISO string to prevent JSON serialization issues
@@ -1206,6 +1231,7 @@ async def google_oauth_login(request: EmergentOAuthRequest):
                         "verified_at": datetime.now(timezone.utc).isoformat()
                     }}
                 )
+                user_cache.invalidate(user["id"])
                 user["verified"] = True
                 user["verified_method"] = "google_oauth"
         else:
@@ -1281,7 +1307,7 @@ async def google_oauth_login(request: EmergentOAuthRequest):
         )
         
         session_dict = user_session.model_dump()
-        session_dict['expires_at'] = session_dict['expires_at'].isoformat()
+        # expires_at stays a BSON datetime so the TTL index can reap the session
         session_dict['created_at'] = session_dict['created_at'].isoformat()
         session_dict['last_used_at'] = session_dict['last_used_at'].isoformat()
         
@@ -1381,7 +1407,7 @@ async def send_email_verification_link(request: EmailVerificationSendRequest):
         
         token_dict = verification_token.model_dump()
         token_dict['created_at'] = token_dict['created_at'].isoformat()
-        token_dict['expires_at'] = token_dict['expires_at'].isoformat()
+        # expires_at stays a BSON datetime so the TTL index can reap the token
         
         await db.email_verification_tokens.insert_one(token_dict)
         
@@ -1459,6 +1485,7 @@ async def verify_email_link(request: EmailVerificationVerifyRequest):
                 "email_verified": True
             }}
         )
+        user_cache.invalidate(user_id)
         
         # Get updated user
         user = await db.users.find_one({"id": user_id}, {"_id": 0})
@@ -1478,7 +1505,7 @@ async def verify_email_link(request: EmailVerificationVerifyRequest):
         )
         
         session_dict = user_session.model_dump()
-        session_dict['expires_at'] = session_dict['expires_at'].isoformat()
+        # expires_at stays a BSON datetime so the TTL index can reap the session
         session_dict['created_at'] = session_dict['created_at'].isoformat()
         session_dict['last_used_at'] = session_dict['last_used_at'].isoformat()
         
@@ -1624,9 +1651,12 @@ async def refresh_access_token(request: RefreshTokenRequest):
 # ===== Logout =====
 
 @api_router.post("/auth/logout")
-async def logout(current_user: dict = Depends(get_current_user)):
+async def logout(
+    current_user: dict = Depends(get_current_user),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
     """
-    Logout user by deleting session
+    Logout user by deleting session and revoking the access token
     """
     try:
         user_id = current_user["id"]
@@ -1634,6 +1664,9 @@ async def logout(current_user: dict = Depends(get_current_user)):
         # Delete all sessions for this user
         await db.user_sessions.delete_many({"user_id": user_id})
         
+        # The token stays cryptographically valid until exp; deny it on every worker
+        await revoked_tokens.revoke(credentials.credentials)
+        
         logging.info(f"✅ User {user_id} logged out")
         
         return {
@@ -1728,20 +1761,27 @@ class VerifyPayload(BaseModel):
     code: str
     otpId: str
 
-@api_router.post("/auth/phone/send-otp")
-async def send_phone_otp(payload: PhonePayload, request: Request, current_user: dict = Depends(optional_auth)):
-    """Send OTP code to phone number with language-aware message"""
+# Rate limiting: prevent spam (30 seconds between requests per phone)
+phone_otp_limiter = RateLimiter("phone_otp", limit=1, period_seconds=30, algorithm=TOKEN_BUCKET,
+                                detail="TOO_MANY_REQUESTS")
+
+async def valid_phone(payload: PhonePayload) -> str:
+    """The payload's phone, validated (rate limit key: invalid numbers don't use up the limit)"""
     phone = payload.phone.strip()
-    
-    # Validate phone format
     if not PHONE_RE.match(phone):
         raise HTTPException(status_code=400, detail="INVALID_PHONE")
-    
-    # Rate limiting: prevent spam (30 seconds between requests)
+    return phone
+
+@api_router.post("/auth/phone/send-otp")
+async def send_phone_otp(
+    payload: PhonePayload,
+    request: Request,
+    current_user: dict = Depends(optional_auth),
+    phone: str = Depends(valid_phone),
+    _rate_limit: RateLimitResult = Depends(phone_otp_limiter.dependency(valid_phone))
+):
+    """Send OTP code to phone number with language-aware message"""
     now = int(time.time())
-    last = await db.user_otp.find_one({"phone": phone}, sort=[("_id", -1)])
-    if last and (now - last.get("created_at", 0) < 30):
-        raise HTTPException(status_code=429, detail="TOO_MANY_REQUESTS")
     
     # Detect user language (if authenticated) or default to 'en'
     user_lang = 'en'
@@ -1757,7 +1797,7 @@ async def send_phone_otp(payload: PhonePayload, request: Request, current_user:
             user_lang = existing_user["language"]
     
     # Generate and send OTP with language-aware message
-    pack = generate_and_send(phone, user_lang)
+    pack = await generate_and_send(phone, user_lang)
     if not pack:
         raise HTTPException(status_code=500, detail="SMS_FAILED")
     
@@ -1769,6 +1809,7 @@ async def send_phone_otp(payload: PhonePayload, request: Request, current_user:
         "attempts_left": pack["attempts_left"],
         "verified": False,
         "created_at": now,
+        "expire_at": epoch_to_datetime(pack["expires_at"]),  # TTL index field
         "language": user_lang  # Store language for reference
     }
     ins = await db.user_otp.insert_one(doc)
@@ -1925,10 +1966,32 @@ class LiveKitTokenRequest(BaseModel):
     call_type: str = Field(default="video", description="Type of call: 'video' or 'audio'")
     participant_name: Optional[str] = Field(default=None, description="Display name for participant")
 
+async def verified_user(current_user: dict = Depends(get_current_user)) -> dict:
+    """Current user, 403 unless their account is verified"""
+    if not current_user.get("verified"):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Account not verified. Please complete verification to use calls."
+        )
+    return current_user
+
+
+async def verified_user_id(current_user: dict = Depends(verified_user)) -> str:
+    """Rate limit key for per-user limits on verified-only routes (checked after verification)"""
+    return current_user['id']
+
+
+livekit_token_limiter = RateLimiter(
+    "livekit_token", limit=30, period_seconds=3600,
+    detail="Rate limit exceeded. Maximum {limit} calls per hour. Try again in {minutes} minutes."
+)
+
+
 @api_router.post("/livekit/token")
 async def generate_livekit_token(
     payload: LiveKitTokenRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(verified_user),
+    _rate_limit: RateLimitResult = Depends(livekit_token_limiter.dependency(verified_user_id))
 ):
     """
     Generate LiveKit access token for video/voice calls
@@ -1951,68 +2014,7 @@ async def generate_livekit_token(
         participant_info: User identity and name
     """
     try:
-        # Check if user is verified
-        if not current_user.get("verified"):
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Account not verified. Please complete verification to use calls."
-            )
-        
-        # Rate limiting: 30 calls per hour
         user_id = current_user.get('id')
-        now = datetime.now(timezone.utc)
-        rate_limit_window = timedelta(hours=1)
-        window_start = now - rate_limit_window
-        
-        # Check existing rate limit
-        rate_limit = await db.rate_limits.find_one(
-            {"user_id": user_id, "endpoint": "/livekit/token"},
-            {"_id": 0}
-        )
-        
-        if rate_limit:
-            window_start_dt = datetime.fromisoformat(rate_limit["window_start"]) if isinstance(rate_limit["window_start"], str) else rate_limit["window_start"]
-            if window_start_dt.tzinfo is None:
-                window_start_dt = window_start_dt.replace(tzinfo=timezone.utc)
-            
-            # Reset if window expired
-            if now - window_start_dt >= rate_limit_window:
-                await db.rate_limits.update_one(
-                    {"user_id": user_id, "endpoint": "/livekit/token"},
-                    {"$set": {
-                        "count": 1,
-                        "window_start": now.isoformat(),
-                        "last_request": now.isoformat()
-                    }}
-                )
-            else:
-                # Check if limit exceeded
-                if rate_limit["count"] >= 30:
-                    raise HTTPException(
-                        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                        detail=f"Rate limit exceeded. Maximum 30 calls per hour. Try again in {int((rate_limit_window - (now - window_start_dt)).total_seconds() / 60)} minutes."
-                    )
-                
-                # Increment count
-                await db.rate_limits.update_one(
-                    {"user_id": user_id, "endpoint": "/livekit/token"},
-                    {"$inc": {"count": 1}, "$set": {"last_request": now.isoformat()}}
-                )
-        else:
-            # Create new rate limit entry
-            rate_limit_entry = RateLimit(
-                user_id=user_id,
-                endpoint="/livekit/token",
-                count=1,
-                window_start=now,
-                last_request=now
-            )
-            
-            rate_limit_dict = rate_limit_entry.model_dump()
-            rate_limit_dict['window_start'] = rate_limit_dict['window_start'].isoformat()
-            rate_limit_dict['last_request'] = rate_limit_dict['last_request'].isoformat()
-            
-            await db.rate_limits.insert_one(rate_limit_dict)
         
         # Check if LiveKit is configured
         if not LiveKitService.is_configured():
@@ -2245,6 +2247,7 @@ async def create_profile(request: ProfileCreateRequest, current_user: dict = Dep
         {"id": current_user['id']},
         {"$set": {"profile_completed": True}}
     )
+    user_cache.invalidate(current_user['id'])
     
     # Remove non-serializable fields from response
     response_profile = {k: v for k, v in profile_dict.items() if k != '_id'}
@@ -2291,13 +2294,9 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 @api_router.get("/usage-stats")
 async def get_usage_stats(current_user: dict = Depends(get_current_user)):
     """Get current usage statistics for free users"""
-    # Check and reset if needed
-    user = await check_and_reset_weekly_limits(current_user)
-    
-    # Refresh user data
-    user = await db.users.find_one({"id": current_user['id']}, {"_id": 0})
+    usage = await get_weekly_usage(current_user['id'])
     
-    premium_tier = user.get('premium_tier', 'free')
+    premium_tier = current_user.get('premium_tier', 'free')
     
     if premium_tier in ['gold', 'platinum']:
         return {
@@ -2305,36 +2304,36 @@ async def get_usage_stats(current_user: dict = Depends(get_current_user)):
             "is_premium": True,
             "likes": {
                 "unlimited": True,
-                "sent": user.get('likes_sent_this_week', 0),
+                "sent": usage['likes'],
                 "remaining": None
             },
             "messages": {
                 "unlimited": True,
-                "sent": user.get('messages_sent_this_week', 0),
+                "sent": usage['messages'],
                 "remaining": None
             }
         }
     
     # Free user
-    likes_sent = user.get('likes_sent_this_week', 0)
-    messages_sent = user.get('messages_sent_this_week', 0)
+    likes_sent = usage['likes']
+    messages_sent = usage['messages']
     
     return {
         "premium_tier": "free",
         "is_premium": False,
         "likes": {
             "unlimited": False,
-            "limit": 12,
+            "limit": WEEKLY_LIKE_LIMIT,
             "sent": likes_sent,
-            "remaining": max(0, 12 - likes_sent)
+            "remaining": max(0, WEEKLY_LIKE_LIMIT - likes_sent)
         },
         "messages": {
             "unlimited": False,
-            "limit": 10,
+            "limit": WEEKLY_MESSAGE_LIMIT,
             "sent": messages_sent,
-            "remaining": max(0, 10 - messages_sent)
+            "remaining": max(0, WEEKLY_MESSAGE_LIMIT - messages_sent)
         },
-        "week_start_date": user.get('week_start_date')
+        "week_start_date": usage['week_start'].isoformat()
     }
 
 
@@ -2624,14 +2623,22 @@ async def purge_user_assets_background(user_id: str):
     This includes: messages, matches, swipes, photos, etc.
     """
     try:
-        # Delete user messages
-        await db.messages.delete_many({"$or": [{"sender_id": user_id}, {"receiver_id": user_id}]})
-        
         # Delete user swipes
         await db.swipes.delete_many({"$or": [{"user_id": user_id}, {"swiped_user_id": user_id}]})
         
-        # Delete user matches
+        # Delete user matches (and tell the other side's synced clients)
+        removed_matches = await db.matches.find(
+            {"$or": [{"user1_id": user_id}, {"user2_id": user_id}]},
+            {"_id": 0, "id": 1, "user1_id": 1, "user2_id": 1}
+        ).to_list(length=None)
         await db.matches.delete_many({"$or": [{"user1_id": user_id}, {"user2_id": user_id}]})
+        await sync_service.record_tombstones(
+            (m['user2_id'] if m['user1_id'] == user_id else m['user1_id'], "match", m['id'])
+            for m in removed_matches
+        )
+        
+        # Delete user messages and archived history, including conversations whose match is already gone
+        await retention_service.purge_user(user_id, [m['id'] for m in removed_matches])
         
         # Delete user likes
         await db.likes.delete_many({"$or": [{"from_user_id": user_id}, {"to_user_id": user_id}]})
@@ -2687,6 +2694,7 @@ async def delete_my_account(
             }
         }
     )
+    user_cache.invalidate(user_id)
     
     # Schedule background purge
     background_tasks.add_task(purge_user_assets_background, user_id)
@@ -2965,14 +2973,10 @@ async def get_top_picks(current_user: dict = Depends(get_current_user)):
 
 @api_router.post("/swipe")
 async def swipe_action(request: SwipeRequest, current_user: dict = Depends(get_current_user)):
-    # Check if action is a like and enforce limits
+    # Likes check and use the weekly quota in one step
+    remaining_likes = None
     if request.action in ['like', 'super_like']:
-        can_like, message = await can_send_like(current_user)
-        if not can_like:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail=message
-            )
+        remaining_likes = await consume_like_quota(current_user)
     
     # Save swipe
     swipe = Swipe(
@@ -2986,10 +2990,6 @@ async def swipe_action(request: SwipeRequest, current_user: dict = Depends(get_c
     
     await db.swipes.insert_one(swipe_dict)
     
-    # Increment like counter if it's a like action
-    if request.action in ['like', 'super_like']:
-        await increment_likes_count(current_user['id'])
-    
     # Check for match if action is like or super_like
     is_match = False
     if request.action in ['like', 'super_like']:
@@ -3020,9 +3020,13 @@ async def swipe_action(request: SwipeRequest, current_user: dict = Depends(get_c
                 
                 match_dict = match.model_dump()
                 match_dict['matched_at'] = match_dict['matched_at'].isoformat()
+                match_dict['updated_at'] = datetime.now(timezone.utc)
                 
                 await db.matches.insert_one(match_dict)
-                
+
+                # Let the new pair see each other's presence straight away
+                await manager.link_presence(current_user['id'], request.swiped_user_id)
+
                 # Create notifications for both users
                 current_user_profile = await db.profiles.find_one(
                     {"user_id": current_user['id']},
@@ -3077,19 +3081,15 @@ async def swipe_action(request: SwipeRequest, current_user: dict = Depends(get_c
                         related_user_photo=current_user_profile.get('photos', [None])[0] if current_user_profile.get('photos') else None
                     )
     
-    # Get remaining limits for response
-    remaining_likes = None
-    if current_user.get('premium_tier') not in ['gold', 'platinum']:
-        updated_user = await db.users.find_one({"id": current_user['id']}, {"_id": 0})
-        likes_sent = updated_user.get('likes_sent_this_week', 0)
-        remaining_likes = max(0, 12 - likes_sent)
-    
-    return {
+    response = {
         "success": True,
         "is_match": is_match,
-        "action": request.action,
-        "remaining_likes": remaining_likes
+        "action": request.action
     }
+    # Only likes use the quota, so passes don't report (or reset) the remaining count
+    if request.action in ['like', 'super_like']:
+        response["remaining_likes"] = remaining_likes
+    return response
 
 
 @api_router.get("/matches")
@@ -3223,6 +3223,8 @@ async def create_dummy_profiles():
     
     dummy_users_data = []
     dummy_profiles_data = []
+    # One hash shared by every dummy account instead of 20 bcrypt rounds in a row
+    dummy_password_hash = await get_password_hash("dummy123")
     
     for i, data in enumerate(dummy_data):
         user_id = f"dummy-user-{i}"
@@ -3233,7 +3235,7 @@ async def create_dummy_profiles():
             "name": data['name'],
             "email": f"dummy{i}@pizoo.com",
             "phone_number": f"+123456789{i:02d}",
-            "password_hash": pwd_context.hash("dummy123"),
+            "password_hash": dummy_password_hash,
             "created_at": datetime.now(timezone.utc).isoformat(),
             "trial_end_date": (datetime.now(timezone.utc) + timedelta(days=14)).isoformat(),
             "subscription_status": "trial",
@@ -3500,9 +3502,13 @@ async def get_conversations(current_user: dict = Depends(get_current_user)):
         {"_id": 0}
     ).to_list(length=None)
     
+    # Compacted history: archived unread counts and the newest archived message per match
+    archived = await retention_service.archived_summaries([m['id'] for m in matches], current_user['id'])
+    
     conversations = []
     for match in matches:
         other_user_id = match['user2_id'] if match['user1_id'] == current_user['id'] else match['user1_id']
+        archive = archived.get(match['id'], {})
         
         # Get other user's profile
         other_profile = await db.profiles.find_one({"user_id": other_user_id}, {"_id": 0})
@@ -3513,14 +3519,16 @@ async def get_conversations(current_user: dict = Depends(get_current_user)):
             {"match_id": match['id']},
             {"_id": 0},
             sort=[("created_at", -1)]
-        )
+        ) or archive.get('last_message')
         
         # Count unread messages
         unread_count = await db.messages.count_documents({
             "match_id": match['id'],
             "receiver_id": current_user['id'],
             "status": {"$ne": "read"}
-        })
+        }) + archive.get('unread', 0)
+        
+        last_seen = presence_store.last_seen_for(other_user_id, other_user)
         
         conversations.append({
             "match_id": match['id'],
@@ -3529,7 +3537,8 @@ async def get_conversations(current_user: dict = Depends(get_current_user)):
                 "name": other_user.get('name') if other_user else "Unknown",
                 "display_name": other_profile.get('display_name') if other_profile else "Unknown",
                 "photo": other_profile.get('photos', [None])[0] if other_profile else None,
-                "is_online": False  # TODO: implement online status
+                "is_online": manager.is_user_online(other_user_id),
+                "last_seen": last_seen.isoformat() if last_seen else None
             },
             "last_message": {
                 "content": last_message.get('content') if last_message else None,
@@ -3547,8 +3556,19 @@ async def get_conversations(current_user: dict = Depends(get_current_user)):
 
 
 @api_router.get("/conversations/{match_id}/messages")
-async def get_messages(match_id: str, current_user: dict = Depends(get_current_user)):
-    """Get all messages for a conversation"""
+async def get_messages(
+    match_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MESSAGE_PAGE_MAX),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Get messages for a conversation (oldest first).
+    Without parameters the full history is returned. `before`/`after` take a
+    message created_at (e.g. a search result cursor) and, with `limit`, return
+    the window of history next to it.
+    """
     # Verify match exists and user is part of it
     match = await db.matches.find_one(
         {
@@ -3564,14 +3584,14 @@ async def get_messages(match_id: str, current_user: dict = Depends(get_current_u
     if not match:
         raise HTTPException(status_code=404, detail="Match not found")
     
-    # Get messages
-    messages = await db.messages.find(
-        {"match_id": match_id},
-        {"_id": 0}
-    ).sort("created_at", 1).to_list(length=None)
+    # Get messages (older history is read from archive blocks when reached)
+    messages, has_more = await retention_service.message_window(
+        match_id, before=before, after=after, limit=limit
+    )
     
     # Mark messages as read
-    await db.messages.update_many(
+    read_at = datetime.now(timezone.utc).isoformat()
+    result = await db.messages.update_many(
         {
             "match_id": match_id,
             "receiver_id": current_user['id'],
@@ -3580,12 +3600,45 @@ async def get_messages(match_id: str, current_user: dict = Depends(get_current_u
         {
             "$set": {
                 "status": "read",
-                "read_at": datetime.now(timezone.utc).isoformat()
+                "read_at": read_at
             }
         }
     )
+    await retention_service.mark_archived_read(match_id, current_user['id'])
+    if result.modified_count:
+        await sync_service.touch_read_watermark(match_id, current_user['id'], read_at)
+    
+    return {"messages": messages, "has_more": has_more}
+
+
+@api_router.get("/conversations/{match_id}/messages/search")
+async def search_conversation_messages(
+    match_id: str,
+    q: str,
+    before: Optional[str] = None,
+    limit: int = SEARCH_PAGE_SIZE,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Full-text search inside one conversation (Arabic and Latin), newest first,
+    including history that has been moved to archive blocks. Pass `next_cursor` back as `before` for the next page; use a result's
+    created_at with GET .../messages?before=&after= to open that part of the history.
+    """
+    match = await db.matches.find_one(
+        {
+            "id": match_id,
+            "$or": [
+                {"user1_id": current_user['id']},
+                {"user2_id": current_user['id']}
+            ]
+        },
+        {"_id": 0, "id": 1}
+    )
     
-    return {"messages": messages}
+    if not match:
+        raise HTTPException(status_code=404, detail="Match not found")
+    
+    return await search_messages(db, match_id, q, before=before, limit=limit, archives=retention_service)
 
 
 class SendMessageRequest(BaseModel):
@@ -3599,14 +3652,6 @@ async def send_message(
     current_user: dict = Depends(get_current_user)
 ):
     """Send a message in a conversation"""
-    # Check message limits for free users
-    can_message, message_limit_info = await can_send_message(current_user)
-    if not can_message:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail=message_limit_info
-        )
-    
     # Verify match exists
     match = await db.matches.find_one(
         {
@@ -3622,6 +3667,9 @@ async def send_message(
     if not match:
         raise HTTPException(status_code=404, detail="Match not found")
     
+    # Check and use the free user's weekly message quota in one step
+    remaining_messages = await consume_message_quota(current_user)
+    
     # Determine receiver
     receiver_id = match['user2_id'] if match['user1_id'] == current_user['id'] else match['user1_id']
     
@@ -3638,11 +3686,22 @@ async def send_message(
         "read_at": None
     }
     
-    await db.messages.insert_one(message_data)
+    await db.messages.insert_one({
+        **message_data,
+        "search_text": normalize_search_text(request.content) if request.message_type == "text" else "",
+        "updated_at": datetime.now(timezone.utc)
+    })
     
-    # Increment message counter for free users
-    if current_user.get('premium_tier') not in ['gold', 'platinum']:
-        await increment_messages_count(current_user['id'])
+    # Queue for the receiver's devices; pushed now if online, on connect otherwise
+    await delivery_queue.deliver(receiver_id, message_data['id'], {
+        "type": "new_message",
+        "id": message_data['id'],
+        "sender_id": current_user['id'],
+        "message": request.content,
+        "message_type": request.message_type,
+        "match_id": match_id,
+        "timestamp": message_data['created_at']
+    })
     
     # Send notification to receiver
     sender_profile = await db.profiles.find_one(
@@ -3663,13 +3722,6 @@ async def send_message(
             related_user_photo=sender_profile.get('photos', [None])[0] if sender_profile.get('photos') else None
         )
     
-    # Get remaining messages for response
-    remaining_messages = None
-    if current_user.get('premium_tier') not in ['gold', 'platinum']:
-        updated_user = await db.users.find_one({"id": current_user['id']}, {"_id": 0})
-        messages_sent = updated_user.get('messages_sent_this_week', 0)
-        remaining_messages = max(0, 10 - messages_sent)
-    
     return {
         "message": "Message sent successfully",
         "data": message_data,
@@ -3680,6 +3732,7 @@ async def send_message(
 @api_router.post("/conversations/{match_id}/read-receipts")
 async def mark_as_read(match_id: str, current_user: dict = Depends(get_current_user)):
     """Mark all messages in conversation as read"""
+    read_at = datetime.now(timezone.utc).isoformat()
     result = await db.messages.update_many(
         {
             "match_id": match_id,
@@ -3689,58 +3742,70 @@ async def mark_as_read(match_id: str, current_user: dict = Depends(get_current_u
         {
             "$set": {
                 "status": "read",
-                "read_at": datetime.now(timezone.utc).isoformat()
+                "read_at": read_at
             }
         }
     )
+    await retention_service.mark_archived_read(match_id, current_user['id'])
+    if result.modified_count:
+        await sync_service.touch_read_watermark(match_id, current_user['id'], read_at)
     
     return {
         "message": f"Marked {result.modified_count} messages as read"
     }
 
 
-@api_router.post("/voice-message/upload")
+@api_router.post("/voice-message/upload", status_code=status.HTTP_202_ACCEPTED)
 async def upload_voice_message(
-    file: UploadFile = File(...),
+    request: Request,
     current_user: dict = Depends(get_current_user)
 ):
-    """Upload voice message to Cloudinary and return URL"""
+    """
+    Accept a voice message (multipart form, audio in the `file` field) for
+    upload to Cloudinary. The body is streamed straight to disk rather than
+    declared as an UploadFile, so the size cap applies while it is read.
+    Returns a pending upload_id; the URL arrives over WebSocket as
+    `voice_upload_complete` (or via GET /voice-message/upload/{upload_id}).
+    """
     try:
-        # Validate file type
-        if not file.content_type or not file.content_type.startswith('audio/'):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid file type. Must be audio file."
-            )
-        
-        # Read file content
-        contents = await file.read()
-        
-        # Upload to Cloudinary as video (audio files work with video upload)
-        import cloudinary.uploader
-        result = cloudinary.uploader.upload(
-            contents,
-            resource_type="video",  # Cloudinary handles audio as video resource
-            folder=f"pizoo/voice_messages/{current_user['id']}",
-            format="webm",
-            transformation=[
-                {'audio_codec': 'opus', 'bit_rate': '32k'}
-            ]
+        path = await voice_uploads.spool(request)
+        upload_id = await voice_uploads.submit(current_user['id'], path)
+    except VoiceInvalidUpload as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    except VoiceTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="Voice message is too large"
+        )
+    except VoiceUploadBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many voice uploads in progress, please retry"
         )
-        
-        return {
-            "success": True,
-            "url": result['secure_url'],
-            "duration": result.get('duration', 0),
-            "public_id": result['public_id']
-        }
-        
     except Exception as e:
         logger.error(f"Voice message upload error: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to upload voice message: {str(e)}"
         )
+    
+    return {
+        "success": True,
+        "status": "pending",
+        "upload_id": upload_id
+    }
+
+
+@api_router.get("/voice-message/upload/{upload_id}")
+async def get_voice_upload_status(upload_id: str, current_user: dict = Depends(get_current_user)):
+    """Poll a pending voice upload (for clients without a WebSocket)"""
+    upload = await voice_uploads.get_status(upload_id, current_user['id'])
+    if not upload:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
 
 
 def calculate_compatibility_score(user1_profile: dict, user2_profile: dict) -> dict:
@@ -4163,12 +4228,20 @@ async def block_user(
     await db.blocks.insert_one(block_dict)
     
     # Remove any existing matches
-    await db.matches.delete_many({
+    pair_filter = {
         "$or": [
             {"user1_id": current_user['id'], "user2_id": request.blocked_user_id},
             {"user1_id": request.blocked_user_id, "user2_id": current_user['id']}
         ]
-    })
+    }
+    removed_match_ids = await db.matches.distinct("id", pair_filter)
+    await db.matches.delete_many(pair_filter)
+    await retention_service.expire_conversations(removed_match_ids)
+    await sync_service.record_tombstones(
+        (uid, "match", mid)
+        for mid in removed_match_ids
+        for uid in (current_user['id'], request.blocked_user_id)
+    )
     
     return {
         "message": "تم حظر المستخدم بنجاح",
@@ -4268,7 +4341,7 @@ async def mark_notification_as_read(
             "id": notification_id,
             "user_id": current_user['id']
         },
-        {"$set": {"is_read": True}}
+        {"$set": {"is_read": True, "updated_at": datetime.now(timezone.utc)}}
     )
     
     if result.modified_count == 0:
@@ -4288,7 +4361,7 @@ async def mark_all_notifications_as_read(current_user: dict = Depends(get_curren
             "user_id": current_user['id'],
             "is_read": False
         },
-        {"$set": {"is_read": True}}
+        {"$set": {"is_read": True, "updated_at": datetime.now(timezone.utc)}}
     )
     
     return {"message": f"Marked {result.modified_count} notifications as read"}
@@ -4311,6 +4384,8 @@ async def delete_notification(
             detail="Notification not found"
         )
     
+    await sync_service.record_tombstones([(current_user['id'], "notification", notification_id)])
+    
     return {"message": "Notification deleted"}
 
 
@@ -4338,12 +4413,35 @@ async def create_notification(
     
     notification_dict = notification.model_dump()
     notification_dict['created_at'] = notification_dict['created_at'].isoformat()
+    notification_dict['updated_at'] = datetime.now(timezone.utc)
     
     await db.notifications.insert_one(notification_dict)
+    # Offline users get these by email, summarized per digest window
+    notification_digest.add(user_id, notification_type, title, message)
     return notification
 
 
 
+# ===== Delta Sync =====
+
+@api_router.get("/sync")
+async def sync_changes(
+    since: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Everything that changed for the current user since `since` (the cursor from
+    the previous response): messages, read watermarks, notifications, matches and
+    deletions. Call again with the new cursor while has_more is true.
+    """
+    try:
+        cursor = parse_cursor(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync cursor")
+    
+    return await sync_service.changes_since(current_user['id'], cursor)
+
+
 # ===== Boost System =====
 
 
@@ -4410,7 +4508,8 @@ async def get_stories_feed(current_user: dict = Depends(get_current_user)):
         if user_id not in stories_by_user:
             stories_by_user[user_id] = []
         
-        # Check if current user has viewed this story
+        # Check if current user has viewed this story (views are write-behind)
+        story = counter_buffer.apply_pending("stories", {"id": story['id']}, story)
         story['viewed_by_me'] = current_user['id'] in story.get('views', [])
         stories_by_user[user_id].append(story)
     
@@ -4443,17 +4542,13 @@ async def view_story(
     current_user: dict = Depends(get_current_user)
 ):
     """Mark story as viewed"""
-    story = await db.stories.find_one({"id": story_id}, {"_id": 0})
+    story = await db.stories.find_one({"id": story_id}, {"_id": 1})
     
     if not story:
         raise HTTPException(status_code=404, detail="Story not found")
     
-    # Add user to views if not already viewed
-    if current_user['id'] not in story.get('views', []):
-        await db.stories.update_one(
-            {"id": story_id},
-            {"$push": {"views": current_user['id']}}
-        )
+    # Buffered $addToSet: repeat views are no-ops and a burst of views is one write
+    counter_buffer.add_to_set("stories", {"id": story_id}, "views", current_user['id'])
     
     return {"message": "Story viewed"}
 
@@ -4470,6 +4565,7 @@ async def get_user_stories(
         "expires_at": {"$gt": now.isoformat()}
     }, {"_id": 0}).sort("created_at", 1).to_list(length=100)
     
+    stories = [counter_buffer.apply_pending("stories", {"id": story['id']}, story) for story in stories]
     for story in stories:
         story['viewed_by_me'] = current_user['id'] in story.get('views', [])
     
@@ -4873,61 +4969,121 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # WebSocket Endpoint for Real-Time Chat
+async def get_match_user_ids(user_id: str) -> List[str]:
+    """Return the ids of everyone the user is currently matched with"""
+    matches = await db.matches.find(
+        {
+            "$or": [
+                {"user1_id": user_id},
+                {"user2_id": user_id}
+            ],
+            "unmatched": False
+        },
+        {"_id": 0, "user1_id": 1, "user2_id": 1}
+    ).to_list(length=None)
+    return [m['user2_id'] if m['user1_id'] == user_id else m['user1_id'] for m in matches]
+
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(user_id, websocket)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    user_id: str,
+    device_id: Optional[str] = None,
+    encoding: Optional[str] = None,
+    batch: bool = False,
+    acks: bool = False,
+    heartbeat: bool = False
+):
+    # Presence is scoped to matches: only they see this user come and go
+    match_user_ids = await get_match_user_ids(user_id)
+    # MessagePack via the pizoo.msgpack.v1 subprotocol (or ?encoding=msgpack), JSON otherwise
+    codec = negotiate_codec(websocket, encoding, batch)
+    # Clients pass a stable ?device_id= so a reconnect replaces only that device's socket
+    # ?acks=true: the client acks message ids and pending entries are kept until it does
+    # ?heartbeat=true: the client answers pings and is dropped after WS_IDLE_TIMEOUT of silence
+    connection = await manager.connect(
+        user_id, websocket, match_user_ids, device_id=device_id, codec=codec, acks=acks, heartbeat=heartbeat
+    )
     try:
+        # Everything missed while offline arrives as one batched frame
+        await delivery_queue.flush(user_id, connection)
+        
         while True:
             # Receive message from client
-            data = await websocket.receive_json()
+            data = await connection.receive()
+            connection.touch()
             
             message_type = data.get('type')
             
-            if message_type == 'message':
+            if message_type == 'ping':
+                connection.enqueue({
+                    'type': 'pong',
+                    'timestamp': datetime.now(timezone.utc).isoformat()
+                })
+            
+            elif message_type == 'pong':
+                # Heartbeat reply; touch() above already recorded it
+                pass
+            
+            elif message_type == 'ack':
+                # Client confirms receipt; drop those entries from its pending queue
+                await delivery_queue.ack(user_id, data.get('message_ids') or [])
+            
+            elif message_type == 'fetch_pending':
+                # Client asks for the next batch after a has_more=true frame
+                await delivery_queue.flush(user_id, connection)
+            
+            elif message_type == 'message':
                 # Send message to receiver
                 receiver_id = data.get('receiver_id')
+                message_id = str(uuid.uuid4())
+                created_at = datetime.now(timezone.utc).isoformat()
                 message_data = {
                     'type': 'new_message',
+                    'id': message_id,
                     'sender_id': user_id,
                     'message': data.get('message'),
                     'match_id': data.get('match_id'),
-                    'timestamp': datetime.now(timezone.utc).isoformat()
+                    'timestamp': created_at
                 }
                 
                 # Save to database
                 await db.messages.insert_one({
-                    'id': str(uuid.uuid4()),
+                    'id': message_id,
                     'match_id': data.get('match_id'),
                     'sender_id': user_id,
                     'receiver_id': receiver_id,
                     'content': data.get('message'),
                     'message_type': 'text',
                     'status': 'sent',
-                    'created_at': datetime.now(timezone.utc).isoformat()
+                    'created_at': created_at,
+                    'search_text': normalize_search_text(data.get('message')),
+                    'updated_at': datetime.now(timezone.utc)
                 })
                 
-                # Send to receiver if online
-                await manager.send_personal_message(message_data, receiver_id)
+                # Queue for the receiver; pushed now if online, on connect otherwise
+                await delivery_queue.deliver(receiver_id, message_id, message_data)
                 
                 # Send confirmation to sender
                 await manager.send_personal_message({
                     'type': 'message_sent',
+                    'id': message_id,
                     'success': True
                 }, user_id)
             
             elif message_type == 'typing':
-                # Broadcast typing indicator
-                receiver_id = data.get('receiver_id')
-                await manager.send_personal_message({
-                    'type': 'typing',
-                    'user_id': user_id,
-                    'is_typing': data.get('is_typing', True)
-                }, receiver_id)
+                # Coalesced into one start/stop pair per burst of keystrokes
+                await typing_coalescer.handle(
+                    connection,
+                    data.get('receiver_id'),
+                    bool(data.get('is_typing', True))
+                )
             
             elif message_type == 'read_receipt':
                 # Mark messages as read
                 match_id = data.get('match_id')
-                await db.messages.update_many(
+                read_at = datetime.now(timezone.utc).isoformat()
+                result = await db.messages.update_many(
                     {
                         'match_id': match_id,
                         'receiver_id': user_id,
@@ -4936,10 +5092,13 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                     {
                         '$set': {
                             'status': 'read',
-                            'read_at': datetime.now(timezone.utc).isoformat()
+                            'read_at': read_at
                         }
                     }
                 )
+                await retention_service.mark_archived_read(match_id, user_id)
+                if result.modified_count:
+                    await sync_service.touch_read_watermark(match_id, user_id, read_at)
                 
                 # Notify sender
                 sender_id = data.get('sender_id')
@@ -4950,15 +5109,60 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
                 }, sender_id)
     
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-        await manager.broadcast_status(user_id, False)
+        pass
     except Exception as e:
         logger.error(f"WebSocket error for user {user_id}: {str(e)}")
-        manager.disconnect(user_id)
+    finally:
+        # Only this socket is dropped; a newer connection for the user stays registered
+        if manager.disconnect(user_id, connection):
+            await typing_coalescer.clear_sender(user_id)
+            await manager.broadcast_status(user_id, False)
+        connection.cancel()
+
+@app.on_event("startup")
+async def start_realtime_services():
+    manager.start()
+    presence_store.start()
+    # On its own: leased jobs stay off until this unique index exists, whatever else fails
+    await job_leases.ensure_indexes()
+    try:
+        await delivery_queue.ensure_indexes()
+        await sync_service.ensure_indexes()
+        await ensure_search_indexes(db)
+        await retention_service.ensure_indexes()
+        await revoked_tokens.ensure_indexes()
+        await ensure_ephemeral_indexes(db)
+        await otp_store.ensure_indexes()
+        await bulk_invites.ensure_indexes()
+        await rate_limit_store.ensure_indexes()
+    except Exception as e:
+        logger.error(f"❌ Failed to create realtime indexes: {e}")
+    retention_service.start()
+    revoked_tokens.start()
+    otp_store.start()
+    bulk_invites.start()
+    email_queue.start()
+    notification_digest.start()
+    http_clients.start()
+    counter_buffer.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
+    await manager.stop()
+    await voice_uploads.stop()
+    await retention_service.stop()
+    password_hasher.shutdown()
+    await revoked_tokens.stop()
+    await otp_store.stop()
+    await bulk_invites.stop()
+    await notification_digest.stop()
+    await email_queue.stop()
+    await http_clients.close()
+    await counter_buffer.stop()
+    # Flush buffered last_seen writes before the client goes away
+    await presence_store.stop()
+    if client is not None:
+        client.close()
 
 
 # ===== Email Verification System =====
@@ -4976,7 +5180,7 @@ class VerifyOTPRequest(BaseModel):
 async def send_verification_otp(request: EmailVerificationRequest):
     """Send OTP to email for verification"""
     try:
-        success = email_service.send_verification_otp(request.email)
+        success = await email_service.send_verification_otp(request.email)
         
         if success:
             return {
@@ -4997,7 +5201,25 @@ async def send_verification_otp(request: EmailVerificationRequest):
 @api_router.post("/auth/verify-otp")
 async def verify_email_otp(request: VerifyOTPRequest):
     """Verify OTP code"""
-    is_valid = email_service.verify_otp(request.email, request.code)
+    is_valid = await email_service.verify_otp(request.email, request.code)
+    
+    if is_valid:
+        # Update user's email verification status
+        await db.users.update_one(
+            {"email": request.email},
+            {"$set": {"email_verified": True}}
+        )
+        user_cache.invalidate_by("email", request.email)
+        
+        return {
+            "message": "تم تأكيد بريدك الإلكتروني بنجاح",
+            "verified": True
+        }
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="رمز التحقق غير صحيح أو منتهي الصلاحية"
+        )
 
 
 # ========================================
@@ -5108,23 +5330,6 @@ async def get_email_service_status():
         "api_key_prefix": email_service.api_key[:8] + "..." if email_service.api_key else None
     }
 
-    
-    if is_valid:
-        # Update user's email verification status
-        await db.users.update_one(
-            {"email": request.email},
-            {"$set": {"email_verified": True}}
-        )
-        
-        return {
-            "message": "تم تأكيد بريدك الإلكتروني بنجاح",
-            "verified": True
-        }
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="رمز التحقق غير صحيح أو منتهي الصلاحية"
-        )
 
 @api_router.post("/notifications/email/test")
 async def test_email_notification(
@@ -5191,6 +5396,7 @@ async def update_user_language(
         {"id": current_user["id"]},
         {"$set": {"language": lang}}
     )
+    user_cache.invalidate(current_user["id"])
     
     return {"success": True, "language": lang}
 
@@ -5222,25 +5428,33 @@ async def get_current_user_info(
     }
 
 
+# e.g. https://ipapi.co/{ip}/json/ ; unset keeps the fixed testing default
+GEOIP_PROVIDER_URL = os.environ.get('GEOIP_PROVIDER_URL')
+http_clients.register('geoip')
+
+
 @api_router.get("/geoip")
 async def get_geoip_info(request: Request):
     """
     Get country from IP address (GeoIP fallback)
+    Uses GEOIP_PROVIDER_URL through the shared pooled client when configured
     For testing: returns default country (CH for Basel)
-    In production: integrate with ipapi.co or similar service
     """
     try:
         client_ip = request.client.host if request.client else "0.0.0.0"
         
-        # TODO: In production, call external GeoIP service
-        # Example: requests.get(f"https://ipapi.co/{client_ip}/json/")
-        # For now, return default for testing
         default_country = "CH"  # Basel, Switzerland for testing
+        country = default_country
+        if GEOIP_PROVIDER_URL:
+            response = await http_clients.get('geoip').get(GEOIP_PROVIDER_URL.format(ip=client_ip))
+            if response.status_code == 200:
+                data = response.json()
+                country = data.get("country_code") or data.get("countryCode") or data.get("country") or default_country
         
         return {
             "ip": client_ip,
-            "country": default_country,
-            "defaultRadius": radius_for_country(default_country)
+            "country": country,
+            "defaultRadius": radius_for_country(country)
         }
     except Exception as e:
         # Fallback to global default
@@ -5289,6 +5503,7 @@ async def update_user_location(
                 {"id": current_user["id"]},
                 {"$set": {"country": country.upper()}}
             )
+            user_cache.invalidate(current_user["id"])
         
         # Update profile location
         profile = await db.profiles.find_one({"user_id": current_user["id"]})
@@ -5449,6 +5664,7 @@ async def update_user_settings(payload: dict, current_user: dict = Depends(get_c
                 {"id": current_user["id"]},
                 {"$set": {"safetyAccepted": bool(safety_accepted)}}
             )
+            user_cache.invalidate(current_user["id"])
         
         return {"ok": True, "message": "Settings updated successfully"}
     except Exception as e:
@@ -5488,20 +5704,41 @@ def today_str():
 DEFAULT_VIEW_LIMIT = 20
 DEFAULT_LIKE_LIMIT = 10
 
+# Day documents are reaped by a TTL index on expire_at (see ephemeral_store.py)
+USAGE_RETENTION_DAYS = int(os.environ.get('USAGE_RETENTION_DAYS', '2'))
+
+def is_premium_user(user: dict) -> bool:
+    return user.get('premium_tier') in ['gold', 'platinum', 'plus']
+
 async def get_usage(user_id: str):
-    """Get or create today's usage document for user"""
+    """Today's usage for user (zeros when nothing was counted yet; never writes)"""
     day = today_str()
-    doc = await db.user_usage.find_one({"user_id": user_id, "day": day})
-    if not doc:
-        doc = {
-            "id": str(uuid.uuid4()),
-            "user_id": user_id,
-            "day": day,
-            "views": 0,
-            "likes": 0
-        }
-        await db.user_usage.insert_one(doc)
-    return doc
+    query = {"user_id": user_id, "day": day}
+    doc = await db.user_usage.find_one(query, {"_id": 0})
+    # Premium counts are write-behind; include the ones not flushed yet
+    doc = counter_buffer.apply_pending("user_usage", query, doc)
+    return doc or {"user_id": user_id, "day": day, "views": 0, "likes": 0}
+
+async def increment_usage(user_id: str, field: str, limit: Optional[int] = None) -> bool:
+    """
+    Count one view/like in a single atomic upsert; with a limit, returns False
+    instead of counting once the limit is reached (see consume_capped).
+    Without a limit nothing depends on the result, so the count is buffered
+    and written behind (see counter_service.py).
+    """
+    day = today_str()
+    query = {"user_id": user_id, "day": day}
+    other = "likes" if field == "views" else "views"
+    day_start = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    on_insert = {
+        "id": str(uuid.uuid4()),
+        other: 0,
+        "expire_at": day_start + timedelta(days=USAGE_RETENTION_DAYS)
+    }
+    if limit is None:
+        counter_buffer.inc("user_usage", query, {field: 1}, upsert=True, on_insert=on_insert)
+        return True
+    return await consume_capped(db.user_usage, query, field, limit, on_insert) is not None
 
 @api_router.get("/usage/context")
 async def usage_context(current_user: dict = Depends(get_current_user)):
@@ -5510,10 +5747,7 @@ async def usage_context(current_user: dict = Depends(get_current_user)):
         usage = await get_usage(current_user["id"])
         
         # Premium users have no limits
-        user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0, "premium_tier": 1})
-        is_premium = user and user.get('premium_tier') in ['gold', 'platinum', 'plus']
-        
-        if is_premium:
+        if is_premium_user(current_user):
             return {
                 "day": usage["day"],
                 "views": usage["views"],
@@ -5545,50 +5779,22 @@ class UsageIncrementPayload(BaseModel):
 async def usage_increment(payload: UsageIncrementPayload, current_user: dict = Depends(get_current_user)):
     """Increment usage counter for views or likes"""
     try:
-        # Premium users bypass limits
-        user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0, "premium_tier": 1})
-        is_premium = user and user.get('premium_tier') in ['gold', 'platinum', 'plus']
-        
-        if is_premium:
-            # Still track usage but don't enforce limits
-            usage = await get_usage(current_user["id"])
-            if payload.kind == 'view':
-                await db.user_usage.update_one(
-                    {"id": usage["id"]}, 
-                    {"$inc": {"views": 1}}
-                )
-            elif payload.kind == 'like':
-                await db.user_usage.update_one(
-                    {"id": usage["id"]}, 
-                    {"$inc": {"likes": 1}}
-                )
-            return {"ok": True, "premium": True}
+        if payload.kind not in ('view', 'like'):
+            raise HTTPException(status_code=400, detail="Invalid kind. Must be 'view' or 'like'")
+        field = "views" if payload.kind == 'view' else "likes"
         
-        # For free users, check and enforce limits
-        usage = await get_usage(current_user["id"])
+        # Premium users bypass limits (usage is still tracked)
+        if is_premium_user(current_user):
+            await increment_usage(current_user["id"], field)
+            return {"ok": True, "premium": True}
         
-        if payload.kind == 'view':
-            if usage["views"] >= DEFAULT_VIEW_LIMIT:
-                raise HTTPException(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS, 
-                    detail="view_limit_reached"
-                )
-            await db.user_usage.update_one(
-                {"id": usage["id"]}, 
-                {"$inc": {"views": 1}}
-            )
-        elif payload.kind == 'like':
-            if usage["likes"] >= DEFAULT_LIKE_LIMIT:
-                raise HTTPException(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS, 
-                    detail="like_limit_reached"
-                )
-            await db.user_usage.update_one(
-                {"id": usage["id"]}, 
-                {"$inc": {"likes": 1}}
+        # For free users, the limit is enforced by the same single operation
+        limit = DEFAULT_VIEW_LIMIT if field == "views" else DEFAULT_LIKE_LIMIT
+        if not await increment_usage(current_user["id"], field, limit):
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS, 
+                detail=f"{payload.kind}_limit_reached"
             )
-        else:
-            raise HTTPException(status_code=400, detail="Invalid kind. Must be 'view' or 'like'")
         
         return {"ok": True, "premium": False}
     except HTTPException:
@@ -5617,6 +5823,7 @@ async def update_user_language(payload: LanguagePayload, current_user: dict = De
             {"id": current_user["id"]},
             {"$set": {"language": lang}}
         )
+        user_cache.invalidate(current_user["id"])
         
         return {"ok": True, "language": lang}
     except Exception as e:
@@ -5979,15 +6186,12 @@ async def ai_match_profiles(
             score += location_score
             
             # 4. Activity Level (10% weight)
-            user_last_active = user_profile.get('lastActive', datetime.now(timezone.utc))
-            profile_last_active = profile.get('lastActive', datetime.now(timezone.utc))
-            if isinstance(profile_last_active, str):
-                try:
-                    profile_last_active = datetime.fromisoformat(profile_last_active.replace('Z', '+00:00'))
-                except:
-                    profile_last_active = datetime.now(timezone.utc)
-            
-            hours_since_active = (datetime.now(timezone.utc) - profile_last_active).total_seconds() / 3600
+            # Live presence first, then the persisted last_seen; no data means inactive
+            profile_last_active = presence_store.last_seen_for(profile.get('id'), profile)
+            if profile_last_active is None:
+                hours_since_active = float('inf')
+            else:
+                hours_since_active = (datetime.now(timezone.utc) - profile_last_active).total_seconds() / 3600
             if hours_since_active < 24:
                 activity_score = 10
                 reasons.append("Active today")
@@ -6141,6 +6345,29 @@ async def admin_stats():
         raise HTTPException(status_code=500, detail="Failed to retrieve statistics")
 
 
+@api_router.get("/admin/metrics", dependencies=[Depends(require_admin)])
+async def admin_metrics():
+    """Runtime metrics for this worker (queues, caches, background services); requires X-Admin-Key"""
+    return {
+        "websocket": {**manager.stats(), **typing_coalescer.stats()},
+        "presence": presence_store.stats(),
+        "delivery": delivery_queue.stats(),
+        "voice_uploads": voice_uploads.stats(),
+        "retention": retention_service.stats(),
+        "user_cache": user_cache.stats(),
+        "password_hashing": password_hasher.stats(),
+        "token_cache": token_cache.stats(),
+        "otp_store": otp_store.stats(),
+        "sms": sms_dispatcher.stats(),
+        "bulk_invites": bulk_invites.stats(),
+        "email": email_queue.stats(),
+        "notification_digest": notification_digest.stats(),
+        "http_clients": http_clients.stats(),
+        "rate_limits": rate_limit_store.stats(),
+        "counters": counter_buffer.stats()
+    }
+
+
 # Mount the API router
 app.include_router(api_router)
 
@@ -8,9 +8,13 @@ import random
 import time
 import hashlib
 import hmac
-import json
-import urllib.request
+import asyncio
 import re
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from http_clients import http_clients
 
 # Configuration
 PROVIDER = os.getenv("SMS_PROVIDER", "mock")  # mock | twilio | telnyx
@@ -27,6 +31,38 @@ ALPHA_ALLOWED = set([
     if os.getenv("ALPHA_ALLOWED_COUNTRIES") else [])
 ])
 
+# Base URLs are configurable so tests can point the dispatcher at a local mock provider
+TELNYX_BASE_URL = os.getenv("TELNYX_BASE_URL", "https://api.telnyx.com")
+TWILIO_BASE_URL = os.getenv("TWILIO_BASE_URL", "https://api.twilio.com")
+
+SMS_TIMEOUT = httpx.Timeout(
+    float(os.getenv("SMS_TIMEOUT_SECONDS", "10")),
+    connect=float(os.getenv("SMS_CONNECT_TIMEOUT_SECONDS", "3"))
+)
+SMS_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("SMS_MAX_CONNECTIONS", "20")),
+    max_keepalive_connections=int(os.getenv("SMS_MAX_KEEPALIVE", "10"))
+)
+SMS_MAX_RETRIES = int(os.getenv("SMS_MAX_RETRIES", "3"))
+SMS_RETRY_BASE_SECONDS = float(os.getenv("SMS_RETRY_BASE_SECONDS", "0.5"))
+SMS_RETRY_QUEUE_MAX = int(os.getenv("SMS_RETRY_QUEUE_MAX", "100"))
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+http_clients.register(
+    "telnyx",
+    base_url=TELNYX_BASE_URL,
+    headers={"Authorization": f"Bearer {TELNYX_API_KEY}"},
+    timeout=SMS_TIMEOUT,
+    limits=SMS_POOL_LIMITS
+)
+http_clients.register(
+    "twilio",
+    base_url=TWILIO_BASE_URL,
+    auth=(TWILIO_SID or "", TWILIO_TOKEN or ""),
+    timeout=SMS_TIMEOUT,
+    limits=SMS_POOL_LIMITS
+)
+
 OTP_TTL = int(os.getenv("OTP_TTL_SECONDS", "300"))  # 5 minutes
 OTP_MAX = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
 
@@ -93,103 +129,192 @@ def _country_from_e164(phone: str) -> str:
     return ""
 
 
-def _send_twilio(phone, message):
-    """Send SMS via Twilio"""
-    try:
-        from twilio.rest import Client
-        client = Client(TWILIO_SID, TWILIO_TOKEN)
-        client.messages.create(
-            from_=TWILIO_FROM,
-            to=phone,
-            body=message
-        )
-        print(f"✅ Twilio SMS sent to {phone}")
-        return True
-    except Exception as e:
-        print(f"❌ Twilio error: {e}")
-        return False
-
-
-def _send_telnyx(phone, message, use_alpha=False):
+# Awaited before each provider request (e.g. a token bucket's acquire)
+Throttle = Callable[[], Awaitable[None]]
+
+
+class SMSDispatcher:
     """
-    Send SMS via Telnyx
-    Args:
-        phone: E.164 format phone number
-        message: SMS text content
-        use_alpha: Use alphanumeric sender ID instead of numeric
+    Sends SMS through the shared pooled client of each provider, so OTP sends
+    never block the event loop and reuse warm TLS connections. Timeouts,
+    connection errors, 429 and 5xx are retried with jittered exponential
+    backoff; at most SMS_RETRY_QUEUE_MAX sends may be waiting on a retry at
+    once, beyond that a failure is returned immediately instead of piling up.
+    An optional `throttle` coroutine is awaited before every HTTP attempt
+    (retries and the alphanumeric fallback included), so callers with a
+    provider rate limit pay for each request actually made.
     """
-    try:
-        url = "https://api.telnyx.com/v2/messages"
-        req = urllib.request.Request(url, method="POST")
-        req.add_header("Authorization", f"Bearer {TELNYX_API_KEY}")
-        req.add_header("Content-Type", "application/json")
-        
+
+    def __init__(self):
+        self._retrying = 0
+        self._metrics: Dict[str, dict] = {}
+        self.stats_counters = {
+            'retry_queue_full': 0,
+        }
+
+    def _record(self, provider: str, latency: float, ok: bool, status_code: Optional[int]):
+        metrics = self._metrics.setdefault(provider, {
+            'requests': 0,
+            'failures': 0,
+            'retries': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+            'last_status': None,
+        })
+        metrics['requests'] += 1
+        metrics['latency_total'] += latency
+        metrics['latency_max'] = max(metrics['latency_max'], latency)
+        metrics['last_status'] = status_code
+        if not ok:
+            metrics['failures'] += 1
+
+    async def _request(self, provider: str, send, throttle: Optional[Throttle] = None) -> Optional[httpx.Response]:
+        """One HTTP attempt; returns the response, or None on a transport error"""
+        if throttle is not None:
+            await throttle()
+        started = time.monotonic()
+        try:
+            response = await send(http_clients.get(provider))
+        except httpx.HTTPError as e:
+            self._record(provider, time.monotonic() - started, False, None)
+            print(f"❌ {provider} transport error: {e!r}")
+            return None
+        self._record(provider, time.monotonic() - started, response.is_success, response.status_code)
+        return response
+
+    async def _send_with_retry(self, provider: str, send, throttle: Optional[Throttle] = None) -> bool:
+        attempt = 0
+        retrying = False
+        try:
+            while True:
+                response = await self._request(provider, send, throttle)
+                if response is not None and response.is_success:
+                    return True
+                retryable = response is None or response.status_code in RETRYABLE_STATUS
+                if not retryable:
+                    print(f"❌ {provider} rejected SMS: {response.status_code} {response.text[:200]}")
+                    return False
+                if attempt >= SMS_MAX_RETRIES:
+                    return False
+                if not retrying:
+                    if self._retrying >= SMS_RETRY_QUEUE_MAX:
+                        self.stats_counters['retry_queue_full'] += 1
+                        return False
+                    self._retrying += 1
+                    retrying = True
+                delay = SMS_RETRY_BASE_SECONDS * (2 ** attempt)
+                await asyncio.sleep(random.uniform(0, delay))  # full jitter
+                attempt += 1
+                self._metrics[provider]['retries'] += 1
+        finally:
+            if retrying:
+                self._retrying -= 1
+
+    async def _send_twilio(self, phone: str, message: str, throttle: Optional[Throttle] = None) -> bool:
+        """Send SMS via Twilio REST API"""
+        ok = await self._send_with_retry("twilio", lambda client: client.post(
+            f"/2010-04-01/Accounts/{TWILIO_SID}/Messages.json",
+            data={"From": TWILIO_FROM, "To": phone, "Body": message}
+        ), throttle)
+        if ok:
+            print(f"✅ Twilio SMS sent to {phone}")
+        return ok
+
+    async def _send_telnyx(self, phone: str, message: str, use_alpha: bool = False,
+                           throttle: Optional[Throttle] = None) -> bool:
+        """
+        Send SMS via Telnyx
+        Args:
+            phone: E.164 format phone number
+            message: SMS text content
+            use_alpha: Use alphanumeric sender ID instead of numeric
+            throttle: Awaited before each HTTP attempt
+        """
         # Choose sender: alphanumeric or numeric
         sender = ALPHA_SENDER if use_alpha else TELNYX_FROM
+        ok = await self._send_with_retry("telnyx", lambda client: client.post(
+            "/v2/messages",
+            json={"from": sender, "to": phone, "text": message}
+        ), throttle)
+        if ok:
+            sender_type = "alphanumeric" if use_alpha else "numeric"
+            print(f"✅ Telnyx SMS sent to {phone} from {sender} ({sender_type})")
+        return ok
+
+    async def send(self, phone: str, message: str, throttle: Optional[Throttle] = None) -> bool:
+        """
+        Send SMS via configured provider with intelligent sender selection
         
-        body = json.dumps({
-            "from": sender,
-            "to": phone,
-            "text": message
-        }).encode()
-        
-        with urllib.request.urlopen(req, body) as resp:
-            success = 200 <= resp.getcode() < 300
-            if success:
-                sender_type = "alphanumeric" if use_alpha else "numeric"
-                print(f"✅ Telnyx SMS sent to {phone} from {sender} ({sender_type})")
-            return success
-    except Exception as e:
-        print(f"❌ Telnyx error: {e}")
-        return False
-
-
-def send_sms(phone: str, message: str) -> bool:
-    """
-    Send SMS via configured provider with intelligent sender selection
-    
-    For Telnyx:
-    - Automatically uses alphanumeric sender ID in supported countries
-    - Falls back to numeric sender if alphanumeric fails or not allowed
-    - US/CA always use numeric sender (alphanumeric not supported)
-    """
-    if PROVIDER == "twilio":
-        return _send_twilio(phone, message)
-    
-    elif PROVIDER == "telnyx":
-        # Detect country from phone number
-        country = _country_from_e164(phone)
-        
-        # Check if alphanumeric sender is allowed
-        # US and CA don't support alphanumeric senders
-        can_alpha = (
-            country in ALPHA_ALLOWED 
-            and country not in {"US", "CA"} 
-            and ALPHA_SENDER 
-            and len(ALPHA_SENDER) > 0
-        )
+        For Telnyx:
+        - Automatically uses alphanumeric sender ID in supported countries
+        - Falls back to numeric sender if alphanumeric fails or not allowed
+        - US/CA always use numeric sender (alphanumeric not supported)
+        """
+        if PROVIDER == "twilio":
+            return await self._send_twilio(phone, message, throttle)
         
-        if can_alpha:
-            # Try alphanumeric first
-            ok = _send_telnyx(phone, message, use_alpha=True)
+        elif PROVIDER == "telnyx":
+            # Detect country from phone number
+            country = _country_from_e164(phone)
             
-            if not ok:
-                # Automatic fallback to numeric sender
-                print(f"⚠️  Alphanumeric failed, falling back to numeric sender for {phone}")
-                ok = _send_telnyx(phone, message, use_alpha=False)
+            # Check if alphanumeric sender is allowed
+            # US and CA don't support alphanumeric senders
+            can_alpha = (
+                country in ALPHA_ALLOWED 
+                and country not in {"US", "CA"} 
+                and ALPHA_SENDER 
+                and len(ALPHA_SENDER) > 0
+            )
             
-            return ok
+            if can_alpha:
+                # Try alphanumeric first
+                ok = await self._send_telnyx(phone, message, use_alpha=True, throttle=throttle)
+                
+                if not ok:
+                    # Automatic fallback to numeric sender
+                    print(f"⚠️  Alphanumeric failed, falling back to numeric sender for {phone}")
+                    ok = await self._send_telnyx(phone, message, use_alpha=False, throttle=throttle)
+                
+                return ok
+            else:
+                # Use numeric sender directly
+                return await self._send_telnyx(phone, message, use_alpha=False, throttle=throttle)
+        
         else:
-            # Use numeric sender directly
-            return _send_telnyx(phone, message, use_alpha=False)
-    
-    else:
-        # Mock mode
-        print(f"[MOCK SMS] to={phone} msg={message}")
-        return True
+            # Mock mode
+            print(f"[MOCK SMS] to={phone} msg={message}")
+            return True
+
+    def stats(self) -> dict:
+        providers = {}
+        for provider, metrics in self._metrics.items():
+            requests = metrics['requests']
+            providers[provider] = {
+                'requests': requests,
+                'failures': metrics['failures'],
+                'retries': metrics['retries'],
+                'avg_latency_ms': round(metrics['latency_total'] / requests * 1000, 2) if requests else None,
+                'max_latency_ms': round(metrics['latency_max'] * 1000, 2),
+                'last_status': metrics['last_status'],
+            }
+        return {
+            'provider': PROVIDER,
+            'retrying': self._retrying,
+            'retry_queue_max': SMS_RETRY_QUEUE_MAX,
+            'providers': providers,
+            **self.stats_counters,
+        }
+
+
+sms_dispatcher = SMSDispatcher()
+
+
+async def send_sms(phone: str, message: str, throttle: Optional[Throttle] = None) -> bool:
+    """Send SMS via the shared dispatcher; `throttle` is awaited before each provider request"""
+    return await sms_dispatcher.send(phone, message, throttle)
 
 
-def generate_and_send(phone, lang="en"):
+async def generate_and_send(phone, lang="en"):
     """
     Generate OTP and send via SMS with language-aware message
     
@@ -222,7 +347,7 @@ def generate_and_send(phone, lang="en"):
     code = _otp(6)
     message = template.format(code)
     
-    ok = send_sms(phone, message)
+    ok = await send_sms(phone, message)
     
     if not ok:
         return None
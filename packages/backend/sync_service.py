@@ -0,0 +1,201 @@
+"""
+Sync Service for Pizoo Dating App
+Delta sync of messages, read watermarks, notifications and matches since a cursor
+"""
+
+import os
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# Max documents per collection in one /api/sync response
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', '200'))
+# Deletions are kept this long; clients offline for longer must do a full reload
+SYNC_TOMBSTONE_TTL_DAYS = int(os.environ.get('SYNC_TOMBSTONE_TTL_DAYS', '30'))
+
+# Response sections in cursor order: changes sharing an updated_at are ordered
+# by section, then by _id, so a page can stop between two of them
+SECTIONS = ('messages', 'notifications', 'matches', 'read_watermarks', 'deleted')
+
+# (updated_at, section index, _id) of the newest change the client has seen;
+# a bare-timestamp cursor uses section len(SECTIONS), after every section at that time
+Cursor = Tuple[datetime, int, Optional[ObjectId]]
+
+
+def parse_cursor(since: Optional[str]) -> Optional[Cursor]:
+    """
+    Cursor is "<ISO updated_at>|<section>|<_id>" as returned by the previous
+    sync. A bare ISO timestamp (older clients) means "everything after it".
+    """
+    if not since:
+        return None
+    timestamp, _, position = since.partition('|')
+    try:
+        updated_at = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        if position:
+            section, doc_id = position.split('|')
+            cursor = (updated_at, int(section), ObjectId(doc_id))
+        else:
+            cursor = (updated_at, len(SECTIONS), None)
+    except (ValueError, InvalidId):
+        raise ValueError("Invalid sync cursor")
+    if updated_at.tzinfo is None:
+        cursor = (updated_at.replace(tzinfo=timezone.utc),) + cursor[1:]
+    return cursor
+
+
+def format_cursor(cursor: Cursor) -> str:
+    updated_at, section, doc_id = cursor
+    if doc_id is None:
+        return updated_at.isoformat()
+    return f"{updated_at.isoformat()}|{section}|{doc_id}"
+
+
+def _as_utc(value: datetime) -> datetime:
+    # Motor returns naive UTC datetimes by default
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _serialize(doc: dict) -> dict:
+    return {k: (_as_utc(v).isoformat() if isinstance(v, datetime) else v) for k, v in doc.items()}
+
+
+class SyncService:
+    """
+    Every synced document carries an indexed `updated_at` (BSON datetime) that is
+    bumped on each change, so a sync is a handful of range scans whose cost
+    depends on how much changed rather than on history size. Deletions are
+    recorded as short-lived tombstones.
+    """
+
+    def __init__(self):
+        self._db = None
+
+    def configure(self, db):
+        self._db = db
+
+    async def ensure_indexes(self):
+        if self._db is None:
+            return
+        await self._db.messages.create_index([('sender_id', 1), ('updated_at', 1)])
+        await self._db.messages.create_index([('receiver_id', 1), ('updated_at', 1)])
+        await self._db.notifications.create_index([('user_id', 1), ('updated_at', 1)])
+        await self._db.matches.create_index([('user1_id', 1), ('updated_at', 1)])
+        await self._db.matches.create_index([('user2_id', 1), ('updated_at', 1)])
+        await self._db.read_watermarks.create_index([('match_id', 1), ('reader_id', 1)], unique=True)
+        await self._db.read_watermarks.create_index([('match_id', 1), ('updated_at', 1)])
+        await self._db.sync_tombstones.create_index([('user_id', 1), ('updated_at', 1)])
+        await self._db.sync_tombstones.create_index('expire_at', expireAfterSeconds=0)
+
+    # ===== Writers =====
+
+    async def touch_read_watermark(self, match_id: str, reader_id: str, read_at: Optional[str] = None):
+        """Record that reader_id has read everything in match_id up to read_at"""
+        if self._db is None or not match_id:
+            return
+        now = datetime.now(timezone.utc)
+        await self._db.read_watermarks.update_one(
+            {'match_id': match_id, 'reader_id': reader_id},
+            {'$set': {'read_at': read_at or now.isoformat(), 'updated_at': now}},
+            upsert=True
+        )
+
+    async def record_tombstones(self, entries: Iterable[Tuple[str, str, str]]):
+        """
+        Record deletions as (user_id, kind, id) so syncing clients can drop them.
+        They all share one updated_at; the sync cursor's _id tiebreak pages through them.
+        """
+        if self._db is None:
+            return
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {'user_id': user_id, 'kind': kind, 'id': doc_id},
+                {'$set': {
+                    'updated_at': now,
+                    'expire_at': now + timedelta(days=SYNC_TOMBSTONE_TTL_DAYS)
+                }},
+                upsert=True
+            )
+            for user_id, kind, doc_id in entries
+        ]
+        if operations:
+            await self._db.sync_tombstones.bulk_write(operations, ordered=False)
+
+    # ===== Reader =====
+
+    async def _changed(self, collection, query: dict, section: int,
+                       since: Optional[Cursor]) -> Tuple[List[dict], bool]:
+        if since is None:
+            position = {'updated_at': {'$exists': True}}
+        else:
+            updated_at, since_section, since_id = since
+            if section > since_section:
+                position = {'updated_at': {'$gte': updated_at}}
+            elif section < since_section:
+                position = {'updated_at': {'$gt': updated_at}}
+            else:
+                position = {'$or': [
+                    {'updated_at': {'$gt': updated_at}},
+                    {'updated_at': updated_at, '_id': {'$gt': since_id}},
+                ]}
+        # search_text only exists on messages; it is an index field, not content
+        docs = await collection.find({'$and': [query, position]}, {'search_text': 0}).sort(
+            [('updated_at', 1), ('_id', 1)]
+        ).limit(SYNC_PAGE_SIZE + 1).to_list(length=None)
+        return docs[:SYNC_PAGE_SIZE], len(docs) > SYNC_PAGE_SIZE
+
+    async def changes_since(self, user_id: str, since: Optional[Cursor]) -> dict:
+        db = self._db
+        match_ids = await db.matches.distinct(
+            'id', {'$or': [{'user1_id': user_id}, {'user2_id': user_id}]}
+        )
+        queries = {
+            'messages': (db.messages, {'$or': [{'sender_id': user_id}, {'receiver_id': user_id}]}),
+            'notifications': (db.notifications, {'user_id': user_id}),
+            'matches': (db.matches, {'$or': [{'user1_id': user_id}, {'user2_id': user_id}]}),
+            'read_watermarks': (db.read_watermarks, {'match_id': {'$in': match_ids}}),
+            'deleted': (db.sync_tombstones, {'user_id': user_id}),
+        }
+        sections = {}
+        for index, name in enumerate(SECTIONS):
+            collection, query = queries[name]
+            sections[name] = await self._changed(collection, query, index, since)
+
+        def position(index: int, doc: dict) -> Cursor:
+            return _as_utc(doc['updated_at']), index, doc['_id']
+
+        # When a section is truncated, stop the cursor at its last document and
+        # hold back later documents of other sections; they come next round
+        truncated_at = [
+            position(index, sections[name][0][-1])
+            for index, name in enumerate(SECTIONS) if sections[name][1]
+        ]
+        limit = min(truncated_at) if truncated_at else None
+
+        response = {}
+        cursor = since
+        for index, name in enumerate(SECTIONS):
+            docs, _ = sections[name]
+            kept = [d for d in docs if limit is None or position(index, d) <= limit]
+            if kept:
+                # Sorted by (updated_at, _id), so the last kept document is the newest
+                last = position(index, kept[-1])
+                if cursor is None or last > cursor:
+                    cursor = last
+            if name == 'deleted':
+                kept = [{'kind': d['kind'], 'id': d['id']} for d in kept]
+            response[name] = [_serialize({k: v for k, v in d.items() if k != '_id'}) for d in kept]
+
+        response['cursor'] = format_cursor(cursor) if cursor else None
+        response['has_more'] = bool(truncated_at)
+        return response
+
+
+sync_service = SyncService()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Test Async SMS Dispatcher
+Runs the dispatcher against a local mock Telnyx server: retries, fallback, metrics
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Dispatcher config for the mock provider; applied by the test before sms_service is imported
+TEST_ENV = {
+    "SMS_PROVIDER": "telnyx",
+    "TELNYX_API_KEY": "test-key",
+    "TELNYX_FROM": "+15550000000",
+    "ALPHA_SENDER_ID": "PIZOO",
+    "ALPHA_ALLOWED_COUNTRIES": "AE",
+    "SMS_RETRY_BASE_SECONDS": "0.01",
+    "SMS_MAX_RETRIES": "3",
+}
+
+
+class MockTelnyx(BaseHTTPRequestHandler):
+    """Answers /v2/messages from a script of status codes, then 200"""
+
+    script = []
+    received = []
+    delay = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        MockTelnyx.received.append(body)
+        time.sleep(MockTelnyx.delay)
+        code = MockTelnyx.script.pop(0) if MockTelnyx.script else 200
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b'{"data": {}}')
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    # The default listen backlog (5) resets connections when check 5 opens ten at once
+    request_queue_size = 64
+
+
+def reset(script, delay=0.0):
+    MockTelnyx.script = list(script)
+    MockTelnyx.received = []
+    MockTelnyx.delay = delay
+
+
+async def run_checks() -> bool:
+    from sms_service import sms_dispatcher, generate_and_send
+    from http_clients import http_clients
+
+    ok = True
+
+    print("\n1️⃣ Plain send...")
+    reset([])
+    sent = await sms_dispatcher.send("+15551234567", "hello")
+    ok &= sent and len(MockTelnyx.received) == 1
+    print(f"   {'✅' if sent else '❌'} sent={sent}, requests={len(MockTelnyx.received)}")
+
+    print("\n2️⃣ Retries 503/429 with backoff...")
+    reset([503, 429])
+    sent = await sms_dispatcher.send("+15551234567", "retry me")
+    ok &= sent and len(MockTelnyx.received) == 3
+    print(f"   {'✅' if sent else '❌'} sent={sent}, requests={len(MockTelnyx.received)}")
+
+    print("\n3️⃣ Gives up after SMS_MAX_RETRIES...")
+    reset([500] * 10)
+    sent = await sms_dispatcher.send("+15551234567", "never")
+    ok &= (not sent) and len(MockTelnyx.received) == 4
+    print(f"   {'✅' if not sent else '❌'} sent={sent}, requests={len(MockTelnyx.received)}")
+
+    print("\n4️⃣ Alphanumeric rejected -> numeric fallback (no retry on 4xx)...")
+    reset([422])
+    sent = await sms_dispatcher.send("+971501234567", "fallback")
+    senders = [r["from"] for r in MockTelnyx.received]
+    ok &= sent and senders == ["PIZOO", "+15550000000"]
+    print(f"   {'✅' if sent else '❌'} sent={sent}, senders={senders}")
+
+    print("\n4️⃣b Throttle is awaited once per provider request...")
+    reset([422])
+    throttled = 0
+
+    async def throttle():
+        nonlocal throttled
+        throttled += 1
+
+    sent = await sms_dispatcher.send("+971501234567", "fallback", throttle=throttle)
+    ok &= sent and throttled == len(MockTelnyx.received) == 2
+    print(f"   {'✅' if throttled == 2 else '❌'} throttled={throttled}, requests={len(MockTelnyx.received)}")
+
+    print("\n5️⃣ Concurrent OTP sends do not block the event loop...")
+    reset([], delay=0.2)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    tick_task = asyncio.create_task(ticker())
+    started = time.monotonic()
+    packs = await asyncio.gather(*[generate_and_send(f"+1555123{i:04d}") for i in range(10)])
+    elapsed = time.monotonic() - started
+    tick_task.cancel()
+    ok &= all(packs) and elapsed < 1.0 and ticks > 10
+    print(f"   {'✅' if all(packs) else '❌'} 10 sends in {elapsed:.2f}s, loop ticks meanwhile: {ticks}")
+
+    stats = sms_dispatcher.stats()
+    print(f"\n📊 Metrics: {json.dumps(stats['providers'])}")
+    ok &= stats['providers']['telnyx']['retries'] == 5
+
+    await http_clients.close()
+    return ok
+
+
+def run_sms_dispatcher_checks() -> bool:
+    """Start the mock provider and run the dispatcher against it; True if every check passed"""
+    print("🧪 Testing async SMS dispatcher...")
+    print("=" * 60)
+
+    server = MockServer(("127.0.0.1", 0), MockTelnyx)
+    env = {**TEST_ENV, "TELNYX_BASE_URL": f"http://127.0.0.1:{server.server_address[1]}"}
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        ok = asyncio.run(run_checks())
+    finally:
+        server.shutdown()
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    print("\n" + "=" * 60)
+    print("✅ All SMS dispatcher checks passed" if ok else "❌ SMS dispatcher checks failed")
+    return ok
+
+
+def test_sms_dispatcher():
+    assert run_sms_dispatcher_checks(), "SMS dispatcher checks failed (see output above)"
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_sms_dispatcher_checks() else 1)
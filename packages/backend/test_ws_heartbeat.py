@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Test WebSocket Heartbeats
+Idle eviction only applies to clients that opted into answering pings (?heartbeat=true)
+"""
+
+import sys
+import asyncio
+
+import realtime_service
+from realtime_service import ConnectionManager
+
+
+class FakeWebSocket:
+    """Accepts everything and records frames; the client on the other end never sends"""
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, payload):
+        self.sent.append(payload)
+
+    async def send_bytes(self, payload):
+        self.sent.append(payload)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+async def run_checks():
+    realtime_service.WS_IDLE_TIMEOUT = 0.05
+    manager = ConnectionManager()
+
+    print("\n1️⃣ Silent legacy client stays connected...")
+    legacy_ws = FakeWebSocket()
+    legacy = await manager.connect("legacy-user", legacy_ws, device_id="web")
+    await asyncio.sleep(0.1)
+    await manager._heartbeat()
+    await asyncio.sleep(0.01)
+    assert manager.get_connections("legacy-user") == [legacy], "silent legacy client was evicted"
+    assert legacy_ws.closed_with is None
+    assert any('"ping"' in frame for frame in legacy_ws.sent), "legacy client was not pinged"
+    print(f"   ✅ still connected, pings sent: {sum('ping' in frame for frame in legacy_ws.sent)}")
+
+    print("\n2️⃣ Silent ?heartbeat=true client is evicted...")
+    hb_ws = FakeWebSocket()
+    await manager.connect("hb-user", hb_ws, device_id="app", heartbeat=True)
+    await asyncio.sleep(0.1)
+    await manager._heartbeat()
+    assert manager.get_connections("hb-user") == [], "idle heartbeat client was kept"
+    assert hb_ws.closed_with is not None
+    print(f"   ✅ evicted with close code {hb_ws.closed_with}")
+
+    print("\n3️⃣ ?heartbeat=true client answering pings stays...")
+    live_ws = FakeWebSocket()
+    live = await manager.connect("live-user", live_ws, device_id="app", heartbeat=True)
+    await asyncio.sleep(0.1)
+    live.touch()
+    await manager._heartbeat()
+    assert manager.get_connections("live-user") == [live], "responsive heartbeat client was evicted"
+    print("   ✅ still connected")
+
+    print("\n4️⃣ Legacy client whose writes fail is evicted...")
+    legacy.closed = True
+    await manager._heartbeat()
+    assert manager.get_connections("legacy-user") == [], "dead legacy client was kept"
+    print("   ✅ evicted")
+
+    await manager.stop()
+
+
+def test_ws_heartbeat():
+    """Run the heartbeat checks against an in-process ConnectionManager"""
+    print("🧪 Testing WebSocket heartbeats...")
+    print("=" * 60)
+    asyncio.run(run_checks())
+    print("\n" + "=" * 60)
+    print("✅ All heartbeat checks passed")
+
+
+if __name__ == "__main__":
+    try:
+        test_ws_heartbeat()
+    except AssertionError as e:
+        print(f"❌ Heartbeat check failed: {e}")
+        sys.exit(1)
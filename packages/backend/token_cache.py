@@ -0,0 +1,195 @@
+"""
+Token Cache for Pizoo Dating App
+LRU of decoded JWT claims keyed by token digest, plus a logout-driven deny list
+"""
+
+import os
+import time
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from jose import jwt
+from jose.exceptions import ExpiredSignatureError, JWTError
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', '10000'))
+# How often each worker pulls revocations made by other workers
+TOKEN_DENY_SYNC_SECONDS = float(os.environ.get('TOKEN_DENY_SYNC_SECONDS', '5'))
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class TokenDenyList:
+    """
+    Digests of tokens revoked by logout, kept until the token would have expired.
+    Revocations are written to `revoked_tokens` (TTL on expire_at) and every
+    worker pulls new ones every TOKEN_DENY_SYNC_SECONDS, so a logout reaches all
+    workers within that window without a DB read per request.
+    """
+
+    def __init__(self):
+        # digest -> exp (epoch seconds)
+        self._denied: Dict[str, float] = {}
+        self._db = None
+        self._task: Optional[asyncio.Task] = None
+        self._synced_until: Optional[datetime] = None
+
+    def configure(self, db):
+        self._db = db
+
+    async def ensure_indexes(self):
+        if self._db is None:
+            return
+        await self._db.revoked_tokens.create_index('digest', unique=True)
+        await self._db.revoked_tokens.create_index('revoked_at')
+        await self._db.revoked_tokens.create_index('expire_at', expireAfterSeconds=0)
+
+    def start(self):
+        if self._task is None and self._db is not None:
+            self._task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._denied
+
+    def _add(self, digest: str, exp: float):
+        self._denied[digest] = exp
+        if len(self._denied) % 1000 == 0:
+            self._prune()
+
+    def _prune(self):
+        now = time.time()
+        for digest in [d for d, exp in self._denied.items() if exp <= now]:
+            del self._denied[digest]
+
+    async def revoke(self, token: str, exp: Optional[float] = None):
+        """Deny a token everywhere until its exp"""
+        digest = token_digest(token)
+        if exp is None:
+            try:
+                exp = jwt.get_unverified_claims(token).get('exp')
+            except JWTError:
+                exp = None
+        exp = float(exp) if exp else time.time() + 24 * 3600
+        self._add(digest, exp)
+        for cache in TokenCache.instances:
+            cache.forget(digest)
+
+        if self._db is not None:
+            now = datetime.now(timezone.utc)
+            await self._db.revoked_tokens.update_one(
+                {'digest': digest},
+                {'$set': {
+                    'revoked_at': now,
+                    'expire_at': datetime.fromtimestamp(exp, tz=timezone.utc)
+                }},
+                upsert=True
+            )
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"❌ Failed to sync revoked tokens: {e}")
+            await asyncio.sleep(TOKEN_DENY_SYNC_SECONDS)
+
+    async def sync(self):
+        query = {}
+        if self._synced_until is not None:
+            # Small overlap so revocations committed out of order are not missed
+            query['revoked_at'] = {'$gte': self._synced_until}
+        started = datetime.now(timezone.utc)
+        async for doc in self._db.revoked_tokens.find(query, {'_id': 0, 'digest': 1, 'expire_at': 1}):
+            expire_at = doc['expire_at']
+            if expire_at.tzinfo is None:
+                expire_at = expire_at.replace(tzinfo=timezone.utc)
+            if doc['digest'] not in self._denied:
+                self._add(doc['digest'], expire_at.timestamp())
+                for cache in TokenCache.instances:
+                    cache.forget(doc['digest'])
+        self._synced_until = started.replace(microsecond=0)
+        self._prune()
+
+    def __len__(self) -> int:
+        return len(self._denied)
+
+
+revoked_tokens = TokenDenyList()
+
+
+class TokenCache:
+    """
+    Decoded claims per token digest, kept until the token's `exp`. The signature
+    is verified once per token per worker; later requests with the same token
+    are a dict lookup. Tokens without `exp` are never cached.
+    """
+
+    instances: List["TokenCache"] = []
+
+    def __init__(self, secret_key: str, algorithms: List[str]):
+        self._secret_key = secret_key
+        self._algorithms = algorithms
+        # digest -> (claims, exp)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats_counters = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'denied': 0,
+            'evictions': 0,
+        }
+        TokenCache.instances.append(self)
+
+    def decode(self, token: str) -> dict:
+        """Same contract as jwt.decode: returns claims or raises JWTError"""
+        digest = token_digest(token)
+        if digest in revoked_tokens:
+            self.stats_counters['denied'] += 1
+            raise JWTError("Token has been revoked")
+
+        entry = self._entries.get(digest)
+        if entry is not None:
+            claims, exp = entry
+            if exp > time.time():
+                self._entries.move_to_end(digest)
+                self.stats_counters['hits'] += 1
+                return dict(claims)
+            del self._entries[digest]
+            self.stats_counters['expired'] += 1
+            raise ExpiredSignatureError("Signature has expired.")
+
+        self.stats_counters['misses'] += 1
+        claims = jwt.decode(token, self._secret_key, algorithms=self._algorithms)
+        exp = claims.get('exp')
+        if isinstance(exp, (int, float)):
+            self._entries[digest] = (claims, float(exp))
+            while len(self._entries) > TOKEN_CACHE_MAX_ENTRIES:
+                self._entries.popitem(last=False)
+                self.stats_counters['evictions'] += 1
+        return dict(claims)
+
+    def forget(self, digest: str):
+        self._entries.pop(digest, None)
+
+    def stats(self) -> dict:
+        hits = self.stats_counters['hits']
+        lookups = hits + self.stats_counters['misses']
+        return {
+            'entries': len(self._entries),
+            'max_entries': TOKEN_CACHE_MAX_ENTRIES,
+            'hit_rate': round(hits / lookups, 4) if lookups else None,
+            'revoked_tokens': len(revoked_tokens),
+            **self.stats_counters,
+        }
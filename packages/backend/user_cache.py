@@ -0,0 +1,108 @@
+"""
+User Cache for Pizoo Dating App
+Process-local TTL + LRU cache of user documents for request authentication
+"""
+
+import os
+import copy
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Short TTL bounds staleness from writes made by other workers/services
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '15'))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '10000'))
+
+
+class UserCache:
+    """
+    Caches `users` documents by id so get_current_user/optional_auth skip the
+    find_one on most requests. Every write to a user in this process must call
+    invalidate(); writes from other processes are bounded by the TTL. Callers
+    get a copy, so mutating a returned document never corrupts the cache.
+    """
+
+    def __init__(self):
+        # user_id -> (document, loaded_at monotonic)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # Bumped on every invalidation; a fill that raced a write is discarded
+        self._epoch = 0
+        self.stats_counters = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'discarded_fills': 0,
+        }
+        self._hit_age_total = 0.0
+        self._hit_age_max = 0.0
+
+    async def get(self, db, user_id: str) -> Optional[dict]:
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            document, loaded_at = entry
+            age = now - loaded_at
+            if age <= USER_CACHE_TTL_SECONDS:
+                self._entries.move_to_end(user_id)
+                self.stats_counters['hits'] += 1
+                self._hit_age_total += age
+                self._hit_age_max = max(self._hit_age_max, age)
+                return copy.deepcopy(document)
+            del self._entries[user_id]
+            self.stats_counters['expired'] += 1
+
+        self.stats_counters['misses'] += 1
+        epoch = self._epoch
+        document = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if document is None:
+            return None
+        if epoch != self._epoch:
+            # A user write happened while we were reading; don't cache what may be stale
+            self.stats_counters['discarded_fills'] += 1
+            return document
+
+        self._entries[user_id] = (document, time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > USER_CACHE_MAX_ENTRIES:
+            self._entries.popitem(last=False)
+            self.stats_counters['evictions'] += 1
+        return copy.deepcopy(document)
+
+    def invalidate(self, user_id: Optional[str]):
+        """Forget user_id (call after any write to that user)"""
+        self._epoch += 1
+        self.stats_counters['invalidations'] += 1
+        if user_id is not None:
+            self._entries.pop(user_id, None)
+
+    def invalidate_by(self, field: str, value):
+        """Forget users whose cached `field` equals value (for writes not keyed by id)"""
+        self._epoch += 1
+        self.stats_counters['invalidations'] += 1
+        for user_id in [uid for uid, (doc, _) in self._entries.items() if doc.get(field) == value]:
+            del self._entries[user_id]
+
+    def clear(self):
+        self._epoch += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        hits = self.stats_counters['hits']
+        lookups = hits + self.stats_counters['misses']
+        return {
+            'entries': len(self._entries),
+            'max_entries': USER_CACHE_MAX_ENTRIES,
+            'ttl_seconds': USER_CACHE_TTL_SECONDS,
+            'hit_rate': round(hits / lookups, 4) if lookups else None,
+            'avg_hit_age_seconds': round(self._hit_age_total / hits, 3) if hits else None,
+            'max_hit_age_seconds': round(self._hit_age_max, 3),
+            **self.stats_counters,
+        }
+
+
+user_cache = UserCache()
@@ -0,0 +1,261 @@
+"""
+Voice Upload Service for Pizoo Dating App
+Streams voice messages from the request body to disk and uploads them to Cloudinary off the event loop
+"""
+
+import os
+import uuid
+import asyncio
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from fastapi import Request
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from realtime_service import manager
+
+logger = logging.getLogger(__name__)
+
+VOICE_MAX_BYTES = int(os.environ.get('VOICE_MAX_BYTES', str(10 * 1024 * 1024)))
+# Multipart framing around the file part (boundaries, part headers)
+VOICE_FORM_OVERHEAD_BYTES = 16 * 1024
+# Uploads running at once (thread pool size) and uploads allowed to wait behind them
+VOICE_UPLOAD_WORKERS = int(os.environ.get('VOICE_UPLOAD_WORKERS', '4'))
+VOICE_UPLOAD_MAX_PENDING = int(os.environ.get('VOICE_UPLOAD_MAX_PENDING', '32'))
+VOICE_SHUTDOWN_GRACE_SECONDS = float(os.environ.get('VOICE_SHUTDOWN_GRACE_SECONDS', '20'))
+
+
+class VoiceTooLarge(Exception):
+    pass
+
+
+class VoiceUploadBusy(Exception):
+    pass
+
+
+class VoiceInvalidUpload(Exception):
+    pass
+
+
+class _FilePartWriter:
+    """python-multipart callbacks writing the form's `file` part to `out`, capped at VOICE_MAX_BYTES"""
+
+    def __init__(self, out):
+        self.out = out
+        self.found = False
+        self.written = 0
+        self.error: Optional[Exception] = None
+        self._in_file = False
+        self._headers: Dict[bytes, bytes] = {}
+        self._field = b''
+        self._value = b''
+
+    def callbacks(self) -> dict:
+        return {
+            'on_part_begin': self.on_part_begin,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+            'on_part_data': self.on_part_data,
+            'on_part_end': self.on_part_end,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b''
+
+    def on_headers_finished(self):
+        _, disposition = parse_options_header(self._headers.get(b'content-disposition', b''))
+        self._in_file = disposition.get(b'name') == b'file' and not self.found
+        if not self._in_file:
+            return
+        self.found = True
+        if not self._headers.get(b'content-type', b'').startswith(b'audio/'):
+            self.error = VoiceInvalidUpload("Invalid file type. Must be audio file.")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_file or self.error is not None:
+            return
+        self.written += end - start
+        if self.written > VOICE_MAX_BYTES:
+            self.error = VoiceTooLarge()
+            return
+        self.out.write(data[start:end])
+
+    def on_part_end(self):
+        self._in_file = False
+
+
+def _upload_to_cloudinary(path: str, user_id: str) -> dict:
+    """Blocking Cloudinary upload; runs in the voice thread pool"""
+    import cloudinary.uploader
+    return cloudinary.uploader.upload(
+        path,
+        resource_type="video",  # Cloudinary handles audio as video resource
+        folder=f"pizoo/voice_messages/{user_id}",
+        format="webm",
+        transformation=[
+            {'audio_codec': 'opus', 'bit_rate': '32k'}
+        ]
+    )
+
+
+class VoiceUploadService:
+    """
+    The endpoint only streams the request body's file part to a temp file and
+    returns a pending upload id. The Cloudinary call runs in a bounded
+    thread pool; the result is stored in `voice_uploads` and pushed to the user
+    over WebSocket as `voice_upload_complete` / `voice_upload_failed`.
+    """
+
+    def __init__(self):
+        self._db = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.stats_counters = {
+            'accepted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected_busy': 0,
+            'rejected_too_large': 0,
+        }
+
+    def configure(self, db):
+        self._db = db
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=VOICE_UPLOAD_WORKERS,
+                thread_name_prefix='voice-upload'
+            )
+        return self._executor
+
+    async def spool(self, request: Request) -> str:
+        """
+        Parse the multipart body as it arrives and write its `file` part to a
+        temp file. The size cap and audio type check apply while reading, so a
+        bad upload is rejected without buffering the rest of it (the body is not
+        parsed into an UploadFile first, so this is the only copy on disk).
+        """
+        length = request.headers.get('content-length', '')
+        if length.isdigit() and int(length) > VOICE_MAX_BYTES + VOICE_FORM_OVERHEAD_BYTES:
+            self.stats_counters['rejected_too_large'] += 1
+            raise VoiceTooLarge()
+        content_type, params = parse_options_header(request.headers.get('content-type', ''))
+        if content_type != b'multipart/form-data' or not params.get(b'boundary'):
+            raise VoiceInvalidUpload("Expected multipart/form-data with a `file` field")
+
+        fd, path = tempfile.mkstemp(prefix='pizoo-voice-', suffix='.audio')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                writer = _FilePartWriter(out)
+                parser = MultipartParser(params[b'boundary'], writer.callbacks())
+                async for chunk in request.stream():
+                    parser.write(chunk)
+                    if writer.error is not None:
+                        break
+                else:
+                    parser.finalize()
+            if isinstance(writer.error, VoiceTooLarge):
+                self.stats_counters['rejected_too_large'] += 1
+            if writer.error is not None:
+                raise writer.error
+            if not writer.found:
+                raise VoiceInvalidUpload("Expected multipart/form-data with a `file` field")
+        except MultipartParseError:
+            os.unlink(path)
+            raise VoiceInvalidUpload("Malformed multipart body")
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path
+
+    async def submit(self, user_id: str, path: str) -> str:
+        """Queue an upload of a spooled file and return its pending upload id"""
+        if len(self._tasks) >= VOICE_UPLOAD_WORKERS + VOICE_UPLOAD_MAX_PENDING:
+            os.unlink(path)
+            self.stats_counters['rejected_busy'] += 1
+            raise VoiceUploadBusy()
+
+        upload_id = str(uuid.uuid4())
+        if self._db is not None:
+            await self._db.voice_uploads.insert_one({
+                'id': upload_id,
+                'user_id': user_id,
+                'status': 'pending',
+                'created_at': datetime.now(timezone.utc).isoformat()
+            })
+        self._tasks[upload_id] = asyncio.create_task(self._run(upload_id, user_id, path))
+        self.stats_counters['accepted'] += 1
+        return upload_id
+
+    async def _run(self, upload_id: str, user_id: str, path: str):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._get_executor(), _upload_to_cloudinary, path, user_id)
+            update = {
+                'status': 'completed',
+                'url': result['secure_url'],
+                'duration': result.get('duration', 0),
+                'public_id': result['public_id'],
+            }
+            frame = {'type': 'voice_upload_complete', 'upload_id': upload_id, **update}
+            self.stats_counters['completed'] += 1
+        except Exception as e:
+            logger.error(f"Voice message upload error: {str(e)}")
+            update = {'status': 'failed', 'error': str(e)}
+            frame = {'type': 'voice_upload_failed', 'upload_id': upload_id}
+            self.stats_counters['failed'] += 1
+        finally:
+            self._tasks.pop(upload_id, None)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+        update['completed_at'] = datetime.now(timezone.utc).isoformat()
+        if self._db is not None:
+            await self._db.voice_uploads.update_one({'id': upload_id}, {'$set': update})
+        await manager.send_personal_message(frame, user_id)
+
+    async def get_status(self, upload_id: str, user_id: str) -> Optional[dict]:
+        if self._db is None:
+            return None
+        return await self._db.voice_uploads.find_one(
+            {'id': upload_id, 'user_id': user_id},
+            {'_id': 0, 'error': 0}
+        )
+
+    async def stop(self):
+        """Give in-flight uploads a grace period, then release the pool"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=VOICE_SHUTDOWN_GRACE_SECONDS)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._tasks),
+            'workers': VOICE_UPLOAD_WORKERS,
+            'max_pending': VOICE_UPLOAD_MAX_PENDING,
+            **self.stats_counters,
+        }
+
+
+voice_uploads = VoiceUploadService()
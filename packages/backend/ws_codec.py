@@ -0,0 +1,191 @@
+"""
+WebSocket Codecs for Pizoo Dating App
+JSON (default) and compact MessagePack frame encodings, negotiated per connection
+"""
+
+import os
+import json
+import logging
+from datetime import datetime, timezone
+from typing import List, Optional, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    msgpack = None
+    MSGPACK_AVAILABLE = False
+    logger.warning("⚠️ msgpack not installed - WebSocket clients will use JSON. Run: pip install msgpack")
+
+# Max frames merged into one `batch` frame when a client opted into batching
+WS_BATCH_MAX_FRAMES = int(os.environ.get('WS_BATCH_MAX_FRAMES', '32'))
+
+SUBPROTOCOL_MSGPACK = 'pizoo.msgpack.v1'
+SUBPROTOCOL_JSON = 'pizoo.json.v1'
+
+# Long field name -> short code used on the MessagePack wire
+FIELD_CODES = {
+    'type': 't',
+    'id': 'i',
+    'sender_id': 's',
+    'receiver_id': 'r',
+    'user_id': 'u',
+    'match_id': 'mi',
+    'message': 'm',
+    'message_type': 'mt',
+    'message_ids': 'ids',
+    'timestamp': 'ts',
+    'online': 'o',
+    'is_typing': 'ty',
+    'users': 'us',
+    'messages': 'ms',
+    'frames': 'f',
+    'has_more': 'hm',
+    'success': 'ok',
+    'read_by': 'rb',
+    'upload_id': 'ui',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+# Frame type -> small integer
+TYPE_CODES = {
+    'new_message': 1,
+    'message_sent': 2,
+    'typing': 3,
+    'read_receipt': 4,
+    'user_status': 5,
+    'presence_snapshot': 6,
+    'pending_messages': 7,
+    'ping': 8,
+    'pong': 9,
+    'batch': 10,
+    'message': 11,
+    'ack': 12,
+    'fetch_pending': 13,
+    'voice_upload_complete': 14,
+    'voice_upload_failed': 15,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Values under these keys are lists of nested frames
+NESTED_FRAME_KEYS = ('messages', 'frames')
+
+
+def _iso_to_millis(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+    except ValueError:
+        return value
+
+
+def _millis_to_iso(value):
+    if isinstance(value, int):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc).isoformat()
+    return value
+
+
+def compact_frame(frame: dict) -> dict:
+    """Shorten known keys, type names and timestamps; unknown keys pass through"""
+    compact = {}
+    for key, value in frame.items():
+        if key == 'type':
+            value = TYPE_CODES.get(value, value)
+        elif key == 'timestamp':
+            value = _iso_to_millis(value)
+        elif key in NESTED_FRAME_KEYS and isinstance(value, list):
+            value = [compact_frame(v) if isinstance(v, dict) else v for v in value]
+        compact[FIELD_CODES.get(key, key)] = value
+    return compact
+
+
+def expand_frame(compact: dict) -> dict:
+    """Inverse of compact_frame"""
+    frame = {}
+    for code, value in compact.items():
+        key = FIELD_NAMES.get(code, code)
+        if key == 'type':
+            value = TYPE_NAMES.get(value, value)
+        elif key == 'timestamp':
+            value = _millis_to_iso(value)
+        elif key in NESTED_FRAME_KEYS and isinstance(value, list):
+            value = [expand_frame(v) if isinstance(v, dict) else v for v in value]
+        frame[key] = value
+    return frame
+
+
+class JsonCodec:
+    """Plain JSON text frames (the fallback every client understands)"""
+
+    name = 'json'
+
+    def __init__(self, subprotocol: Optional[str] = None, batch: bool = False):
+        self.subprotocol = subprotocol
+        self.batch = batch
+
+    def encode(self, frame: dict) -> Union[str, bytes]:
+        return json.dumps(frame, separators=(',', ':'), ensure_ascii=False)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        return json.loads(data)
+
+
+class MsgpackCodec(JsonCodec):
+    """Binary MessagePack frames with short field codes and integer timestamps"""
+
+    name = 'msgpack'
+
+    def encode(self, frame: dict) -> Union[str, bytes]:
+        return msgpack.packb(compact_frame(frame), use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        if isinstance(data, str):
+            # Clients may still send text control frames
+            return json.loads(data)
+        return expand_frame(msgpack.unpackb(data, raw=False))
+
+
+def negotiate(websocket: WebSocket, encoding: Optional[str] = None, batch: bool = False) -> JsonCodec:
+    """
+    Pick a codec from the client's Sec-WebSocket-Protocol offer, or from the
+    ?encoding= query parameter for clients that cannot set subprotocols.
+    Falls back to JSON.
+    """
+    offered: List[str] = websocket.scope.get('subprotocols') or []
+    if SUBPROTOCOL_MSGPACK in offered and MSGPACK_AVAILABLE:
+        return MsgpackCodec(SUBPROTOCOL_MSGPACK, batch)
+    if SUBPROTOCOL_JSON in offered:
+        return JsonCodec(SUBPROTOCOL_JSON, batch)
+    if encoding == 'msgpack' and MSGPACK_AVAILABLE:
+        return MsgpackCodec(None, batch)
+    return JsonCodec(None, batch)
+
+
+async def send_frame(websocket: WebSocket, codec: JsonCodec, frames: List[dict]) -> int:
+    """Send one or more queued frames; returns bytes written"""
+    if len(frames) == 1:
+        payload = codec.encode(frames[0])
+    else:
+        payload = codec.encode({'type': 'batch', 'frames': frames})
+    if isinstance(payload, bytes):
+        await websocket.send_bytes(payload)
+        return len(payload)
+    await websocket.send_text(payload)
+    return len(payload.encode('utf-8'))
+
+
+async def receive_frame(websocket: WebSocket, codec: JsonCodec) -> dict:
+    message = await websocket.receive()
+    if message['type'] == 'websocket.disconnect':
+        raise WebSocketDisconnect(message.get('code', 1000))
+    if message.get('bytes') is not None:
+        return codec.decode(message['bytes'])
+    return codec.decode(message.get('text') or '{}')
+
+
+JSON_CODEC = JsonCodec()